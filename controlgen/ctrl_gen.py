@@ -8,6 +8,9 @@ import torch
 import torch.nn as nn
 import sys
 import torch.nn.functional as F
+sys.path.append('../')
+from src.utils import top_k_top_p_sample
+from src.adapters.loss import linear_cross_entropy
 
 
 class CARA(nn.Module):
@@ -263,11 +266,9 @@ class CARA(nn.Module):
             outputs = self.decoder(**inputs)  # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet (cached hidden-states)
             lm_logits = outputs[0]
 
-            # softmax sample
-            next_tokens_logits = lm_logits[:, -1, :] / self.args.temperature  # (B, 1, vocab_size)
-            filtered_logits = self.top_k_top_p_filtering_batch(next_tokens_logits, top_k=self.args.top_k, top_p=self.args.top_p)  # (B, 1, vocab_size)
-            filtered_logits = F.softmax(filtered_logits, dim=-1)
-            next_tokens = torch.multinomial(filtered_logits, num_samples=1)   # (B, 1)
+            # top-k/top-p sample
+            next_tokens, _ = top_k_top_p_sample(lm_logits[:, -1, :], top_k=self.args.top_k, top_p=self.args.top_p,
+                                                temperature=self.args.temperature)   # (B, 1)
             generated = torch.cat((generated, next_tokens), dim=1)  # (B, seq_len+1)
 
             not_finished = next_tokens != self.tokenizer_decoder.encode('<EOS>')[0]
@@ -276,41 +277,6 @@ class CARA(nn.Module):
 
         return generated    # (B, seq_len)
 
-    def top_k_top_p_filtering_batch(self, logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
-        """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
-            Args:
-                logits: logits distribution shape (vocabulary size)
-                top_k > 0: keep only top k tokens with highest probability (top-k filtering).
-                top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                    Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-            From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
-        """
-        # assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-
-        top_k = min(top_k, logits.size(-1))  # Safety check
-
-        if top_k > 0:
-            # Remove all tokens with a probability less than the last token of the top-k
-            threshold = torch.topk(logits, top_k, dim=-1)[0][:, -1, None]
-            logits.masked_fill_(logits < threshold, filter_value)   #  (B, vocab_size)
-
-        if top_p > 0.0:
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)         # (B, vocab_size)
-            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)   # (B, vocab_size)
-
-            # Remove tokens with cumulative probability above the threshold
-            sorted_indices_to_remove = cumulative_probs > top_p
-
-            # Shift the indices to the right to keep also the first token above the threshold
-            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-            sorted_indices_to_remove[..., 0] = 0
-
-            indices_to_remove = sorted_indices[sorted_indices_to_remove]
-
-            logits.masked_fill_(indices_to_remove, filter_value)
-
-        return logits
-
     def sample_sequence_conditional_batch_soft(self, past, context):
         # context: a single id of <BOS>
         # past: (B, past_seq_len dim_h)
@@ -330,13 +296,6 @@ class CARA(nn.Module):
             next_tokens_soft = gumbel_softmax(logits=lm_logits[:, -1:, :], temperature=self.args.soft_temperature, hard=False)  # (B, 1, vocab_size)
             generated_soft = torch.cat((generated_soft, next_tokens_soft), dim=1)   # (B, seq_len+1, vocab_size)
 
-            # # softmax sample
-            # next_tokens_logits = lm_logits[:, -1, :] / self.args.temperature  # (B, 1, vocab_size)
-            # filtered_logits = self.top_k_top_p_filtering_batch(next_tokens_logits, top_k=self.args.top_k, top_p=self.args.top_p)  # (B, 1, vocab_size)
-            # filtered_logits = F.softmax(filtered_logits, dim=-1)
-            # next_tokens = torch.multinomial(filtered_logits, num_samples=1)   # (B, 1)
-            # generated = torch.cat((generated, next_tokens), dim=1)  # (B, seq_len+1)
-
             next_tokens = torch.argmax(next_tokens_soft, dim=-1)    # (B, 1)
             not_finished = next_tokens != self.tokenizer_decoder.encode('<|endoftext|>')[0]
             if torch.sum(not_finished) == 0:
@@ -355,6 +314,8 @@ class Ctrl_AdaVAE(nn.Module):
         self.transformer = decoder
         self.encoder = encoder
         self.bos_token_id = self.eos_token = eos_token
+        ## optional vocabulary shortlist for sampling (LongTensor of allowed token ids)
+        self.shortlist = None
 
         self.nz = AdapterConfig.latent_size
         self.n_label = args.n_label
@@ -491,9 +452,9 @@ class Ctrl_AdaVAE(nn.Module):
                                    inputs_embeds=inputs_embeds,
                                    representations=past)
         hidden_states = outputs[0]
-        lm_logits = self.lm_head(hidden_states)
-        num_logits = lm_logits.size(-1)
-        loss_rec = self.CrossEntropyLoss(lm_logits.view(-1, num_logits), tgt_seq_ids.view(-1))
+        ## lm_head fused with the cross-entropy over vocabulary chunks, no (B, seq_len, vocab_size) logits
+        loss_rec = linear_cross_entropy(hidden_states, self.lm_head.weight, tgt_seq_ids,
+                                        ignore_index=self.CrossEntropyLoss.ignore_index)
 
         ####################  Train a classifier in the observation space ####################
         tgt_emb = self.gpt_embeddings(tgt_seq_ids)
@@ -535,31 +496,37 @@ class Ctrl_AdaVAE(nn.Module):
         loss = loss_rec + self.args.beta_latent * loss_latent_space
 
         if not self.training:
-            # Generate based on encoded z and gt labels
-            generated = self.sample_sequence_conditional_batch(representations=past, context=self.bos_token_id)
-
+            # Generate based on encoded z and gt labels (reconstruction)
             # Generate based on encoded z and sampled labels (attribute transfer)
             # at_past = torch.cat([past_z.unsqueeze(1), past_sampled_label.unsqueeze(1)], dim=1) # (B, 2, n_blocks * hidden_size)
             at_past = past_z + self.n_label *  past_sampled_label  # (B, n_blocks * hidden_size)
-            # at_past = [at_past.unsqueeze(-2), at_past.unsqueeze(-2)]  # query, key
-            # at_past = [at_past] * len(self.transformer.h)
-            at_generated = self.sample_sequence_conditional_batch(representations=at_past,
-                                                                  context=self.bos_token_id)  # (B, seq_len)
-
             # Generate based on sampled z and sampled labels. (conditional generation)
             # cg_past = torch.cat([gen_past_z.unsqueeze(1), past_sampled_label.unsqueeze(1)], dim=1) # (B, 2, n_blocks * hidden_size)
             cg_past = gen_past_z + self.n_label * sampled_label_emb  # (B, n_blocks * hidden_size)
-            # cg_past = [cg_past.unsqueeze(-2), cg_past.unsqueeze(-2)]  # query, key
-            # cg_past = [cg_past] * len(self.transformer.h)
-            cg_generated = self.sample_sequence_conditional_batch(representations=cg_past,
-                                                                  context=self.bos_token_id)  # (B, seq_len)
+            ## the three generations run as a single decode over a 3B batch
+            bsz = past.size(0)
+            all_generated = self.sample_sequence_conditional_batch(representations=torch.cat([past, at_past, cg_past], dim=0),
+                                                                   context=self.bos_token_id)  # (3B, seq_len)
+            ## every B-chunk is cut to the length its own decode would have run
+            lengths = [self.generated_length(g) for g in all_generated.split(bsz)]
+            generated, at_generated, cg_generated = [g[:, :l] for g, l in zip(all_generated.split(bsz), lengths)]
+
+            # classifier on the three generated batches in one pass.
+            # rows are <EOS>-filled after their first <EOS> (sample_sequence_conditional_batch), where a separate
+            # decode used to keep sampling until the whole batch had ended: the conv1 (kernel 3, no padding)
+            # outputs are averaged over every row's own length up to its first <EOS>, so the classifier
+            # accuracies only see the generated sentence itself (not the tokens sampled after it, as before)
+            all_emb = self.gpt_embeddings(all_generated)
+            all_encode = self.conv1(all_emb.transpose(1, 2))  # (3B, dim_h, seq_len - 2)
+            encode_len = self.row_lengths(all_generated) - 2  # (3B)
+            positions = torch.arange(all_encode.size(-1), device=all_encode.device)
+            encode_mask = (positions.unsqueeze(0) < encode_len.unsqueeze(1)).to(all_encode.dtype)  # (3B, seq_len - 2)
+            ## rows of at most 2 tokens (<BOS><EOS>) have no conv output: zero encoding instead of a 0 division
+            all_encode = (all_encode * encode_mask.unsqueeze(1)).sum(dim=-1) / \
+                         encode_len.clamp(min=1).unsqueeze(1).to(all_encode.dtype)
+            prob_ge_cls, prob_at_cls, prob_cg_cls = self.classifier(all_encode).split(bsz)  # (B, 1) each
 
             # classifier on gt generated sentences.
-            ge_emb = self.gpt_embeddings(generated)
-            ge_encode = self.conv1(ge_emb.transpose(1, 2))  # (B, dim_h, seq_len)
-            ge_encode = torch.mean(ge_encode, dim=-1)  # (B, dim_h)
-            prob_ge_cls = self.classifier(ge_encode)  # (B, 1)
-
             if self.args.label_size <= 2:
                 pred_ge_cls = (prob_ge_cls.squeeze(1) >= 0).to(torch.long)
             else:
@@ -568,10 +535,6 @@ class Ctrl_AdaVAE(nn.Module):
 
             # classifier on attribute transfer generated sentences.
             # From the current sentiment to the opposite one (two labels)
-            at_emb = self.gpt_embeddings(at_generated)
-            at_encode = self.conv1(at_emb.transpose(1, 2))  # (B, dim_h, seq_len)
-            at_encode = torch.mean(at_encode, dim=-1)  # (B, dim_h)
-            prob_at_cls = self.classifier(at_encode)  # (B, 1)
             if self.args.label_size <= 2:
                 pred_at_cls = (prob_at_cls.squeeze(1) >= 0).to(torch.long)
             else:
@@ -579,10 +542,6 @@ class Ctrl_AdaVAE(nn.Module):
             acc_at_cls = (pred_at_cls == sampled_cond_labels).float()
 
             # classifier on conditional generated sentences.
-            cg_emb = self.gpt_embeddings(cg_generated)
-            cg_encode = self.conv1(cg_emb.transpose(1, 2))  # (B, dim_h, seq_len)
-            cg_encode = torch.mean(cg_encode, dim=-1)  # (B, dim_h)
-            prob_cg_cls = self.classifier(cg_encode)  # (B, 1)
             if self.AdapterConfig.class_num <= 2:
                 pred_cg_cls = (prob_cg_cls.squeeze(1) >= 0).to(torch.long)
             else:
@@ -631,71 +590,65 @@ class Ctrl_AdaVAE(nn.Module):
         }
         return loss_dict, acc_dict
 
+    def row_lengths(self, generated):
+        """(B,) length of every row up to and including its first generated <EOS>, the full length without one"""
+        is_eos = generated[:, 1:] == self.eos_token
+        positions = torch.arange(1, generated.size(1), device=generated.device).expand_as(is_eos)
+        first_eos = torch.where(is_eos, positions, torch.full_like(positions, generated.size(1) - 1)).min(dim=1)[0]
+        return first_eos + 1
+
+    def generated_length(self, generated):
+        """number of positions a decode of this batch alone produces: it stops once every row has an <EOS>"""
+        return int(self.row_lengths(generated).max())
+
     def sample_sequence_conditional_batch(self, representations, context):
         # context: a single id of <BOS>
         # past: (B, past_seq_len dim_h)
         num_samples = representations.size(0)
-        prev = torch.tensor([[context]] * num_samples, dtype=torch.long, device=representations.device)
-        generated = prev # (B, 1)
-        mem = None
+        ## (B, block_size) written in place, positions after <EOS> keep the <EOS> filling
+        generated = torch.full((num_samples, self.args.block_size), self.eos_token, dtype=torch.long,
+                               device=representations.device)
+        generated[:, 0] = context
+        prev = generated[:, :1]
+        seq_len = 1
+        ## rows still decoding: finished ones are pruned from the cache and the latent context
+        active = torch.arange(num_samples, device=representations.device)
+        mem = self.transformer.init_kv_cache(self.args.block_size)
+        latent_context = self.transformer.init_latent_context(representations)
+        if self.shortlist is not None:
+            ## decode in the reduced vocabulary, sampled ids are mapped back
+            shortlist = self.shortlist.to(representations.device)
+            lm_weight = self.lm_head.weight.index_select(0, shortlist)
         # with torch.no_grad():
-        while generated.size(-1) < self.args.block_size:
-            inputs = {'input_ids': prev, 'past': mem, 'representations': representations}
+        while seq_len < self.args.block_size:
+            inputs = {'input_ids': prev, 'past': mem, 'representations': latent_context}
             last_hidden, mem = self.transformer(**inputs)  # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet (cached hidden-states)
-            lm_logits = self.lm_head(last_hidden)  # (B, seq_len, vocab_size)
+            if self.shortlist is not None:
+                lm_logits = F.linear(last_hidden, lm_weight)  # (B, seq_len, shortlist_size)
+            else:
+                lm_logits = self.lm_head(last_hidden)  # (B, seq_len, vocab_size)
 
-            # softmax sample
-            next_tokens_logits = lm_logits[:, -1, :] / self.args.temperature  # (B, 1, vocab_size)
-            filtered_logits = self.top_k_top_p_filtering_batch(next_tokens_logits, top_k=self.args.top_k, top_p=self.args.top_p)  # (B, 1, vocab_size)
-            filtered_logits = F.softmax(filtered_logits, dim=-1)
-            next_tokens = torch.multinomial(filtered_logits, num_samples=1)   # (B, 1)
+            # top-k/top-p sample
+            next_tokens, _ = top_k_top_p_sample(lm_logits[:, -1, :], top_k=self.args.top_k, top_p=self.args.top_p,
+                                                temperature=self.args.temperature)   # (B, 1)
+            if self.shortlist is not None:
+                next_tokens = shortlist[next_tokens]
             prev = next_tokens
-            generated = torch.cat((generated, next_tokens), dim=1)  # (B, seq_len+1)
+            generated[active, seq_len] = next_tokens.view(-1)
+            seq_len += 1
 
-            not_finished = next_tokens != self.eos_token
+            not_finished = (next_tokens != self.eos_token).view(-1)
             if torch.sum(not_finished) == 0:
                 break
+            if not not_finished.all():
+                keep = not_finished.nonzero().view(-1)
+                active, prev = active[keep], prev[keep]
+                mem = self.transformer.select_past(mem, keep)
+                latent_context = latent_context.index_select(keep)
 
+        generated = generated[:, :seq_len]
         return generated    # (B, seq_len)
 
-    def top_k_top_p_filtering_batch(self, logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
-        """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
-            Args:
-                logits: logits distribution shape (vocabulary size)
-                top_k > 0: keep only top k tokens with highest probability (top-k filtering).
-                top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                    Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-            From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
-        """
-        # assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-
-        top_k = min(top_k, logits.size(-1))  # Safety check
-
-        if top_k > 0:
-            # Remove all tokens with a probability less than the last token of the top-k
-            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-            # logits.masked_fill_(logits < threshold, filter_value)  # (B, vocab_size)
-            logits[indices_to_remove] = filter_value
-
-        if top_p > 0.0:
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)  # (B, vocab_size)
-            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)  # (B, vocab_size)
-
-            # Remove tokens with cumulative probability above the threshold
-            sorted_indices_to_remove = cumulative_probs > top_p
-
-            # Shift the indices to the right to keep also the first token above the threshold
-            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-            sorted_indices_to_remove[..., 0] = 0
-
-            # indices_to_remove = sorted_indices[sorted_indices_to_remove]
-
-            # logits.masked_fill_(indices_to_remove, filter_value)
-            indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
-            logits[indices_to_remove] = filter_value
-
-        return logits
-
     def sample_sequence_conditional_batch_soft(self, past, context):
         # context: a single id of <BOS>
         # past: (B, past_seq_len dim_h)
@@ -719,13 +672,6 @@ class Ctrl_AdaVAE(nn.Module):
                                               hard=False)  # (B, 1, vocab_size)
             generated_soft = torch.cat((generated_soft, next_tokens_soft), dim=1)  # (B, seq_len+1, vocab_size)
 
-            # # softmax sample
-            # next_tokens_logits = lm_logits[:, -1, :] / self.args.temperature  # (B, 1, vocab_size)
-            # filtered_logits = self.top_k_top_p_filtering_batch(next_tokens_logits, top_k=self.args.top_k, top_p=self.args.top_p)  # (B, 1, vocab_size)
-            # filtered_logits = F.softmax(filtered_logits, dim=-1)
-            # next_tokens = torch.multinomial(filtered_logits, num_samples=1)   # (B, 1)
-            # generated = torch.cat((generated, next_tokens), dim=1)  # (B, seq_len+1)
-
             next_tokens = torch.argmax(next_tokens_soft, dim=-1)  # (B, 1)
             not_finished = next_tokens != self.tokenizer_decoder.encode('<EOS>')[0]
             if torch.sum(not_finished) == 0:
@@ -20,7 +20,7 @@ from src.adapters.vae import *
 from src.utils import *
 from apex import amp
 from src.adapters.common import AdapterConfig
-from src.data import ConditionalGenerationDataset
+from src.data import ConditionalGenerationDataset, EvalBatches, Collator, batching, loader_workers
 from transformers import GPT2Tokenizer, GPT2LMHeadModel, GPT2Config, AdamW, get_linear_schedule_with_warmup, Conv1D
 
 
@@ -88,6 +88,8 @@ parser.add_argument('--latent_gen', type=str, default="latent_attn",
                     choices=['latent_attn', 'averaged_attn', 'linear', 'mean_max_linear'])
 parser.add_argument('--workers', default=2, type=int, metavar='N',
                     help='number of data loading workers')
+parser.add_argument('--prefetch_factor', default=2, type=int,
+                    help='batches prepared ahead by every data loading worker')
 
 # use GPU
 parser.add_argument('--gpu', default=0, type=int)
@@ -105,6 +107,16 @@ parser.add_argument('--top_k', default=10, type=int)
 parser.add_argument('--top_p', default=0.5, type=float)
 parser.add_argument('--temperature', default=1.0, type=float)
 parser.add_argument('--test_flag', default=0, type=int)
+parser.add_argument('--vocab_shortlist', action="store_true",
+                    help="sample only with the token types of the training set")
+parser.add_argument('--shortlist_min_count', type=int, default=1,
+                    help="minimum training frequency of a token type to enter the shortlist")
+parser.add_argument('--decode_slots', type=int, default=0,
+                    help="conditional generation with continuous batching over this many decoding slots")
+parser.add_argument('--length_buckets', action="store_true",
+                    help="batch sentences of similar length together")
+parser.add_argument('--max_tokens', type=int, default=None,
+                    help="with --length_buckets, vary the training batch size to about this many words per batch")
 
 ## trigger
 parser.add_argument('--load', action="store_true")
@@ -160,8 +172,15 @@ def conditional_generate(args, model, tokenizer, label, n_samples, eval_output_d
         # cg_past = [cg_past.unsqueeze(-2), cg_past.unsqueeze(-2)]  # query, key
         # cg_past = [cg_past] * len(self.transformer.h)
         bos_token_id = eos_token_id = pad_token_id = tokenizer.encode('<|endoftext|>')[0]
-        cg_generated = model.sample_sequence_conditional_batch(representations=cg_past,
-                                                              context=bos_token_id).cpu().tolist()  # (B, seq_len)
+        if args.decode_slots > 0:
+            cg_generated, stats = continuous_sample(model, args.block_size - 1, cg_past, args.decode_slots,
+                                                    top_k=args.top_k, top_p=args.top_p, temperature=args.temperature,
+                                                    device=device, eos_token=eos_token_id, shortlist=model.shortlist)
+            cg_generated = cg_generated.cpu().tolist()  # (B, block_size)
+            print(f"{stats['sentences_per_sec']:.2f} sentences/sec, slot occupancy {stats['occupancy']:.3f}")
+        else:
+            cg_generated = model.sample_sequence_conditional_batch(representations=cg_past,
+                                                                  context=bos_token_id).cpu().tolist()  # (B, seq_len)
 
         cg_generated_ids = []
         cg_generated_text = []
@@ -212,8 +231,8 @@ def evaluate(args, model, tokenizer, logging, eval_dataloader, max_val_batches,
     with tqdm(total=min(len(eval_dataloader), max_val_batches), desc="Evaluating Model") as pbar:
         for bi, batch in enumerate(eval_dataloader):
             ## Data
-            tgt_seq_ids, input_seq_ids, input_mask = tokenize(batch['x'], tokenizer, device, args)
-            cond_labels = torch.tensor(batch['y']).to(device)
+            tgt_seq_ids, input_seq_ids, input_mask = batch_tokens(batch, tokenizer, device, args)
+            cond_labels = batch['y'].to(device, non_blocking=True)
 
             # Model
             with torch.no_grad():
@@ -500,24 +519,28 @@ def main(args):
     cur_b_schedule = len(batch_schedule) - 1 if args.switch_time == 0 else 0
     logging.info('Batch schedule')
     logging.info(batch_schedule)
+    train_set = ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/train.txt")
+    test_set = ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/test.txt")
+    val_set = ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/valid.txt")
+    collate = Collator(tokenizer, args.max_length)
     train_loader = DataLoader(
-        ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/train.txt"),
-        batch_size=batch_schedule[cur_b_schedule][0],
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
-    test_loader = DataLoader(
-        ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/test.txt"),
-        batch_size=batch_schedule[-1][0],
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
-    val_loader = DataLoader(
-        ConditionalGenerationDataset.from_file(f"../data/{args.dataset}/valid.txt"),
-        batch_size=batch_schedule[-1][0],
+        train_set,
+        **batching(train_set, batch_schedule[cur_b_schedule][0], args.length_buckets, args.max_tokens,
+                   shuffle=False, drop_last=True),
         pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
+        **loader_workers(args.workers, args.prefetch_factor),
+        collate_fn=collate)
+    ## evaluation batches are built once, the same ones at every evaluation
+    test_loader = EvalBatches(test_set, collate, batch_schedule[-1][0], seed=args.seed)
+    val_loader = EvalBatches(val_set, collate, batch_schedule[-1][0], seed=args.seed)
+    if args.vocab_shortlist:
+        model.shortlist, coverage = build_vocab_shortlist([train_set[i]['x'] for i in range(len(train_set))],
+                                                          tokenizer, min_count=args.shortlist_min_count,
+                                                          special_ids=[endoftext],
+                                                          eval_texts=[val_set[i]['x'] for i in range(len(val_set))])
+        logging.info('Vocabulary shortlist: %d/%d types, lost token coverage %.4f%% (train) %.4f%% (valid)' %
+                     (coverage['shortlist_size'], coverage['vocab_size'],
+                      100 * coverage['train_lost'], 100 * coverage['eval_lost']))
     logging.info('Done.')
 
 
@@ -555,8 +578,8 @@ def main(args):
 
             with tqdm(total=len(train_loader)) as pbar:
                 for i, data_dict in enumerate(train_loader):
-                    x_ids, input_ids, attention_mask = tokenize(data_dict['x'], tokenizer, device, args)
-                    cond_labels = torch.tensor(data_dict['y']).to(device)
+                    x_ids, input_ids, attention_mask = batch_tokens(data_dict, tokenizer, device, args)
+                    cond_labels = data_dict['y'].to(device, non_blocking=True)
 
                     if args.warmup != -1:
                         scheduler.step()
@@ -18,7 +18,7 @@ import torch.nn.functional as F
 from src.adapters.vae import *
 from src.utils import *
 from src.adapters.common import AdapterConfig
-from src.data import DialogGenerationDataset
+from src.data import DialogGenerationDataset, EvalBatches, Collator, batching, loader_workers
 import datetime
 
 from torch.utils.data import Dataset, DataLoader
@@ -96,6 +96,12 @@ parser.add_argument('--latent_gen', type=str, default="averaged_attn",
                     choices=['averaged_attn', 'linear'])
 parser.add_argument('--workers', default=2, type=int, metavar='N',
                     help='number of data loading workers')
+parser.add_argument('--prefetch_factor', default=2, type=int,
+                    help='batches prepared ahead by every data loading worker')
+parser.add_argument('--length_buckets', action="store_true",
+                    help="batch dialogues of similar response length together")
+parser.add_argument('--max_tokens', type=int, default=None,
+                    help="with --length_buckets, vary the training batch size to about this many words per batch")
 parser.add_argument('--fb', default=1, type=int)
 parser.add_argument('--early_stop', default=6, type=int)
 parser.add_argument("--sents_per_cxt", default=10, type=int,
@@ -150,6 +156,14 @@ def tokenize(context, response, tokenizer, device, args):
     return inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask
 
 
+## batch already tokenized in the loader workers (data.Collator): only moved to the device
+def batch_tokens(batch, tokenizer, device, args):
+    if 'inputs_src' not in batch:
+        return tokenize(batch['context'], batch['response'], tokenizer, device, args)
+    return tuple(batch[k].to(device, non_blocking=True) for k in
+                 ('inputs_src', 'inputs_tgt', 'labels_tgt', 'src_attention_mask', 'tgt_attention_mask'))
+
+
 def compute_loss(device, model, inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask, beta, kl_rate, fb):
     inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask = \
         inputs_src.to(device), inputs_tgt.to(device), labels_tgt.to(device), src_attention_mask.to(device), \
@@ -181,57 +195,19 @@ def train_step(device, model, optimizer, inputs_src, inputs_tgt, labels_tgt, src
     return loss, loss_rec, loss_reg
 
 
-def top_k_top_p_filtering_mb(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
-    """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
-        Args:
-            logits: logits distribution shape (vocabulary size)
-            top_k > 0: keep only top k tokens with highest probability (top-k filtering).
-            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
-    """
-    # assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-
-    top_k = min(top_k, logits.size(-1))  # Safety check
-
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        # logits.masked_fill_(logits < threshold, filter_value)  # (B, vocab_size)
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)  # (B, vocab_size)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)  # (B, vocab_size)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # indices_to_remove = sorted_indices[sorted_indices_to_remove]
-
-        # logits.masked_fill_(indices_to_remove, filter_value)
-        indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
-        logits[indices_to_remove] = filter_value
-
-    return logits
-
 def sample_sequence_conditional(model, length, context, endoftext, z=None, num_samples=1, temperature=1, top_k=0, top_p=0.0):
     generated = context
-    mem = None
+    ## the context is fed once, then one token per step: bounded by ``length`` to size the static cache
+    mem = model.transformer.init_kv_cache(context.size(1) + length)
     prev = context
     with torch.no_grad():
-        while True:
-            # for _ in trange(length):
-            inputs = {'input_ids': prev, 'past': mem, 'representations': z}
+        latent_context = model.transformer.init_latent_context(z)
+        # while True:
+        for _ in range(length):
+            inputs = {'input_ids': prev, 'past': mem, 'representations': latent_context}
             last_hidden, mem = model.transformer(**inputs)  # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet (cached hidden-states)
             lm_logits = model.lm_head(last_hidden)  # (B, seq_len, vocab_size)
-            next_token_logits = lm_logits[:, -1, :] / temperature
-            filtered_logits = top_k_top_p_filtering_mb(next_token_logits, top_k=top_k, top_p=top_p)
-            next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
+            next_token, _ = top_k_top_p_sample(lm_logits[:, -1, :], top_k=top_k, top_p=top_p, temperature=temperature)
             generated = torch.cat((generated, next_token), dim=1)
             prev = next_token
 
@@ -264,8 +240,7 @@ def evaluate(args, model_sf, tokenizer, eval_dataloader, logging, device, prefix
     val_loss_list = []
     with tqdm(total=min(len(eval_dataloader), max_val_batches), desc="Evaluating Model") as pbar:
         for bi, batch in enumerate(eval_dataloader):
-            inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask = tokenize(batch['context'], batch['response'], tokenizer,
-                                                                                                  device, args)
+            inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask = batch_tokens(batch, tokenizer, device, args)
             with torch.no_grad():
                 val_loss, val_loss_rec, val_loss_reg = compute_loss(device, model_sf, inputs_src, inputs_tgt, labels_tgt,
                                                         src_attention_mask,
@@ -468,24 +443,21 @@ def main(args):
     logging.info(batch_schedule)
     GDataset = DialogGenerationDataset
     prefix_path = '../data'
+    train_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "train.txt"))
+    test_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "test.txt"))
+    val_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "valid.txt"))
+    ## buckets follow the response length (text_len)
+    collate = Collator(tokenizer, args.max_length)
     train_loader = DataLoader(
-        GDataset.from_file(os.path.join(prefix_path, args.dataset, "train.txt")),
-        batch_size=batch_schedule[cur_b_schedule][0],
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
-    test_loader = DataLoader(
-        GDataset.from_file(os.path.join(prefix_path, args.dataset, "test.txt")),
-        batch_size=batch_schedule[-1][0],
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
-    val_loader = DataLoader(
-        GDataset.from_file(os.path.join(prefix_path, args.dataset, "valid.txt")),
-        batch_size=batch_schedule[-1][0],
+        train_set,
+        **batching(train_set, batch_schedule[cur_b_schedule][0], args.length_buckets, args.max_tokens,
+                   shuffle=False, drop_last=True),
         pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers)
+        **loader_workers(args.workers, args.prefetch_factor),
+        collate_fn=collate)
+    ## evaluation batches are built once, the same ones at every evaluation
+    test_loader = EvalBatches(test_set, collate, batch_schedule[-1][0], seed=args.seed)
+    val_loader = EvalBatches(val_set, collate, batch_schedule[-1][0], seed=args.seed)
     logging.info('Done.')
 
     logging.info('Wrapping models and optimizers...')
@@ -632,7 +604,7 @@ def main(args):
         # train_iter = iter(train_loader); x_mask, x_tokens, y_mask, y_tokens, input_tokens, target_tokens, mask = next(train_iter)
         with tqdm(total=len(train_loader)) as pbar:
             for i, data_dict in enumerate(train_loader):
-                inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask = tokenize(data_dict['context'], data_dict['response'], tokenizer, device, args)
+                inputs_src, inputs_tgt, labels_tgt, src_attention_mask, tgt_attention_mask = batch_tokens(data_dict, tokenizer, device, args)
 
                 beta = cyclic_weights[num_iters]
                 loss, ce_loss, reg_loss = train_step(device, model_sf, optimizer, inputs_src, inputs_tgt,
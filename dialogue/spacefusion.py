@@ -7,6 +7,7 @@ based on Optimus
 import sys
 sys.path.append('../')
 from src.adapters.vae import *
+from src.adapters.loss import linear_cross_entropy
 import numpy as np
 import torch, copy, pdb
 import torch.nn.functional as F
@@ -138,6 +139,8 @@ class SpaceFusion(AdaVAEModel):
 
         loss_rec = 0
         z_idx = 0
+        target_mask = labels_tgt.ne(self.CELoss.ignore_index)
+        target_tokens = labels_tgt[target_mask]
         for z in [z_AE, z_S2S, z_interp]:
             # pdb.set_trace()
             # past = z  # past = self.decoder.linear(z)
@@ -151,16 +154,13 @@ class SpaceFusion(AdaVAEModel):
                                        representations=z)
             # outputs = self.decoder(input_ids=labels_tgt, past=past, labels=labels_tgt, label_ignore=self.pad_token_id)
             hidden_states = transformer_outputs[0]
-            lm_logits = self.lm_head(hidden_states)
-            num_logits = lm_logits.size(-1)
-
-            # Perform masking
+            # Perform masking: <pad> targets are ignored by CELoss, only the others go through lm_head
             # if tgt_attention_mask is not None:
             #     att_mask = tgt_attention_mask.type(torch.bool)
             #     lm_logits = lm_logits.masked_select(att_mask.unsqueeze(-1))
             #     labels_tgt = labels_tgt.masked_select(att_mask)
-
-            loss_rec_ = self.CELoss(lm_logits.view(-1, num_logits), labels_tgt.view(-1))
+            loss_rec_ = linear_cross_entropy(hidden_states[target_mask], self.lm_head.weight, target_tokens,
+                                             ignore_index=self.CELoss.ignore_index)
 
             if z_idx == 1:
                 loss_rec = loss_rec + 1.0 * loss_rec_
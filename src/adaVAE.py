@@ -15,8 +15,11 @@ from tqdm import tqdm
 import torch.nn.functional as F
 from adapters.vae import *
 from utils import *
+from metrics import LatentStatistics
 from adapters.common import AdapterConfig
-from data import ConditionalGenerationDataset, GenerationDataset, GLUEPretrainingDataset
+from adapters.loss import linear_cross_entropy
+from data import ConditionalGenerationDataset, GenerationDataset, GLUEPretrainingDataset, TokenizedDataset, \
+    EncoderFeatureDataset, EvalBatches, Collator, batching, loader_workers, token_cache_key
 import datetime
 
 from torch.utils.data import Dataset, DataLoader
@@ -56,6 +59,12 @@ parser.add_argument('--encoder_n_layer', type=int, default=6,
                     help="attention layer number of GPT-2 encoder")
 parser.add_argument('--decoder_n_layer', type=int, default=12,
                     help="attention layer number of GPT-2 decoder")
+parser.add_argument('--checkpoint_enc', type=str, default=None,
+                    help="encoder blocks with activation checkpointing: all, a range 0-3 or a list 0,2,4")
+parser.add_argument('--checkpoint_dec', type=str, default=None,
+                    help="decoder blocks with activation checkpointing: all, a range 0-5 or a list 0,2,4")
+parser.add_argument('--attn_backend', type=str, default="eager", choices=['eager', 'sdpa'],
+                    help="attention kernel: eager matmul/softmax or torch scaled_dot_product_attention")
 parser.add_argument('--class_num', type=int, default=2,
                     help="class number for controllable generation")
 # parser.add_argument('--label_emb_size', type=int, default=8,
@@ -96,12 +105,25 @@ parser.add_argument('--adapter_init', type=str, default='bert',
                     help="parameter initialization method for adapter layers.")
 parser.add_argument('--workers', default=2, type=int, metavar='N',
                     help='number of data loading workers')
+parser.add_argument('--prefetch_factor', default=2, type=int,
+                    help='batches prepared ahead by every data loading worker')
+parser.add_argument('--token_cache', type=str, default=None,
+                    help="directory of the pre-tokenized corpus cache, tokenize the texts of every batch if not set")
+parser.add_argument('--encoder_cache', type=str, default=None,
+                    help="directory of the fp16 features of the frozen encoder, "
+                         "used for the training batches before --pre_enc_iter")
+parser.add_argument('--length_buckets', action="store_true",
+                    help="batch sentences of similar length together")
+parser.add_argument('--max_tokens', type=int, default=None,
+                    help="with --length_buckets, vary the training batch size to about this many words per batch")
 parser.add_argument('--early_stop', default=4, type=int,
                     help='early stopping validation step')
 
 ## metrics
 parser.add_argument('--au_delta', type=float, default=0.01,
                     help="threshold for activated unit calculation. 0.01 as suggested in Optimus")
+parser.add_argument('--mi_samples', type=int, default=None,
+                    help="posteriors sampled for the mutual information estimate (reported with its standard error), all if not set")
 
 # use GPU
 parser.add_argument('--gpu', default=0, type=int)
@@ -125,6 +147,8 @@ parser.add_argument('--load', action="store_true")
 parser.add_argument('--save_all', action="store_true",
                     help="save full parameters of the model, may up to 500M+")
 parser.add_argument('--weighted_sample', action="store_true", default=False)
+parser.add_argument('--iw_max_tokens', type=int, default=16384,
+                    help="tokens per decoder pass of the importance weighted NLL, sentences and samples are chunked to fit")
 parser.add_argument('--add_input', action="store_true")
 parser.add_argument('--add_attn', action="store_true")
 parser.add_argument('--add_softmax', action="store_true")
@@ -139,7 +163,8 @@ parser.add_argument('--finetune_dec', help="whether to fine-tune decoder, if Tru
 
 cache_dir = '/home/tuhq/.cache/torch/transformers'
 
-def compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn, beta, kl_rate, reg_loss, weighted_sample=False, from_mean=False, fb=1):
+def compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn, beta, kl_rate, reg_loss, weighted_sample=False, from_mean=False, fb=1,
+                 encoder_hidden_states=None, iw_max_tokens=16384):
     """
 
     :param device:
@@ -150,14 +175,17 @@ def compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn, beta,
     :param loss_fn:
     :param beta: weight of regularization loss
     :param use_adv_loss: use adversarial loss for WAE
+    :param encoder_hidden_states: cached features of the frozen encoder (--encoder_cache)
+    :param iw_max_tokens: tokens per decoder pass of the importance weighted estimate (weighted_sample)
     :return:
     """
     input_tokens = input_tokens.to(device)
     att_mask = att_mask.to(device)
     x_tokens = x_tokens.to(device)
 
-    outputs = model(input_ids=input_tokens, attention_mask=att_mask, from_mean=from_mean)
-    logits = outputs[0]
+    outputs = model(input_ids=input_tokens, attention_mask=att_mask, from_mean=from_mean, return_hidden=True,
+                    encoder_hidden_states=encoder_hidden_states)
+    hidden_states, logits_rep = outputs[0]
     regularization_loss = outputs[-3]
     mean = outputs[-2]
     logvar = outputs[-1]
@@ -167,16 +195,20 @@ def compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn, beta,
     else:
         kl_loss = regularization_loss
         regularization_loss = regularization_loss.sum(-1)
-    num_logits = logits.size(-1)
 
-    # Perform masking
+    # Perform masking: only the target positions go through lm_head
+    bias_index = None
     if att_mask is not None and not weighted_sample:
         att_mask = att_mask.type(torch.bool)
-        logits = logits.masked_select(att_mask.unsqueeze(-1))
+        if logits_rep is not None:
+            bias_index = att_mask.nonzero()[:, 0]
+        hidden_states = hidden_states[att_mask]  # (n_tokens, n_embd)
         x_tokens = x_tokens.masked_select(att_mask)
 
-    ## x_token is target tokens
-    ce_loss = loss_fn(logits.view(-1, num_logits), x_tokens.view(-1))
+    ## x_token is target tokens, lm_head and loss_fn are fused over vocabulary chunks
+    ce_loss = linear_cross_entropy(hidden_states, model.lm_head.weight, x_tokens, bias=logits_rep,
+                                   bias_index=bias_index, ignore_index=loss_fn.ignore_index,
+                                   reduction=loss_fn.reduction)
     if reg_loss == "adversarial":
         loss = ce_loss.mean() + g_loss + beta * d_loss #+ beta * kld
     else:
@@ -196,38 +228,19 @@ def compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn, beta,
             loss = (ce_loss.mean() + beta * kl_loss).mean()
 
     if weighted_sample:
-        nsamples = 100
-        ns = 10
-        bs = mean.size(0)
-        ll_tmp, rc_tmp = [], []
-        x_tokens = x_tokens.unsqueeze(1).expand(bs, ns, x_tokens.size(-1)).contiguous()
-        for _ in range(int(nsamples / ns)):
-            # (batch, nsamples, nz)
-            z = model.reparameterize(mean, logvar, ns=ns)
-
-            # [batch, nsamples]
-            log_prior = (-0.5 * math.log(2 * math.pi) - z ** 2 / 2).sum(dim=-1)#prior.log_prob(z).sum(dim=-1) ## [bs, ns]
-            logits = model.eval_cond_ll(x=input_tokens, mask=att_mask, z=z)
-            log_gen = - loss_fn(logits.view(-1, logits.size(-1)), x_tokens.view(-1)).view(bs, ns, -1).sum(-1)
-
-            log_infer = model.eval_inference_dist(z, (mean, logvar)) # [bs, ns]
-
-            # pdb.set_trace()
-            # log_gen = log_gen.unsqueeze(0).contiguous().view(z.shape[0], -1)
-            # pdb.set_trace()
-            rc_tmp.append(log_gen)
-            ll_tmp.append(log_gen - log_prior + log_infer)
-
-        log_prob_iw = log_sum_exp(torch.cat(ll_tmp, dim=-1), dim=-1) - math.log(nsamples)
-        log_gen_iw = torch.mean(torch.cat(rc_tmp, dim=-1), dim=-1)
+        ## 100-sample importance weighted log p(x), decoded in chunks of at most iw_max_tokens tokens
+        log_prob_iw, log_gen_iw = model.iw_log_likelihood(input_tokens, att_mask, x_tokens, mean, logvar, nsamples=100,
+                                                          ignore_index=loss_fn.ignore_index, max_tokens=iw_max_tokens)
         return loss, ce_loss, regularization_loss, mean, logvar, log_prob_iw, log_gen_iw
     else:
         return loss, ce_loss, regularization_loss, mean, logvar
 
-def train_step(device, model, optimizer, x_tokens, input_tokens, att_mask, loss_fn, beta, kl_rate, reg_loss_type, from_mean, fb):
+def train_step(device, model, optimizer, x_tokens, input_tokens, att_mask, loss_fn, beta, kl_rate, reg_loss_type, from_mean, fb,
+               encoder_hidden_states=None):
     optimizer.zero_grad()
     loss, ce_loss, reg_loss, _, _ = compute_loss(device, model, x_tokens, input_tokens, att_mask, loss_fn,
-                                          beta, kl_rate, reg_loss_type, weighted_sample=False, from_mean=from_mean, fb=fb)
+                                          beta, kl_rate, reg_loss_type, weighted_sample=False, from_mean=from_mean, fb=fb,
+                                          encoder_hidden_states=encoder_hidden_states)
     with amp.scale_loss(loss, optimizer) as scaled_loss:
         scaled_loss.backward()
         torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), 1.0)  # max_grad_norm=1.0
@@ -387,6 +400,10 @@ def train(args):
         AdaVAE.transformer.resize_token_embeddings(len(tokenizer))
     init_para_frompretrained(AdaVAE.transformer, gpt2_model.transformer, share_para=True)
     init_para_frompretrained(AdaVAE.encoder, gpt2_model.transformer, share_para=True)
+    ## trade recomputation for activation memory
+    AdaVAE.encoder.set_checkpointing(parse_layers(args.checkpoint_enc, args.encoder_n_layer))
+    AdaVAE.transformer.set_checkpointing(parse_layers(args.checkpoint_dec, args.decoder_n_layer))
+    set_attn_backend(AdaVAE, args.attn_backend)
 
     ## freeze all prarameters excpect the ones in adapters
     # AdaVAE = freeze_all_parameters(AdaVAE)
@@ -455,29 +472,24 @@ def train(args):
         train_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "train.txt"))
         test_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "test.txt"))
         val_set = GDataset.from_file(os.path.join(prefix_path, args.dataset, "valid.txt"))
+    if args.token_cache is not None:
+        ## tokenized once, batches then only pad the memory-mapped token ids
+        train_set, test_set, val_set = [TokenizedDataset(d, tokenizer, args.max_length, args.token_cache)
+                                        for d in (train_set, test_set, val_set)]
+    ## batches are tokenized/padded in the workers, the training loop only moves tensors to the device
+    collate = Collator(tokenizer, args.max_length)
 
     train_loader = DataLoader(
         train_set,
-        batch_size=batch_schedule[cur_b_schedule][0],
+        **batching(train_set, batch_schedule[cur_b_schedule][0], args.length_buckets, args.max_tokens,
+                   shuffle=True, drop_last=True),
         pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers,
-        shuffle=True)
-    test_bs = 10 if args.weighted_sample else batch_schedule[-1][0]
-    test_loader = DataLoader(
-        test_set,
-        batch_size=test_bs,
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers,
-        shuffle=True)
-    val_loader = DataLoader(
-        val_set,
-        batch_size=test_bs,
-        pin_memory=True,
-        drop_last=True,
-        num_workers=args.workers,
-        shuffle=True)
+        **loader_workers(args.workers, args.prefetch_factor),
+        collate_fn=collate)
+    test_bs = batch_schedule[-1][0]
+    ## evaluation batches are built once, the same ones at every val_step
+    test_loader = EvalBatches(test_set, collate, test_bs, seed=args.seed)
+    val_loader = EvalBatches(val_set, collate, test_bs, seed=args.seed)
     logging.info('Done.')
 
     logging.info('Wrapping models and optimizers...')
@@ -516,6 +528,32 @@ def train(args):
         logging.info('Done.')
     loss_fn = nn.CrossEntropyLoss(ignore_index=endoftext, reduction='none')
 
+    ## until pre_enc_iter the encoder blocks are frozen: their outputs are computed once and read back from
+    ## the cache, only the latent heads and the decoder side run (without encoder dropout) in this phase
+    feature_loader = None
+    if args.encoder_cache is not None and pre_enc_iter > 0:
+        if args.latent_gen not in ['averaged_attn', 'latent_attn']:
+            raise ValueError("--encoder_cache needs a masked latent_gen (averaged_attn, latent_attn), "
+                             f"{args.latent_gen} pools the padded positions")
+        os.makedirs(args.encoder_cache, exist_ok=True)
+        key = encoder_cache_key(AdaVAE.encoder, token_cache_key(train_set, tokenizer, args.max_length))
+        features_path = os.path.join(args.encoder_cache, f'{key}.features')
+        offsets_path = os.path.join(args.encoder_cache, f'{key}.offsets')
+        if not (os.path.exists(features_path) and os.path.exists(offsets_path)):
+            logging.info('Caching encoder features...')
+            build_encoder_cache(AdaVAE.encoder,
+                                DataLoader(train_set, batch_size=batch_schedule[-1][0], collate_fn=collate,
+                                           **loader_workers(args.workers, args.prefetch_factor)),
+                                features_path, offsets_path, device)
+        feature_set = EncoderFeatureDataset(train_set, features_path, offsets_path, config.n_embd)
+        feature_loader = DataLoader(
+            feature_set,
+            **batching(feature_set, batch_schedule[cur_b_schedule][0], args.length_buckets, args.max_tokens,
+                       shuffle=True, drop_last=True),
+            pin_memory=True,
+            **loader_workers(args.workers, args.prefetch_factor),
+            collate_fn=collate)
+
     logging.info("Begin training iterations")
     max_val_batches = 200  # max num. of val batches
     logging.info("Total iteration: %d" % args.iterations)
@@ -529,8 +567,6 @@ def train(args):
 
         n_words_bpe = 0
         n_words = 0
-        n_examples = 0
-        cnt_au = 0
         logp_sum = 0.
         reg_loss_sum = 0.
         length_sum = 0.
@@ -543,8 +579,7 @@ def train(args):
             d_loss_sum = 0.
             g_loss_sum = 0.
 
-        mu_batch_list, logvar_batch_list = [], []
-        neg_entropy = 0.
+        latent_stats = LatentStatistics()
 
         logging.info("Validation loop.         Batches: %d" % len(val_loader))
         logging.info("Validation loop. max_val_batches: %d" % max_val_batches)
@@ -552,13 +587,14 @@ def train(args):
         with tqdm(total=min(len(val_loader), max_val_batches), desc="Evaluating Model") as pbar:
             for i, val_data_dict in enumerate(val_loader):
                 with torch.no_grad():
-                    val_x_ids, val_input_ids, val_attention_mask = tokenize(val_data_dict['x'], tokenizer, device, args)
+                    val_x_ids, val_input_ids, val_attention_mask = batch_tokens(val_data_dict, tokenizer, device, args)
                     if args.weighted_sample:
                         val_loss, val_ce_loss, val_reg_loss, val_mu, val_lv, \
                         val_loss_ppl, val_loss_rec = compute_loss(device, AdaVAE, val_x_ids,
                                                                        val_input_ids, val_attention_mask,
                                                                        loss_fn, 1.0, 0.0, args.reg_loss,
-                                                                  weighted_sample=True, fb=args.fb)
+                                                                  weighted_sample=True, fb=args.fb,
+                                                                  iw_max_tokens=args.iw_max_tokens)
                         val_loss_ppl, val_loss_rec = val_loss_ppl.sum(), val_loss_rec.mean()
                         reported_loss_ppl += val_loss_ppl.item()
                         reported_loss_rec += val_loss_rec.item()
@@ -571,14 +607,10 @@ def train(args):
                 """
                 calculate text perplexity
                 """
-                target_tokens = val_x_ids
-                if len(target_tokens.size()) == 1:
-                    target_tokens = target_tokens.unsqueeze(0)
-                n, l = target_tokens.size()
-
-                text = target_tokens.tolist()
-                tokens = [t[:t.index(endoftext) + 1] if endoftext in t else t for t in text]
-                words_bpe = sum([len(t) for t in tokens])
+                n = val_attention_mask.size(0)
+
+                ## target tokens up to <|endoftext|> are the ones of the attention mask
+                words_bpe = val_attention_mask.sum().item()
                 # length_sum += (l - 1) * n
                 n_words_bpe += words_bpe
                 logprob = val_ce_loss.mean()
@@ -587,15 +619,10 @@ def train(args):
                 logp_sum += logprob * words_bpe
 
                 ## add special token (batch size)
-                n_words_bpe += len(text)
+                n_words_bpe += n
 
-                ctext = [tokenizer.decode(target_tokens[i, :], clean_up_tokenization_spaces=True) for i in range(n)]
-                ctext = [s[s.find("<|endoftext|>") + len("<|endoftext|>"):] for s in ctext]
-                ctext = [s[:s.find("<|endoftext|>") + len("<|endoftext|>")] if "<|endoftext|>" in s else s for s in ctext]
-                words = sum([len(
-                    [t for t in re.split('("|\'|!|\?|\.|,|:| |\n|’|“|”|;|\(|\)|`)', s) if t != ' ' and t != '']) for
-                    s in ctext])
-                n_words += words
+                ## word counts precomputed with the dataset (see count_words in data.py)
+                n_words += val_data_dict['n_words'].sum().item()
 
                 if args.reg_loss == "adversarial":
                     d_loss, g_loss, kld = val_reg_loss[0].item(), val_reg_loss[1].item(), val_reg_loss[2]
@@ -606,23 +633,9 @@ def train(args):
                     reg_loss_sum += val_reg_loss.mean().item()
 
                 """
-                calculate mutual information (mi) Stage 1
-                """
-                n_examples += n
-                nz = val_mu.size(1)
-                # E_{q(z|x)}log(q(z|x)) = -0.5*nz*log(2*\pi) - 0.5*(1+logvar).sum(-1)
-                neg_entropy += (-0.5 * nz * math.log(2 * math.pi) - 0.5 * (1 + val_lv).sum(-1)).sum().item()
-                mu_batch_list += [val_mu.cpu()]
-                logvar_batch_list += [val_lv.cpu()]
-
-                """
-                compute the number of active units (au) Stage 1
+                posterior statistics of mutual information (mi) and active units (au)
                 """
-                if cnt_au == 0:
-                    means_sum = val_mu.sum(dim=0, keepdim=True)
-                else:
-                    means_sum = means_sum + val_mu.sum(dim=0, keepdim=True)
-                cnt_au += val_mu.size(0)
+                latent_stats.update(val_mu, val_lv)
 
 
                 if i > max_val_batches:
@@ -630,8 +643,6 @@ def train(args):
                 pbar.update(1)
 
         val_loader_len = min(len(val_loader), max_val_batches)
-        neg_entropy = neg_entropy / n_examples
-        mean_mean = means_sum / cnt_au
         loss_bpe = logp_sum / n_words_bpe # nll
         reg = reg_loss_sum / val_loader_len
         latent_bound = g_loss if args.reg_loss == "adversarial" else reg_loss_sum
@@ -651,77 +662,10 @@ def train(args):
             g_loss = g_loss_sum / val_loader_len
 
         """
-        calculate mi and au Stage 2
-        """
-        n_examples = 0
-        log_qz = 0.
-        for i in tqdm(range(len(mu_batch_list)), desc="Evaluating MI, Stage 2"):
-            ###############
-            # get z_samples
-            ###############
-            mu, logvar = mu_batch_list[i].cuda(), logvar_batch_list[i].cuda()
-
-            # [z_batch, 1, nz]
-            with torch.no_grad():
-                z_samples = AdaVAE.reparameterize(mu, logvar).unsqueeze(1)
-
-            z_samples = z_samples.view(-1, 1, nz)
-            n_examples += z_samples.size(0)
-
-            ###############
-            # compute density
-            ###############
-            # [1, x_batch, nz]
-            # mu, logvar = mu_batch_list[i].cuda(), logvar_batch_list[i].cuda()
-            # indices = list(np.random.choice(np.arange(len(mu_batch_list)), 10)) + [i]
-            indices = np.arange(len(mu_batch_list))
-            mu = torch.cat([mu_batch_list[_] for _ in indices], dim=0).cuda()
-            logvar = torch.cat([logvar_batch_list[_] for _ in indices], dim=0).cuda()
-            x_batch, nz = mu.size()
-
-            mu, logvar = mu.unsqueeze(0), logvar.unsqueeze(0)
-            var = logvar.exp()
-
-            # (z_batch, x_batch, nz)
-            dev = z_samples - mu
-
-            # (z_batch, x_batch)
-            log_density = -0.5 * ((dev ** 2) / var).sum(dim=-1) - \
-                          0.5 * (nz * math.log(2 * math.pi) + logvar.sum(-1))
-
-            # log q(z): aggregate posterior
-            # [z_batch]
-            log_qz += (log_sum_exp(log_density, dim=1) - math.log(x_batch)).sum(-1)
-
-
-        log_qz /= n_examples
-        mi = (neg_entropy - log_qz).item()
-
-        """
-        calculate au Stage 2
+        calculate mi and au from the statistics of the single pass
         """
-        cnt_au = 0
-        with tqdm(total=min(len(val_loader), max_val_batches), desc="Evaluating AU, Stage 2") as pbar:
-            for i, val_data_dict in enumerate(val_loader):
-                with torch.no_grad():
-                    val_x_ids, val_input_ids, val_attention_mask = tokenize(val_data_dict['x'], tokenizer, device, args)
-
-                    val_loss, val_ce_loss, _, val_mu, val_lv = compute_loss(device, AdaVAE, val_x_ids,
-                                                                            val_input_ids, val_attention_mask,
-                                                                            loss_fn, 1.0, 0.0, args.reg_loss, fb=args.fb)
-                if cnt_au == 0:
-                    var_sum = ((val_mu - mean_mean) ** 2).sum(dim=0)
-                else:
-                    var_sum = var_sum + ((val_mu - mean_mean) ** 2).sum(dim=0)
-                cnt_au += val_mu.size(0)
-
-                if i > max_val_batches:
-                    break
-                pbar.update(1)
-
-        # (nz)
-        au_var = var_sum / (cnt_au - 1)
-        n_au = (au_var >= args.au_delta).sum().item()
+        mi, mi_stderr = latent_stats.mutual_information(num_samples=args.mi_samples, device=device)
+        n_au = latent_stats.active_units(args.au_delta)
 
 
 
@@ -748,6 +692,8 @@ def train(args):
         logging.info('val ppl_word : %.4f' % ppl_word)
         logging.info('val reg_loss : %.4f' % reg)
         logging.info('val MI       : %.4f' % mi)
+        if mi_stderr is not None:
+            logging.info('val MI stderr: %.4f' % mi_stderr)
         logging.info('val AU       : %.4f' % n_au)
         bsz = 5
         sents, _ = sample_sequence(AdaVAE, args.max_length,
@@ -781,13 +727,14 @@ def train(args):
         st = time.time()
 
         # Training
-        print('Training loop. Batches:', len(train_loader))
+        epoch_loader = feature_loader if feature_loader is not None and not tuning_enc else train_loader
+        print('Training loop. Batches:', len(epoch_loader))
         logging.info('\n----------------------------------------------------------------------')
-        logging.info("Training loop.       Batches: %d" % len(train_loader))
+        logging.info("Training loop.       Batches: %d" % len(epoch_loader))
 
-        with tqdm(total=len(train_loader)) as pbar:
-            for i, data_dict in enumerate(train_loader):
-                x_ids, input_ids, attention_mask = tokenize(data_dict['x'], tokenizer, device, args)
+        with tqdm(total=len(epoch_loader)) as pbar:
+            for i, data_dict in enumerate(epoch_loader):
+                x_ids, input_ids, attention_mask = batch_tokens(data_dict, tokenizer, device, args)
 
                 # if (args.cycle != "const") and (num_iters % cycle_num >= cycle_num - args.beta_warmup):
                 #     beta = min(1.0, beta + (1. - args.beta_0) / args.beta_warmup)
@@ -833,8 +780,12 @@ def train(args):
                     kl_rate = args.kl_rate / args.latent_size
                 else:
                     kl_rate = args.kl_rate
+                encoder_hidden_states = None
+                if 'encoder_hidden_states' in data_dict and not tuning_enc:
+                    encoder_hidden_states = data_dict['encoder_hidden_states'].to(device, non_blocking=True)
                 loss, ce_loss, regul_loss = train_step(device, AdaVAE, optimizer, x_ids, input_ids, attention_mask,
-                                                       loss_fn, beta, kl_rate, args.reg_loss, False, args.fb)
+                                                       loss_fn, beta, kl_rate, args.reg_loss, False, args.fb,
+                                                       encoder_hidden_states=encoder_hidden_states)
                 if args.reg_loss == "adversarial":
                     d_loss, g_loss, kld = regul_loss[0].item(), regul_loss[1].item(), regul_loss[2].item()
                 else:
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: cache.py
+@feature: decoding caches shared by the generation entry points
+"""
+import torch
+
+
+class StaticKVCache(object):
+    """
+    preallocated key/value cache for incremental decoding.
+    every layer owns a (batch, n_head, max_length, head_dim) buffer which is written in place
+    at ``seq_length``, so a decode step never copies the positions that are already cached.
+    buffers are allocated lazily by the first write to take the dtype/device of the activations.
+    """
+    def __init__(self, n_layer, max_length):
+        self.n_layer = n_layer
+        self.max_length = max_length
+        self.seq_length = 0
+        self.key = [None] * n_layer
+        self.value = [None] * n_layer
+        self.layers = [KVCacheLayer(self, i) for i in range(n_layer)]
+
+    def update(self, layer_idx, key, value):
+        """
+        write the new positions of one layer and return views over all cached positions
+        :param key: (batch, n_head, head_dim, seq_len), GPT-2 keeps the keys transposed
+        :param value: (batch, n_head, seq_len, head_dim)
+        :return: key, value in the same layouts as the inputs
+        """
+        start = self.seq_length
+        end = start + value.size(-2)
+        if end > self.max_length:
+            raise ValueError(f"KV cache overflow: {end} positions for a cache of {self.max_length}")
+        if self.key[layer_idx] is None:
+            bsz, n_head, _, head_dim = value.size()
+            self.key[layer_idx] = value.new_empty(bsz, n_head, self.max_length, head_dim)
+            self.value[layer_idx] = value.new_empty(bsz, n_head, self.max_length, head_dim)
+        self.key[layer_idx][:, :, start:end] = key.transpose(-2, -1)
+        self.value[layer_idx][:, :, start:end] = value
+        return self.key[layer_idx][:, :, :end].transpose(-2, -1), self.value[layer_idx][:, :, :end]
+
+    def advance(self, n):
+        """move the cursor once every layer has written ``n`` new positions"""
+        self.seq_length += n
+
+    def index_select(self, index):
+        """keep the batch rows ``index`` (e.g. unfinished sequences), only the filled positions are copied"""
+        for i in range(self.n_layer):
+            if self.key[i] is None:
+                continue
+            key = self.key[i].new_empty(index.size(0), *self.key[i].size()[1:])
+            value = self.value[i].new_empty(index.size(0), *self.value[i].size()[1:])
+            key[:, :, :self.seq_length] = self.key[i][index, :, :self.seq_length]
+            value[:, :, :self.seq_length] = self.value[i][index, :, :self.seq_length]
+            self.key[i], self.value[i] = key, value
+        return self
+
+
+class KVCacheLayer(object):
+    """per-layer handle of a StaticKVCache, passed to the attention blocks as ``layer_past``"""
+    def __init__(self, cache, layer_idx):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key, value):
+        return self.cache.update(self.layer_idx, key, value)
+
+
+class LatentContext(object):
+    """
+    z-derived tensors of the decoder, built once per batch of latent codes (z is fixed while decoding)
+    and passed as ``representations`` so that no decoding step re-projects z.
+        input_proj: (batch, 1, n_embd) for add_input, else None
+        attn_proj: per-layer (batch, 1, n_embd) latent vectors for add_attn/add_mem, else None
+        layers: per-layer dicts of projected z keys/values ("key_z", "value_z", "mem_key", "mem_value")
+            and the adapter projection "z_proj"
+        logits_rep: (batch, vocab_size) softmax bias for add_softmax, else None
+    """
+    def __init__(self, representations, input_proj=None, attn_proj=None, layers=None, logits_rep=None):
+        self.representations = representations
+        self.input_proj = input_proj
+        self.attn_proj = attn_proj
+        self.layers = layers
+        self.logits_rep = logits_rep
+
+    def index_select(self, index):
+        """keep the batch rows ``index``, tensors shared between layers stay shared"""
+        selected = {}
+
+        def select(x):
+            if x is None:
+                return None
+            if id(x) not in selected:
+                selected[id(x)] = x.index_select(0, index)
+            return selected[id(x)]
+
+        attn_proj = None if self.attn_proj is None else [select(z) for z in self.attn_proj]
+        layers = None if self.layers is None else \
+            [{name: select(x) for name, x in state.items()} for state in self.layers]
+        return LatentContext(select(self.representations), select(self.input_proj), attn_proj, layers,
+                             select(self.logits_rep))
+
+    def index_copy_(self, index, other):
+        """write the rows of ``other`` (built for the new latent codes) into the batch rows ``index``"""
+        copied = set()
+
+        def copy(x, y):
+            if x is not None and id(x) not in copied:
+                copied.add(id(x))
+                x[index] = y
+
+        copy(self.representations, other.representations)
+        copy(self.input_proj, other.input_proj)
+        copy(self.logits_rep, other.logits_rep)
+        if self.attn_proj is not None:
+            for x, y in zip(self.attn_proj, other.attn_proj):
+                copy(x, y)
+        if self.layers is not None:
+            for state, other_state in zip(self.layers, other.layers):
+                for name, x in state.items():
+                    copy(x, other_state[name])
+        return self
+
+
+class SlotKVCache(StaticKVCache):
+    """
+    key/value cache of a fixed number of decoding slots for continuous batching.
+    every slot has its own cursor ``positions``: a finished slot is reset and refilled with a new sequence
+    while the other slots keep decoding. slots feed one position per step, the attention of every slot
+    is masked to its own filled positions (see attention_mask).
+    """
+    def __init__(self, n_layer, n_slots, max_length, device=None):
+        super(SlotKVCache, self).__init__(n_layer, max_length)
+        self.positions = torch.zeros(n_slots, dtype=torch.long, device=device)
+
+    def update(self, layer_idx, key, value):
+        """
+        write the new position of every slot at its own cursor and return the whole buffers
+        :param key: (n_slots, n_head, head_dim, 1)
+        :param value: (n_slots, n_head, 1, head_dim)
+        """
+        if value.size(-2) != 1:
+            raise ValueError(f"slot cache decodes one position per step, got {value.size(-2)}")
+        if self.key[layer_idx] is None:
+            bsz, n_head, _, head_dim = value.size()
+            ## zeros rather than empty: unwritten positions are masked but must stay finite
+            self.key[layer_idx] = value.new_zeros(bsz, n_head, self.max_length, head_dim)
+            self.value[layer_idx] = value.new_zeros(bsz, n_head, self.max_length, head_dim)
+        rows = torch.arange(value.size(0), device=value.device)
+        self.key[layer_idx][rows, :, self.positions] = key[..., 0]
+        self.value[layer_idx][rows, :, self.positions] = value[:, :, 0]
+        return self.key[layer_idx].transpose(-2, -1), self.value[layer_idx]
+
+    def advance(self, n):
+        self.positions += n
+
+    def reset(self, slots):
+        """start new sequences in ``slots``, their stale positions are masked until overwritten"""
+        self.positions[slots] = 0
+
+    def position_ids(self):
+        """(n_slots, 1) position of the token every slot feeds next"""
+        return self.positions.unsqueeze(1)
+
+    def attention_mask(self, dtype):
+        """additive (n_slots, 1, 1, max_length) mask over the cache, -10000.0 beyond the cursor of every slot"""
+        if bool((self.positions >= self.max_length).any()):
+            raise ValueError(f"KV cache overflow: a slot exceeds the cache of {self.max_length} positions")
+        ranks = torch.arange(self.max_length, device=self.positions.device)
+        allowed = (ranks.unsqueeze(0) <= self.positions.unsqueeze(1)).to(dtype)
+        return (1.0 - allowed)[:, None, None, :] * -10000.0
+
+    def index_select(self, index):
+        """keep the slots ``index``, e.g. once there is nothing left to refill them with"""
+        self.positions = self.positions[index]
+        for i in range(self.n_layer):
+            if self.key[i] is None:
+                continue
+            self.key[i] = self.key[i].index_select(0, index)
+            self.value[i] = self.value[i].index_select(0, index)
+        return self
@@ -301,6 +301,7 @@ class Prefix(nn.Module):
             nn.Linear(self.n_embd, self.mid_dim),
             nn.Tanh(),
             nn.Linear(self.mid_dim, self.match_n_layer * 2 * self.n_embd))
+        self._cache = None
 
         # self.wte_enc = nn.Embedding(self.attn_bn, self.n_embd)
         # self.control_trans_enc = nn.Sequential(
@@ -317,40 +318,41 @@ class Prefix(nn.Module):
         # if args.lisa_option == "cross_attn":
         #     self.apply(init_lisa_params)
 
-    def forward(self, bsz, nsamples=1, device="cuda"):
-        old_bsz = bsz
-        bsz = bsz * nsamples
-        input_tokens = self.input_tokens.unsqueeze(0).expand(bsz, -1).to(device)
-        temp_control = self.wte(input_tokens)
-        past_key_values = self.control_trans(temp_control) #bsz, seqlen, layer*emb
-        bsz, seqlen, _ = past_key_values.shape
-        past_key_values = past_key_values.view(bsz, seqlen, self.match_n_layer * 2, self.match_n_head,
+    def _states(self):
+        """prefix key/values at batch size 1, the MLP only sees the attn_bn prefix embeddings"""
+        # wte(arange(attn_bn)) is the whole embedding table
+        past_key_values = self.control_trans(self.wte.weight.unsqueeze(0)) #1, attn_bn, layer*emb
+        past_key_values = past_key_values.view(1, self.attn_bn, self.match_n_layer * 2, self.match_n_head,
                                                self.match_n_embd)
         past_key_values = self.dropout(past_key_values)
-        past_key_values = past_key_values.permute([2, 0, 3, 1, 4]).split(2)
+        past_key_values = past_key_values.permute([2, 0, 3, 1, 4]).split(2) #layer x (2, 1, nhead, attn_bn, head_dim)
+        return [(key_val[0], key_val[1]) for key_val in past_key_values]
 
-        # temp_control2 = self.wte2(input_tokens)
-        # past_key_values2 = self.control_trans2(temp_control2)  # bsz, seqlen, layer*emb
-        # past_key_values2 = past_key_values2.view(bsz, seqlen, self.match_n_layer * 2, self.match_n_head,
-        #                                          self.match_n_embd)
-        # past_key_values2 = self.dropout(past_key_values2)
-        # past_key_values2 = past_key_values2.permute([2, 0, 3, 1, 4]).split(2)
-        #
-        # input_tokens_enc = self.input_tokens.unsqueeze(0).expand(old_bsz, -1).to(device)
-        # temp_control_enc = self.wte_enc(input_tokens_enc)
-        # past_key_values_enc = self.control_trans_enc(temp_control_enc)  # bsz, seqlen, layer*emb
-        # bsz_enc, seqlen, _ = past_key_values_enc.shape
-        # past_key_values_enc = past_key_values_enc.view(bsz_enc, seqlen, self.match_n_layer * 2, self.match_n_head,
-        #                                                self.match_n_embd)
-        # past_key_values_enc = self.dropout(past_key_values_enc)
-        # past_key_values_enc = past_key_values_enc.permute([2, 0, 3, 1, 4]).split(2)
+    def forward(self, bsz, nsamples=1, device="cuda"):
+        """
+        prefix states do not depend on the inputs, so they are computed at batch size 1 and broadcast to
+        bsz * nsamples with expand (no copies). In eval without grad they are cached until the prefix
+        weights change: optimizer steps, checkpoint loading and device moves all bump the version/storage
+        of the parameters.
+        :return: per-layer dicts, prev_key/prev_value: (bsz, nhead, attn_bn, head_dim), prev_key_padding_mask: (bsz, attn_bn)
+        """
+        bsz = bsz * nsamples
+        if self.training or torch.is_grad_enabled():
+            states = self._states()
+        else:
+            version = tuple((p.data_ptr(), p._version) for p in self.parameters())
+            if self._cache is None or self._cache[0] != version:
+                self._cache = (version, self._states())
+            states = self._cache[1]
 
+        # one zeros mask shared by all the layers
+        prefix_mask = states[0][0].new_zeros(1, self.attn_bn).expand(bsz, -1) #bsz, attn_bn
         result = []
-        for i, key_val in enumerate(past_key_values):
-            temp_dict = {"prev_key": key_val[0].contiguous().view(bsz*self.match_n_head, -1, self.match_n_embd),
-                                  "prev_value": key_val[1].contiguous().view(bsz*self.match_n_head, -1, self.match_n_embd),
-                                  "prev_key_padding_mask": torch.zeros(bsz, seqlen).to(key_val.device) #bsz, attn_bn
-                                  }
+        for key, value in states:
+            temp_dict = {"prev_key": key.expand(bsz, -1, -1, -1),
+                         "prev_value": value.expand(bsz, -1, -1, -1),
+                         "prev_key_padding_mask": prefix_mask,
+                         }
             result.append(temp_dict)
         return result
 
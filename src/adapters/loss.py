@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: loss.py
+@feature: lm_head fused with the cross-entropy, streamed over vocabulary chunks
+"""
+import torch
+
+
+class LinearCrossEntropy(torch.autograd.Function):
+    """
+    per-token cross-entropy of ``hidden @ weight.T (+ bias)`` without the (n_tokens, vocab_size) logits:
+    the forward pass keeps a running log-sum-exp and the target logit chunk by chunk,
+    the backward pass recomputes the logits of every chunk from the saved inputs.
+    """
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, bias_index, target, ignore_index, chunk_size):
+        """
+        :param hidden: (n_tokens, n_embd)
+        :param weight: (vocab_size, n_embd), e.g. the tied lm_head weight
+        :param bias: (n_rows, vocab_size) logits bias of every sequence (add_softmax) or None
+        :param bias_index: (n_tokens,) row of ``bias`` every token belongs to
+        :param target: (n_tokens,)
+        :return: (n_tokens,) loss, 0 for ``ignore_index`` targets
+        """
+        n_tokens, vocab_size = hidden.size(0), weight.size(0)
+        running_max = hidden.new_full((n_tokens,), -float('Inf'), dtype=torch.float)
+        running_sum = hidden.new_zeros(n_tokens, dtype=torch.float)
+        target_logit = hidden.new_zeros(n_tokens, dtype=torch.float)
+        for start in range(0, vocab_size, chunk_size):
+            end = min(start + chunk_size, vocab_size)
+            logits = _chunk_logits(hidden, weight, bias, bias_index, start, end)  # (n_tokens, chunk)
+            chunk_max = logits.max(dim=-1)[0]
+            new_max = torch.max(running_max, chunk_max)
+            running_sum = running_sum * (running_max - new_max).exp() + \
+                          (logits - new_max.unsqueeze(-1)).exp().sum(dim=-1)
+            running_max = new_max
+            in_chunk = (target >= start) & (target < end)
+            rows = in_chunk.nonzero().view(-1)
+            target_logit[rows] = logits[rows, target[rows] - start]
+        lse = running_max + running_sum.log()
+        valid = target.ne(ignore_index)
+        loss = (lse - target_logit) * valid.float()
+
+        ctx.save_for_backward(hidden, weight, bias, bias_index, target, lse)
+        ctx.ignore_index, ctx.chunk_size = ignore_index, chunk_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        hidden, weight, bias, bias_index, target, lse = ctx.saved_tensors
+        ## d loss / d logits = softmax - one_hot(target), scaled by the incoming gradient
+        scale = grad_loss.float() * target.ne(ctx.ignore_index).float()
+        vocab_size = weight.size(0)
+        grad_hidden = torch.zeros_like(hidden, dtype=torch.float) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.empty_like(weight) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias) if bias is not None and ctx.needs_input_grad[2] else None
+        for start in range(0, vocab_size, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, vocab_size)
+            logits = _chunk_logits(hidden, weight, bias, bias_index, start, end)
+            grad_logits = (logits - lse.unsqueeze(-1)).exp()
+            rows = ((target >= start) & (target < end)).nonzero().view(-1)
+            grad_logits[rows, target[rows] - start] -= 1.
+            grad_logits = grad_logits * scale.unsqueeze(-1)
+            if grad_hidden is not None:
+                grad_hidden += grad_logits.matmul(weight[start:end].float())
+            if grad_weight is not None:
+                grad_weight[start:end] = grad_logits.t().matmul(hidden.float()).to(weight.dtype)
+            if grad_bias is not None:
+                grad_bias[:, start:end].index_add_(0, bias_index, grad_logits.to(bias.dtype))
+        if grad_hidden is not None:
+            grad_hidden = grad_hidden.to(hidden.dtype)
+        return grad_hidden, grad_weight, grad_bias, None, None, None, None
+
+
+def _chunk_logits(hidden, weight, bias, bias_index, start, end):
+    logits = hidden.matmul(weight[start:end].t()).float()
+    if bias is not None:
+        logits = logits + bias[:, start:end].index_select(0, bias_index).float()
+    return logits
+
+
+def linear_cross_entropy(hidden_states, weight, target, bias=None, bias_index=None, ignore_index=-100,
+                         reduction='mean', chunk_size=8192):
+    """
+    same as nn.CrossEntropyLoss(ignore_index, reduction)(F.linear(hidden_states, weight) + bias, target),
+    computed over vocabulary chunks of ``chunk_size`` so the logits are never materialized
+    :param hidden_states: (batch, seq_len, n_embd) or (n_tokens, n_embd)
+    :param target: (batch, seq_len) or (n_tokens,)
+    :param bias: (batch, vocab_size) logits bias shared along the sequence (add_softmax)
+    :param bias_index: (n_tokens,) row of ``bias`` of every token when hidden_states are gathered positions,
+        inferred for (batch, seq_len, n_embd) hidden states
+    :return: scalar for 'mean'/'sum', (n_tokens,) for 'none'
+    """
+    if bias is not None and bias_index is None:
+        bsz, seq_len = hidden_states.size()[:2]
+        bias_index = torch.arange(bsz, device=bias.device).repeat_interleave(seq_len)
+    hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+    target = target.reshape(-1)
+    loss = LinearCrossEntropy.apply(hidden_states, weight, bias, bias_index, target, ignore_index, chunk_size)
+    if reduction == 'none':
+        return loss
+    if reduction == 'sum':
+        return loss.sum()
+    return loss.sum() / target.ne(ignore_index).sum()
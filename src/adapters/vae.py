@@ -13,16 +13,88 @@ import torch
 import torch.nn as nn
 import math, sys
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_gpt2 import ACT2FN, Attention, GPT2Model, Block, MLP, GPT2LMHeadModel
 from transformers.modeling_utils import PreTrainedModel, Conv1D, prune_conv1d_layer, SequenceSummary
 sys.path.append('../')
 from .common import AdapterConfig, init_lisa_params, init_bert_weights, init_bias_mlp, init_zero_weights, \
     LoRALinear, Adapter_Layer, Prefix, GatedDense, NonLinear, log_Logistic_256, log_Normal_diag, log_Bernoulli
+from .loss import linear_cross_entropy
+from .cache import StaticKVCache, SlotKVCache, KVCacheLayer, LatentContext
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+def sdpa_attention(module, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
+    """
+    attention of the custom layers through F.scaled_dot_product_attention when ``module.attn_backend`` is "sdpa"
+    (torch >= 2.0): no score matrix is materialized by the fused kernels.
+    the additive mask carries the causal part, the z/prefix/memory columns and the padding (see
+    Decoder.extended_attention_mask), so the layers only hand it over.
+    :param k: (batch, n_head, head_dim, ns), GPT-2 keeps the keys transposed
+    :return: [attention output] as _attn, or None to use the reference path (attention weights or head mask asked)
+    """
+    if module.attn_backend != "sdpa" or head_mask is not None or output_attentions:
+        return None
+    if not module.scale:
+        ## the kernel always scales by 1/sqrt(head_dim)
+        q = q * math.sqrt(q.size(-1))
+    if attention_mask is not None:
+        attention_mask = attention_mask.to(q.dtype)
+    dropout_p = module.attn_dropout.p if module.training else 0.
+    return [F.scaled_dot_product_attention(q, k.transpose(-2, -1), v, attn_mask=attention_mask, dropout_p=dropout_p)]
+
+
+def set_attn_backend(model, backend):
+    """
+    attention backend of every custom attention layer of ``model``
+    :param backend: "eager" for the reference matmul/softmax path, "sdpa" for F.scaled_dot_product_attention
+    """
+    if backend not in ["eager", "sdpa"]:
+        raise ValueError(f"unknown attention backend {backend}")
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise ValueError("the sdpa attention backend needs torch >= 2.0")
+    for module in model.modules():
+        if isinstance(module, (Cond_Attention, MAM_Attention, Unmasked_Attention, MAM_Unmasked_Attention)):
+            module.attn_backend = backend
+    return model
+
+
+def checkpoint_block(block, hidden_states, **kwargs):
+    """
+    activation checkpointing of a block call for training forwards (no present nor attentions):
+    only the block input is kept, the block is recomputed during backward with the same dropout masks.
+    the tensors of the keyword arguments (z, attention mask, prefix/latent state dicts) are handed to the
+    checkpoint positionally so that the gradients reaching them (e.g. z, prefix states) flow back
+    :return: [hidden_states, None] as the block outputs x, present
+    """
+    slots, tensors = [], []
+    for name, value in kwargs.items():
+        if torch.is_tensor(value):
+            slots.append((name, None))
+            tensors.append(value)
+        elif isinstance(value, dict):
+            for key, v in value.items():
+                if torch.is_tensor(v):
+                    slots.append((name, key))
+                    tensors.append(v)
+
+    def run_block(hidden_states, *tensors):
+        call_kwargs = {name: dict(value) if isinstance(value, dict) else value for name, value in kwargs.items()}
+        for (name, key), tensor in zip(slots, tensors):
+            if key is None:
+                call_kwargs[name] = tensor
+            else:
+                call_kwargs[name][key] = tensor
+        return block(hidden_states, **call_kwargs)[0]
+
+    if not hidden_states.requires_grad:
+        ## inputs of frozen embeddings: without a grad input the checkpoint would drop the block parameter grads
+        hidden_states = hidden_states.detach().requires_grad_()
+    return [checkpoint(run_block, hidden_states, *tensors), None]
+
+
 ## attention averaged block to produce latent variable, essentially a self-attention process
 class AverageSelfAttention(nn.Module):
     def __init__(self, attention_size, AdapterConfig):
@@ -108,6 +180,8 @@ class LatentSelfAttention(nn.Module):
 
 ## PSA for additive z infusion
 class Cond_Attention(Attention):
+    attn_backend = "eager"  # see set_attn_backend
+
     def __init__(self, nx, n_ctx, config, AdapterConfig, scale=False):
         super(Attention, self).__init__()
         # self.output_attentions = config.output_attentions
@@ -116,7 +190,6 @@ class Cond_Attention(Attention):
         n_state = nx  # in Attention: n_state=768 (nx=n_embd)
         # [switch nx => n_state from Block to Attention to keep identical to TF implem]
         assert n_state % config.n_head == 0
-        self.register_buffer("bias", torch.tril(torch.ones(n_ctx, n_ctx)).view(1, 1, n_ctx, n_ctx))
         self.n_head = config.n_head
         self.split_size = n_state
         self.scale = scale
@@ -129,23 +202,41 @@ class Cond_Attention(Attention):
 
         # add code here
         self.c_z = Conv1D(n_state * 2, nx)
+        self.n_ctx = n_ctx
+        self._causal_mask = None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        ## checkpoints saved before the causal mask was built on the fly carry a copy per layer
+        state_dict.pop(prefix + 'bias', None)
+        super(Cond_Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def causal_mask(self, nd, ns, device, dtype):
+        """
+        additive (1, 1, nd, ns) causal mask of the last nd positions over the z column (first key, always
+        visible) and ns - 1 sequence keys, sliced from one (n_ctx, n_ctx) matrix per device
+        """
+        if self._causal_mask is None or self._causal_mask.device != device:
+            self._causal_mask = torch.tril(torch.ones(self.n_ctx, self.n_ctx, dtype=torch.bool, device=device))
+        causal = F.pad(self._causal_mask[ns - 1 - nd:ns - 1, :ns - 1], (1, 0), value=True)
+        return ((1.0 - causal.to(dtype)) * -10000.0).view(1, 1, nd, ns)
 
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
+        ## the causal term is always added: a (batch, 1, 1, ns - 1) padding mask gets the z column first,
+        ## an extended mask (see Decoder.extended_attention_mask) already covers it
+        causal_mask = self.causal_mask(q.size(-2), k.size(-1), q.device, q.dtype)
+        if attention_mask is not None and attention_mask.size(-1) == k.size(-1) - 1:
+            attention_mask = F.pad(attention_mask, (1, 0))
+        attention_mask = causal_mask if attention_mask is None else attention_mask + causal_mask
+        sdpa_outputs = sdpa_attention(self, q, k, v, attention_mask, head_mask, output_attentions)
+        if sdpa_outputs is not None:
+            return sdpa_outputs
         w = torch.matmul(q, k)
         if self.scale:
             w = w / math.sqrt(v.size(-1))
-        nd, ns = w.size(-2), w.size(-1)
-        b = self.bias[:, :, ns - nd : ns, :ns]
-        w = w * b - 1e4 * (1 - b)
 
-        if attention_mask is not None:
-            # add code here: w size has been bsz * n_heads * L * (L+1), mask bsz * 1 * 1 * L
-            assert attention_mask.size()[-1] == w.size()[-1] - 1
-            zeros = torch.zeros(attention_mask.size()[:-1], device=attention_mask.device, dtype=attention_mask.dtype).unsqueeze(-1)
-            attention_mask = torch.cat((zeros, attention_mask), dim=-1)
-
-            # Apply the attention mask
-            w = w + attention_mask
+        # causal mask plus the padding with the z column
+        assert attention_mask.size(-1) == w.size(-1)
+        w = w + attention_mask
 
         w = nn.Softmax(dim=-1)(w)
         w = self.attn_dropout(w)
@@ -176,7 +267,7 @@ class Cond_Attention(Attention):
             past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
             key = torch.cat((past_key, key), dim=-1)
             value = torch.cat((past_value, value), dim=-2)
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        present = torch.stack((key.transpose(-2, -1), value)) if use_cache else None  # transpose to have same shapes for stacking
 
         z_conv = self.c_z(z)
         key_z, value_z = z_conv.split(self.split_size, dim=2)
@@ -199,6 +290,8 @@ class MAM_Attention(Attention):
     """
     parallel adapter with prefix-tuning and LoRA component
     """
+    attn_backend = "eager"  # see set_attn_backend
+
     def __init__(self, nx, n_ctx, config, AdapterConfig, add_attn=True, add_mem=False, bias_bool=True, scale=False):
         super(Attention, self).__init__()
         # self.output_attentions = config.output_attentions
@@ -207,7 +300,6 @@ class MAM_Attention(Attention):
         n_state = nx  # in Attention: n_state=768 (nx=n_embd)
         # [switch nx => n_state from Block to Attention to keep identical to TF implem]
         assert n_state % config.n_head == 0
-        self.register_buffer("bias", torch.tril(torch.ones(n_ctx, n_ctx)).view(1, 1, n_ctx, n_ctx))
         self.n_head = config.n_head
         self.split_size = n_state
         self.scale = scale
@@ -247,21 +339,18 @@ class MAM_Attention(Attention):
             self.ef_attn_adapter = GPT2Adapter(AdapterConfig)
 
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
+        sdpa_outputs = sdpa_attention(self, q, k, v, attention_mask, head_mask, output_attentions)
+        if sdpa_outputs is not None:
+            return sdpa_outputs
         ## attention scores
         w = torch.matmul(q, k)
         if self.scale:
             w = w / math.sqrt(v.size(-1))
-        nd, ns = w.size(-2), w.size(-1)
-        b = self.bias[:, :, ns - nd : ns, :ns]
-        w = w * b - 1e4 * (1 - b)
 
         if attention_mask is not None:
-            # add code here: w size has been bsz * n_heads * L * (L+1), mask bsz * 1 * 1 * L
-            assert attention_mask.size()[-1] == w.size()[-1] - 1
-            zeros = torch.zeros(attention_mask.size()[:-1], device=attention_mask.device, dtype=attention_mask.dtype).unsqueeze(-1)
-            attention_mask = torch.cat((zeros, attention_mask), dim=-1)
-
-            # Apply the attention mask
+            # extended mask of the Decoder, (bsz or 1) * 1 * L * ns: causal, padding and the always attended
+            # z/prefix/memory columns, built once per forward for all the layers
+            assert attention_mask.size(-1) == w.size(-1)
             w = w + attention_mask
 
         w = nn.Softmax(dim=-1)(w)
@@ -276,6 +365,25 @@ class MAM_Attention(Attention):
             outputs.append(w)
         return outputs
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        ## checkpoints saved before the causal mask was shared by the Decoder carry a copy per layer
+        state_dict.pop(prefix + 'bias', None)
+        super(MAM_Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def latent_state(self, z):
+        """z keys/values of this layer, constant along the sequence so they can be built once per decode"""
+        state = {}
+        if self.add_attn:
+            ## PSA concat
+            key_z, value_z = self.c_z(z).split(self.split_size, dim=2)
+            state["key_z"] = self.split_heads(key_z, k=True)
+            state["value_z"] = self.split_heads(value_z)
+        if self.add_mem:
+            mem = self.latent2mem(z)
+            state["mem_key"] = self.split_heads(mem, k=True)
+            state["mem_value"] = self.split_heads(mem)
+        return state
+
     def forward(self, x, z,
                 layer_past=None,
                 attention_mask=None,
@@ -285,6 +393,7 @@ class MAM_Attention(Attention):
                 use_cache=False,
                 output_attentions=False,
                 prefix_state=None,
+                latent_state=None,
                 ):
         bsz = x.size(0)
         x = self.c_attn(x)
@@ -292,30 +401,37 @@ class MAM_Attention(Attention):
         query = self.split_heads(query)
         key = self.split_heads(key, k=True)
         value = self.split_heads(value)
-        if self.add_mem:
-            layer_past = [self.latent2mem(z),
-                    self.latent2mem(z)]  # query, key
+        if latent_state is None:
+            latent_state = self.latent_state(z)
+        kv_cache = layer_past if isinstance(layer_past, KVCacheLayer) else None
+        if self.add_mem and kv_cache is None:
+            layer_past = [latent_state["mem_key"].transpose(-2, -1), latent_state["mem_value"]]  # query, key
             # layer_past = [past] * self.decoder_n_layer
-            attention_mask = None
-        if layer_past is not None:
-            past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
-            if len(past_key.size()) != len(key.size()):
-                past_key = self.split_heads(past_key.transpose(-2, -1), k=True)
-            key = torch.cat((past_key, key), dim=-1)
-            if len(past_value.size()) != len(value.size()):
-                past_value = self.split_heads(past_value)
-            value = torch.cat((past_value, value), dim=-2)
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        if kv_cache is not None:
+            ## static cache: write the new positions in place, latent memory is kept out of the cache
+            key, value = kv_cache.update(key, value)
+            present = kv_cache
+            if self.add_mem:
+                key = torch.cat((latent_state["mem_key"], key), dim=-1)
+                value = torch.cat((latent_state["mem_value"], value), dim=-2)
+        else:
+            if layer_past is not None:
+                past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
+                if len(past_key.size()) != len(key.size()):
+                    past_key = self.split_heads(past_key.transpose(-2, -1), k=True)
+                key = torch.cat((past_key, key), dim=-1)
+                if len(past_value.size()) != len(value.size()):
+                    past_value = self.split_heads(past_value)
+                value = torch.cat((past_value, value), dim=-2)
+            ## only decoding consumes present, training forwards skip the stacked copy of key/value
+            present = torch.stack((key.transpose(-2, -1), value)) if use_cache else None  # transpose to have same shapes for stacking
         if prefix_state is not None and "prefix" in self.attn_mode:
             # legacy
-            prefix_key = prefix_state['prev_key']  # bsz x nhead, attn_bn, head_dim
+            prefix_key = prefix_state['prev_key']  # bsz, nhead, attn_bn, head_dim
             prefix_value = prefix_state['prev_value']
-            prefix_mask = prefix_state['prev_key_padding_mask']  # bsz, attn_bn: zeros
 
-            # (bsz, nhead, attn_bn, head_im)
             ## GPT2 key dim is different from BERT
-            prefix_key = prefix_key.view(bsz, self.config.n_head, *prefix_key.size()[-2:]).permute(0, 1, 3, 2)
-            prefix_value = prefix_value.view(bsz, self.config.n_head, *prefix_value.size()[-2:])
+            prefix_key = prefix_key.transpose(-2, -1)
 
             # import pdb; pdb.set_trace()
             # original lisa prefix-tuning
@@ -325,24 +441,14 @@ class MAM_Attention(Attention):
             # else:
             key = torch.cat([prefix_key, key], dim=3)
             value = torch.cat([prefix_value, value], dim=2)
-
-            # import pdb; pdb.set_trace()
-            if attention_mask is not None:
-                # import pdb; pdb.set_trace()
-                expanded_prefix_mask = prefix_mask[:, None, None, :].expand(bsz, 1, attention_mask.size(2),
-                                                                            prefix_mask.size(1)).to(attention_mask.dtype)
-                attention_mask = torch.cat([expanded_prefix_mask, attention_mask], dim=-1)
+            ## the prefix columns of the mask are part of the extended mask (see Decoder.forward)
         elif self.attn_mode == "adapter":
             pass
 
         if self.add_attn:
             ## PSA concat
-            z_conv = self.c_z(z)
-            key_z, value_z = z_conv.split(self.split_size, dim=2)
-            key_z = self.split_heads(key_z, k=True)
-            value_z = self.split_heads(value_z)
-            key = torch.cat((key_z, key), dim=-1)
-            value = torch.cat((value_z, value), dim=-2)
+            key = torch.cat((latent_state["key_z"], key), dim=-1)
+            value = torch.cat((latent_state["value_z"], value), dim=-2)
 
         attn_outputs = self._attn(query, key, value, attention_mask, head_mask, output_attentions)
         a = attn_outputs[0]
@@ -481,7 +587,12 @@ class Unmasked_Attention(Attention):
     """
     unmasked attention layer for encoder, re-define _atten function
     """
+    attn_backend = "eager"  # see set_attn_backend
+
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
+        sdpa_outputs = sdpa_attention(self, q, k, v, attention_mask, head_mask, output_attentions)
+        if sdpa_outputs is not None:
+            return sdpa_outputs
         w = torch.matmul(q, k)
         if self.scale:
             w = w / math.sqrt(v.size(-1))
@@ -506,6 +617,8 @@ class MAM_Unmasked_Attention(Attention):
     """
     parallel adapter with prefix-tuning and LoRA component
     """
+    attn_backend = "eager"  # see set_attn_backend
+
     def __init__(self, nx, n_ctx, config, AdapterConfig, scale=False):
         super(Attention, self).__init__()
         # self.output_attentions = config.output_attentions
@@ -514,7 +627,6 @@ class MAM_Unmasked_Attention(Attention):
         n_state = nx  # in Attention: n_state=768 (nx=n_embd)
         # [switch nx => n_state from Block to Attention to keep identical to TF implem]
         assert n_state % config.n_head == 0
-        self.register_buffer("bias", torch.tril(torch.ones(n_ctx, n_ctx)).view(1, 1, n_ctx, n_ctx))
         self.n_head = config.n_head
         self.split_size = n_state
         self.scale = scale
@@ -546,10 +658,18 @@ class MAM_Unmasked_Attention(Attention):
         elif self.attn_mode != 'none':
             raise ValueError("att_mode not supported")
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        ## checkpoints of the former per-layer causal mask, unused by the unmasked attention
+        state_dict.pop(prefix + 'bias', None)
+        super(MAM_Unmasked_Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _attn(self, q, k, v, attention_mask=None, head_mask=None, output_attentions=False):
         """
         unmasked attention layer for encoder, re-define _atten function
         """
+        sdpa_outputs = sdpa_attention(self, q, k, v, attention_mask, head_mask, output_attentions)
+        if sdpa_outputs is not None:
+            return sdpa_outputs
         w = torch.matmul(q, k)
         if self.scale:
             w = w / math.sqrt(v.size(-1))
@@ -590,17 +710,15 @@ class MAM_Unmasked_Attention(Attention):
             past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
             key = torch.cat((past_key, key), dim=-1)
             value = torch.cat((past_value, value), dim=-2)
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        present = torch.stack((key.transpose(-2, -1), value)) if use_cache else None  # transpose to have same shapes for stacking
 
         if prefix_state is not None and "prefix" in self.attn_mode:
             # legacy
-            prefix_key = prefix_state['prev_key']  # bsz x nhead, attn_bn, head_dim
+            prefix_key = prefix_state['prev_key']  # bsz, nhead, attn_bn, head_dim
             prefix_value = prefix_state['prev_value']
-            prefix_mask = prefix_state['prev_key_padding_mask']  # bsz, attn_bn: zeros
 
-            # (bsz, nhead, attn_bn, head_im)
-            prefix_key = prefix_key.view(bsz, self.config.n_head, *prefix_key.size()[-2:]).permute(0, 1, 3, 2)
-            prefix_value = prefix_value.view(bsz, self.config.n_head, *prefix_value.size()[-2:])
+            ## GPT2 key dim is different from BERT
+            prefix_key = prefix_key.transpose(-2, -1)
 
             # import pdb; pdb.set_trace()
             # original lisa prefix-tuning
@@ -610,13 +728,7 @@ class MAM_Unmasked_Attention(Attention):
             # else:
             key = torch.cat([prefix_key, key], dim=3)
             value = torch.cat([prefix_value, value], dim=2)
-
-            # import pdb; pdb.set_trace()
-            if attention_mask is not None:
-                # import pdb; pdb.set_trace()
-                expanded_prefix_mask = prefix_mask[:, None, None, :].expand(bsz, 1, attention_mask.size(2),
-                                                                            prefix_mask.size(1)).to(attention_mask.dtype)
-                attention_mask = torch.cat([expanded_prefix_mask, attention_mask], dim=-1)
+            ## the prefix columns of the mask are part of the extended mask (see Encoder.forward)
 
         attn_outputs = self._attn(query, key, value, attention_mask, head_mask, output_attentions)
         a = attn_outputs[0]
@@ -652,9 +764,13 @@ class Masked_Block(Block):
         self.ln_2 = nn.LayerNorm(nx, eps=config.layer_norm_epsilon)
         self.mlp = MLP(4 * nx, config)
 
-    def forward(self, x, z, layer_past=None, attention_mask=None, head_mask=None):
+    def latent_state(self, z):
+        return self.attn.latent_state(z)
+
+    def forward(self, x, z, layer_past=None, attention_mask=None, head_mask=None, latent_state=None, use_cache=False):
         output_attn = self.attn(
-            self.ln_1(x), z, layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask
+            self.ln_1(x), z, layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask,
+            latent_state=latent_state, use_cache=use_cache
         )
         a = output_attn[0]  # output_attn: a, present, (attentions)
 
@@ -772,6 +888,11 @@ class AdapterBlock(Block):
         self.Adaconfig = AdapterConfig
         self.adapter = GPT2Adapter(AdapterConfig) if not self.add_z2adapters else Latent_GPT2Adapter(AdapterConfig)
 
+    def latent_state(self, z):
+        state = self.attn.latent_state(z)
+        if self.add_z2adapters:
+            state["z_proj"] = self.z_proj(z)
+        return state
 
     def forward(self, x, z,
                 layer_past=None,
@@ -781,7 +902,8 @@ class AdapterBlock(Block):
                 encoder_attention_mask=None,
                 use_cache=False,
                 output_attentions=False,
-                prefix_state=None,):
+                prefix_state=None,
+                latent_state=None,):
         output_attn = self.attn(
             self.ln_1(x), z,
                 layer_past=layer_past,
@@ -790,9 +912,10 @@ class AdapterBlock(Block):
                 use_cache=use_cache,
                 output_attentions=output_attentions,
                 prefix_state=prefix_state,
+                latent_state=latent_state,
         )
         if self.add_z2adapters:
-            z_proj = self.z_proj(z)
+            z_proj = latent_state["z_proj"] if latent_state is not None else self.z_proj(z)
         else:
             z_proj = None
 
@@ -855,6 +978,7 @@ class Encoder(GPT2Model):
         self.output_attentions = False ## True is return hidden_states
         self.output_past = False
         self.latent_representations = False
+        self.checkpoint_layers = set()
 
         ## wte is word token embedding
         self.wte = nn.Embedding(config.vocab_size, config.n_embd)
@@ -896,6 +1020,16 @@ class Encoder(GPT2Model):
         if self.attn_mode == "prefix":
             self.prompt_model = Prefix(AdapterConfig, config)
 
+    def set_checkpointing(self, layers=None):
+        """
+        activation checkpointing of the blocks in ``layers`` (see checkpoint_block) for training forwards
+        :param layers: iterable of block indices, 'all', or None/empty to keep every activation
+        """
+        self.checkpoint_layers = set(range(len(self.h))) if layers == 'all' else set(layers or ())
+
+    def checkpointed(self, i):
+        return i in self.checkpoint_layers and self.training and torch.is_grad_enabled()
+
     def forward(
             self,
             input_ids=None,
@@ -905,9 +1039,17 @@ class Encoder(GPT2Model):
             position_ids=None,
             head_mask=None,
             inputs_embeds=None,
+            last_hidden_states=None,
     ):
+        """
+        :param last_hidden_states: (batch, seq_len, n_embd) cached output of ln_f for these inputs, the embeddings
+            and blocks are skipped and only the latent heads run (frozen encoder, see build_encoder_cache in utils.py)
+        :return: mean, logvar, last hidden states, (presents), (all hidden_states), (attentions).
+            the last hidden states stay in the outputs for backward compatibility (e.g. build_encoder_cache reads them),
+            presents only with output_past
+        """
         prefix_state = None
-        if self.attn_mode == "prefix":
+        if self.attn_mode == "prefix" and last_hidden_states is None:
             prefix_state = self.prompt_model(input_ids.size(0), device=input_ids.device)
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
@@ -970,46 +1112,58 @@ class Encoder(GPT2Model):
         else:
             head_mask = [None] * self.config.n_layer
 
-        if inputs_embeds is None:
-            inputs_embeds = self.wte(input_ids)
-        position_embeds = self.wpe(position_ids)
-        if token_type_ids is not None:
-            token_type_embeds = self.wte(token_type_ids)
-        else:
-            token_type_embeds = 0
-        ## hidden states of a block
-        hidden_states = inputs_embeds + position_embeds + token_type_embeds
-        hidden_states = self.drop(hidden_states)
-
-        output_shape = input_shape + (hidden_states.size(-1),)
+        ## extended mask of the blocks: the prefix keys prepended in every layer are always attended
+        block_attention_mask = attention_mask
+        if attention_mask is not None and prefix_state is not None and not self.tune_enc:
+            prefix_len = (prefix_state[0] if isinstance(prefix_state, list) else prefix_state)['prev_key'].size(2)
+            block_attention_mask = F.pad(attention_mask, (prefix_len, 0))
 
         presents = ()
         all_attentions = []
         all_hidden_states = ()
-        for i, (block, layer_past) in enumerate(zip(self.h, past)):
-            if self.output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_states.view(*output_shape),)
-
-            outputs = block(
-                hidden_states, layer_past=layer_past, attention_mask=attention_mask,
-                head_mask=head_mask[i]) if self.tune_enc else\
-                block(hidden_states, layer_past=layer_past, attention_mask=attention_mask,
-                head_mask=head_mask[i], prefix_state=prefix_state[i] if isinstance(prefix_state, list) else prefix_state)
+        if last_hidden_states is not None:
+            hidden_states = last_hidden_states.to(dtype=next(self.parameters()).dtype)
+        else:
+            if inputs_embeds is None:
+                inputs_embeds = self.wte(input_ids)
+            position_embeds = self.wpe(position_ids)
+            if token_type_ids is not None:
+                token_type_embeds = self.wte(token_type_ids)
+            else:
+                token_type_embeds = 0
+            ## hidden states of a block
+            hidden_states = inputs_embeds + position_embeds + token_type_embeds
+            hidden_states = self.drop(hidden_states)
+
+            output_shape = input_shape + (hidden_states.size(-1),)
+
+            for i, (block, layer_past) in enumerate(zip(self.h, past)):
+                if self.output_hidden_states:
+                    all_hidden_states = all_hidden_states + (hidden_states.view(*output_shape),)
+
+                block_kwargs = dict(layer_past=layer_past, attention_mask=block_attention_mask, head_mask=head_mask[i],
+                                    use_cache=self.output_past)
+                if not self.tune_enc:
+                    block_kwargs['prefix_state'] = prefix_state[i] if isinstance(prefix_state, list) else prefix_state
+                if self.checkpointed(i) and not self.output_past and not self.output_attentions:
+                    outputs = checkpoint_block(block, hidden_states, **block_kwargs)
+                else:
+                    outputs = block(hidden_states, **block_kwargs)
 
-            hidden_states, present = outputs[:2]
-            if self.output_past:
-                presents = presents + (present,)
+                hidden_states, present = outputs[:2]
+                if self.output_past:
+                    presents = presents + (present,)
 
-            if self.output_attentions:
-                all_attentions.append(outputs[2])
+                if self.output_attentions:
+                    all_attentions.append(outputs[2])
 
-        ## the last hidden states
-        hidden_states = self.ln_f(hidden_states)
+            ## the last hidden states
+            hidden_states = self.ln_f(hidden_states)
 
-        hidden_states = hidden_states.view(*output_shape)
-        # Add last hidden state
-        if self.output_hidden_states:
-            all_hidden_states = all_hidden_states + (hidden_states,)
+            hidden_states = hidden_states.view(*output_shape)
+            # Add last hidden state
+            if self.output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
 
         # added code here
         ## latent space parameterization
@@ -1073,6 +1227,9 @@ class Decoder(GPT2Model):
         self.output_attentions = False  ## True is return hidden_states
         self.output_past = True
         self.tune_dec = AdapterConfig.tune_dec
+        self.checkpoint_layers = set()
+        ## causal mask shared by all the layers (see causal_mask), not saved with the model
+        self._causal_mask = None
 
         self.wte = nn.Embedding(config.vocab_size, config.n_embd)
         self.wpe = nn.Embedding(config.n_positions, config.n_embd)
@@ -1110,6 +1267,80 @@ class Decoder(GPT2Model):
         if self.attn_mode == "prefix":
             self.prompt_model = Prefix(AdapterConfig, config)
 
+    def set_checkpointing(self, layers=None):
+        """
+        activation checkpointing of the blocks in ``layers`` (see checkpoint_block) for training forwards
+        :param layers: iterable of block indices, 'all', or None/empty to keep every activation
+        """
+        self.checkpoint_layers = set(range(len(self.h))) if layers == 'all' else set(layers or ())
+
+    def checkpointed(self, i):
+        return i in self.checkpoint_layers and self.training and torch.is_grad_enabled()
+
+    def causal_mask(self, nd, ns, device):
+        """(nd, ns) lower-triangular bool mask of the last nd positions over ns keys, one (n_ctx, n_ctx) matrix per device"""
+        if self._causal_mask is None or self._causal_mask.device != device:
+            n_ctx = self.config.n_ctx
+            self._causal_mask = torch.tril(torch.ones(n_ctx, n_ctx, dtype=torch.bool, device=device))
+        return self._causal_mask[ns - nd:ns, :ns]
+
+    def extended_attention_mask(self, attention_mask, query_length, key_length, n_latent_keys, dtype, device):
+        """
+        additive mask over the keys of MAM_Attention, built once per forward for all the layers
+        :param attention_mask: additive (batch, 1, 1, key_length) padding mask or None
+        :param n_latent_keys: z slot, prefix and latent memory keys, prepended to the sequence and always attended
+        :return: (batch or 1, 1, query_length, n_latent_keys + key_length)
+        """
+        causal = self.causal_mask(query_length, key_length, device)
+        extended = (1.0 - causal.to(dtype))[None, None] * -10000.0
+        if attention_mask is not None:
+            extended = extended + attention_mask
+        return F.pad(extended, (n_latent_keys, 0))
+
+    def init_kv_cache(self, max_length):
+        """
+        preallocate a static key/value cache to be passed as ``past`` for incremental decoding
+        :param max_length: number of positions the decoding loop will feed at most
+        :return: StaticKVCache, or None when the blocks (plain GPT-2 Block) only extend ``past`` by concatenation
+        """
+        if not (self.add_attn or self.add_mem):
+            return None
+        return StaticKVCache(len(self.h), max_length)
+
+    def init_slot_cache(self, n_slots, max_length, device=None):
+        """
+        key/value cache of ``n_slots`` independently reset decoding slots, passed as ``past`` for continuous batching
+        :return: SlotKVCache, or None when the blocks (plain GPT-2 Block) do not take a static cache
+        """
+        if not (self.add_attn or self.add_mem):
+            return None
+        return SlotKVCache(len(self.h), n_slots, max_length, device=device)
+
+    @staticmethod
+    def select_past(past, index):
+        """keep the batch rows ``index`` of a decoding state: StaticKVCache or tuple of stacked presents"""
+        if isinstance(past, StaticKVCache):
+            return past.index_select(index)
+        return tuple(layer_past.index_select(1, index) for layer_past in past)
+
+    def init_latent_context(self, representations):
+        """
+        project the latent codes once for a whole decode, the result is passed as ``representations``
+        :param representations: (batch, latent_size)
+        :return: LatentContext
+        """
+        input_proj, attn_proj, layers = None, None, None
+        if self.add_input:
+            input_proj = self.input_proj(representations).unsqueeze(1)
+        if self.add_attn or self.add_mem:
+            attn_proj = self.attn_proj(representations).unsqueeze(1)
+            if self.attn_proj_vary:
+                attn_proj = attn_proj.split(self.config.n_embd, dim=-1)
+            else:
+                attn_proj = [attn_proj] * len(self.h)
+            layers = [block.latent_state(z) for block, z in zip(self.h, attn_proj)]
+        return LatentContext(representations, input_proj, attn_proj, layers)
+
     def forward(
             self,
             input_ids=None,
@@ -1120,7 +1351,15 @@ class Decoder(GPT2Model):
             head_mask=None,
             inputs_embeds=None,
             representations=None,
+            use_cache=None,
     ):
+        """
+        :param use_cache: build and return the key/value ``presents``, by default only when decoding
+            (a ``past`` is given or the model is in eval mode): training forwards skip them
+        """
+        if use_cache is None:
+            use_cache = past is not None or not self.training
+        use_cache = use_cache and self.output_past
         prefix_state = None
         if self.attn_mode == "prefix":
             prefix_state = self.prompt_model(input_ids.size(0), device=input_ids.device)
@@ -1139,9 +1378,20 @@ class Decoder(GPT2Model):
         if position_ids is not None:
             position_ids = position_ids.view(-1, input_shape[-1])
 
+        kv_cache = past if isinstance(past, StaticKVCache) else None
+        slot_cache = past if isinstance(past, SlotKVCache) else None
         if past is None:
             past_length = 0
             past = [None] * len(self.h)
+        elif slot_cache is not None:
+            ## every slot sits at its own position, see SlotKVCache
+            past_length = None
+            past = slot_cache.layers
+            if position_ids is None:
+                position_ids = slot_cache.position_ids()
+        elif kv_cache is not None:
+            past_length = kv_cache.seq_length
+            past = kv_cache.layers
         else:
             # # different latent vectors for each layer
             # past_split = torch.split(past.unsqueeze(1), self.config.hidden_size, dim=2)
@@ -1173,6 +1423,23 @@ class Decoder(GPT2Model):
             # effectively the same as removing these entirely.
             attention_mask = attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
             attention_mask = (1.0 - attention_mask) * -10000.0
+        if slot_cache is not None:
+            ## slots only attend to the positions of their current sequence
+            attention_mask = slot_cache.attention_mask(next(self.parameters()).dtype)
+        if self.add_attn or self.add_mem:
+            if slot_cache is not None:
+                key_length = slot_cache.max_length
+            elif self.add_mem and kv_cache is None:
+                ## the latent memory takes the place of ``past``, and its keys are not masked for padding
+                key_length = input_shape[-1]
+                attention_mask = None
+            else:
+                key_length = past_length + input_shape[-1]
+            n_latent_keys = int(self.add_attn) + int(self.add_mem)
+            if prefix_state is not None and not self.tune_dec:
+                n_latent_keys += (prefix_state[0] if isinstance(prefix_state, list) else prefix_state)['prev_key'].size(2)
+            attention_mask = self.extended_attention_mask(attention_mask, input_shape[-1], key_length, n_latent_keys,
+                                                          next(self.parameters()).dtype, position_ids.device)
 
         # Prepare head mask if needed
         # 1.0 in head_mask indicate we keep the head
@@ -1203,10 +1470,14 @@ class Decoder(GPT2Model):
 
         # add code here
         ## method 1 in the paper: add to word embedding
+        latent_context = representations if isinstance(representations, LatentContext) else None
         if self.add_input:
             assert (representations is not None)
             # representations = torch.cat([representations, label_emb], dim=-1)
-            input_proj = self.input_proj(representations).unsqueeze(1)
+            if latent_context is not None:
+                input_proj = latent_context.input_proj
+            else:
+                input_proj = self.input_proj(representations).unsqueeze(1)
             hidden_states = hidden_states + input_proj
 
         hidden_states = self.drop(hidden_states)
@@ -1219,10 +1490,13 @@ class Decoder(GPT2Model):
             assert (representations is not None)
             ## add condition to latent representation via concatenation
             # representations = torch.cat([representations, label_emb], dim=-1)
-            attn_proj = self.attn_proj(representations).unsqueeze(1)
-            if self.attn_proj_vary:
-                attn_proj = attn_proj.split(hidden_states.size(-1), dim=-1)
-                assert len(attn_proj) == len(self.h)
+            if latent_context is not None:
+                attn_proj = latent_context.attn_proj
+            else:
+                attn_proj = self.attn_proj(representations).unsqueeze(1)
+                if self.attn_proj_vary:
+                    attn_proj = attn_proj.split(hidden_states.size(-1), dim=-1)
+                    assert len(attn_proj) == len(self.h)
 
         presents = ()
         all_attentions = []
@@ -1232,34 +1506,36 @@ class Decoder(GPT2Model):
                 all_hidden_states = all_hidden_states + (hidden_states.view(*output_shape),)
 
             if self.add_attn or self.add_mem:
-                if self.attn_proj_vary:
+                if self.attn_proj_vary or latent_context is not None:
                     z = attn_proj[i]
                 else:
                     z = attn_proj
+                latent_state = latent_context.layers[i] if latent_context is not None else None
                 ## add label embedding to decoder adapter
-                if self.tune_dec:
-                    outputs = block(
-                        hidden_states, z, layer_past=layer_past, attention_mask=attention_mask,
-                        head_mask=head_mask[i]
-                    )
-                else:
-                    outputs = block(
-                        hidden_states, z, layer_past=layer_past, attention_mask=attention_mask,
-                        head_mask=head_mask[i], prefix_state=prefix_state[i] if isinstance(prefix_state, list) else prefix_state
-                    )
-
+                block_kwargs = dict(z=z, layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask[i],
+                                    latent_state=latent_state, use_cache=use_cache)
+                if not self.tune_dec:
+                    block_kwargs['prefix_state'] = prefix_state[i] if isinstance(prefix_state, list) else prefix_state
+            else:
+                block_kwargs = dict(layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask[i],
+                                    use_cache=use_cache)
+            if self.checkpointed(i) and not use_cache and not self.output_attentions:
+                outputs = checkpoint_block(block, hidden_states, **block_kwargs)
             else:
-                outputs = block(
-                    hidden_states, layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask[i]
-                )
+                outputs = block(hidden_states, **block_kwargs)
 
             hidden_states, present = outputs[:2]
-            if self.output_past:
+            if use_cache:
                 presents = presents + (present,)
 
             if self.output_attentions:
                 all_attentions.append(outputs[2])
 
+        if kv_cache is not None:
+            ## every layer has written its positions, the cache itself is handed back as ``presents``
+            kv_cache.advance(input_shape[-1])
+            presents = kv_cache
+
         hidden_states = self.ln_f(hidden_states)
 
         hidden_states = hidden_states.view(*output_shape)
@@ -1268,7 +1544,7 @@ class Decoder(GPT2Model):
             all_hidden_states = all_hidden_states + (hidden_states,)
 
         outputs = (hidden_states,)
-        if self.output_past:
+        if use_cache:
             outputs = outputs + (presents,)
         if self.output_hidden_states:
             outputs = outputs + (all_hidden_states,)
@@ -1514,11 +1790,18 @@ class AdaVAEModel(GPT2LMHeadModel):
 
 
 
+    def init_latent_context(self, z):
+        """decoder-side projections of z plus the add_softmax logits bias, built once per decode"""
+        latent_context = self.transformer.init_latent_context(z)
+        if self.add_softmax:
+            latent_context.logits_rep = self.lm_head_rep(z)
+        return latent_context
+
     def reparameterize(self, mean, logvar, z=None, ns=0):
         std = logvar.mul(0.5).exp()
         if ns != 0:
             mean = mean.unsqueeze(1).expand(mean.size(0), ns, mean.size(-1))
-            std = logvar.unsqueeze(1).expand(mean.size(0), ns, mean.size(-1))
+            std = std.unsqueeze(1).expand(mean.size(0), ns, mean.size(-1))
         if z is None:
             z = torch.randn(std.size(), device=mean.device, dtype=mean.dtype)
         return z.mul(std) + mean
@@ -1588,8 +1871,24 @@ class AdaVAEModel(GPT2LMHeadModel):
 
         return log_density
 
-    def eval_cond_ll(self, x, mask, z):
+    def lm_logits(self, hidden_states, logits_rep=None):
+        """
+        lm_head plus the add_softmax bias
+        :param hidden_states: (batch, seq_len, n_embd), or (n_positions, n_embd) for gathered positions
+        :param logits_rep: (batch, vocab_size), or (n_positions, vocab_size) gathered along with hidden_states
+        """
+        lm_logits = self.lm_head(hidden_states)
+        if logits_rep is not None:
+            if logits_rep.dim() < lm_logits.dim():
+                logits_rep = logits_rep.unsqueeze(dim=1)
+            lm_logits = lm_logits + logits_rep
+        return lm_logits
+
+    def eval_cond_ll(self, x, mask, z, labels=None, ignore_index=-100):
         """compute log p(x|z)
+        :param labels: targets of x, (batch, nsamples, seq_len) when z holds nsamples codes per sentence.
+            if given, the per-token negative log-likelihood is returned in place of the logits,
+            lm_head and the cross-entropy run over vocabulary chunks
         """
         x_shape = list(x.size())
         z_shape = list(z.size())
@@ -1599,8 +1898,73 @@ class AdaVAEModel(GPT2LMHeadModel):
             if not mask is None:
                 mask = mask.unsqueeze(1).repeat(1, z_shape[1], 1).contiguous().view(x_shape[0] * z_shape[1], x_shape[-1])
         hidden_states = self.transformer(x, attention_mask=mask, representations=z)[0]
+        if labels is not None:
+            return linear_cross_entropy(hidden_states, self.lm_head.weight, labels, ignore_index=ignore_index,
+                                        reduction='none')
         return self.lm_head(hidden_states)
 
+    def iw_log_likelihood(self, x, mask, labels, mean, logvar, nsamples=100, ignore_index=-100, max_tokens=16384):
+        """
+        importance weighted estimate of log p(x) with ``nsamples`` codes from q(z|x) per sentence (Optimus PPL).
+        the (sentence, sample) pairs go through the decoder in chunks of at most ``max_tokens`` tokens,
+        sentences are expanded along the samples instead of repeated, only the target log-probs of the masked
+        positions are computed (see linear_cross_entropy) and the log-sum-exp over samples is kept running.
+        :param x: (batch, seq_len) decoder input ids
+        :param mask: (batch, seq_len) attention mask, the positions of ``labels`` counted in log p(x|z)
+        :param labels: (batch, seq_len) target ids
+        :param mean: (batch, nz) posterior mean
+        :param logvar: (batch, nz) posterior log variance
+        :return: log p(x) (batch,), E_q[log p(x|z)] (batch,)
+        """
+        bsz, seq_len = x.size()
+        mask = mask.type(torch.bool)
+        ## sentences and samples per decoder pass
+        rows = max(max_tokens // seq_len, 1)
+        if rows >= bsz:
+            b_chunk, s_chunk = bsz, min(rows // bsz, nsamples)
+        else:
+            b_chunk, s_chunk = rows, 1
+
+        log_prob_iw, log_gen_iw = [], []
+        for b_start in range(0, bsz, b_chunk):
+            x_b, mask_b, labels_b = x[b_start:b_start + b_chunk], mask[b_start:b_start + b_chunk], \
+                                    labels[b_start:b_start + b_chunk]
+            mean_b, logvar_b = mean[b_start:b_start + b_chunk], logvar[b_start:b_start + b_chunk]
+            b = x_b.size(0)
+            running_max = mean_b.new_full((b,), -float('Inf'), dtype=torch.float)
+            running_sum = mean_b.new_zeros(b, dtype=torch.float)
+            log_gen_sum = mean_b.new_zeros(b, dtype=torch.float)
+            for s_start in range(0, nsamples, s_chunk):
+                ns = min(s_chunk, nsamples - s_start)
+                # (b, ns, nz)
+                z = self.reparameterize(mean_b, logvar_b, ns=ns)
+                x_rep = x_b.unsqueeze(1).expand(b, ns, seq_len).reshape(b * ns, seq_len)
+                mask_rep = mask_b.unsqueeze(1).expand(b, ns, seq_len).reshape(b * ns, seq_len)
+                labels_rep = labels_b.unsqueeze(1).expand(b, ns, seq_len).reshape(b * ns, seq_len)
+                z_rep = z.reshape(b * ns, -1)
+                hidden_states = self.transformer(x_rep, attention_mask=mask_rep, representations=z_rep,
+                                                 use_cache=False)[0]
+                ## target positions only, row of every token for the add_softmax bias and the per-sample sums
+                row_index = mask_rep.nonzero()[:, 0]
+                logits_rep = self.lm_head_rep(z_rep) if self.add_softmax else None
+                nll = linear_cross_entropy(hidden_states[mask_rep], self.lm_head.weight, labels_rep[mask_rep],
+                                           bias=logits_rep, bias_index=row_index, ignore_index=ignore_index,
+                                           reduction='none')
+                # (b, ns)
+                log_gen = -mean_b.new_zeros(b * ns, dtype=torch.float).index_add_(0, row_index, nll.float()).view(b, ns)
+                log_prior = (-0.5 * math.log(2 * math.pi) - z.float() ** 2 / 2).sum(dim=-1)
+                log_infer = self.eval_inference_dist(z.float(), (mean_b.float(), logvar_b.float()))
+                log_weight = log_gen + log_prior - log_infer
+
+                new_max = torch.max(running_max, log_weight.max(dim=1)[0])
+                running_sum = running_sum * torch.exp(running_max - new_max) + \
+                              torch.exp(log_weight - new_max.unsqueeze(1)).sum(dim=1)
+                running_max = new_max
+                log_gen_sum += log_gen.sum(dim=1)
+            log_prob_iw.append(running_max + torch.log(running_sum) - math.log(nsamples))
+            log_gen_iw.append(log_gen_sum / nsamples)
+        return torch.cat(log_prob_iw, dim=0), torch.cat(log_gen_iw, dim=0)
+
 
     def forward(
         self,
@@ -1613,10 +1977,20 @@ class AdaVAEModel(GPT2LMHeadModel):
         inputs_embeds=None,
         from_prior=False,
         from_mean=False,
+        return_hidden=False,
+        encoder_hidden_states=None,
+        use_cache=None,
     ):
+        """
+        :param return_hidden: return (last hidden states, add_softmax logits bias or None) in place of lm_logits,
+            so that lm_head only runs on the positions the caller needs (see lm_logits)
+        :param encoder_hidden_states: cached last hidden states of the frozen encoder for input_ids
+        :param use_cache: return the decoder presents, see Decoder.forward
+        """
         # latent representation
         ## mean, logvar, last hidden state, (presents), (all hidden_states), (attentions)
-        posterior_mean, posterior_logvar = self.encoder(input_ids=input_ids, attention_mask=attention_mask)[:2]
+        posterior_mean, posterior_logvar = self.encoder(input_ids=input_ids, attention_mask=attention_mask,
+                                                        last_hidden_states=encoder_hidden_states)[:2]
 
         prior_mean = prior_logvar = torch.zeros([input_ids.size(0), self.AdapterConfig.latent_size], device=input_ids.device)
         prior_mean, prior_logvar = prior_mean.to(posterior_mean.dtype), prior_logvar.to(posterior_logvar.dtype)
@@ -1687,13 +2061,15 @@ class AdaVAEModel(GPT2LMHeadModel):
                                                position_ids=position_ids,
                                                head_mask=head_mask,
                                                inputs_embeds=inputs_embeds,
-                                               representations=z)
+                                               representations=z,
+                                               use_cache=use_cache)
         hidden_states = transformer_outputs[0]
-        lm_logits = self.lm_head(hidden_states)
-        if self.add_softmax:
-            lm_logits_rep = self.lm_head_rep(z)
-            lm_logits = lm_logits + lm_logits_rep.unsqueeze(dim=1)
-        outputs = (lm_logits,) + transformer_outputs[1:]
+        lm_logits_rep = self.lm_head_rep(z) if self.add_softmax else None
+        if return_hidden:
+            outputs = ((hidden_states, lm_logits_rep),) + transformer_outputs[1:]
+        else:
+            lm_logits = self.lm_logits(hidden_states, lm_logits_rep)
+            outputs = (lm_logits,) + transformer_outputs[1:]
 
         if self.reg_loss == "adversarial":
             regularization_loss = self.adv_loss(posterior_mean, posterior_logvar, prior_mean, prior_logvar)
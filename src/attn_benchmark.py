@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: attn_benchmark.py
+@feature: eager vs scaled_dot_product_attention backends: output agreement, step time and memory across lengths
+"""
+import argparse, time
+import torch
+from adapters.vae import set_attn_backend
+from memory_profile import build_model, step_memory
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--seq_lens', type=str, default="16,32,64,128,256")
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--latent_size', type=int, default=32)
+parser.add_argument('--encoder_n_layer', type=int, default=8)
+parser.add_argument('--decoder_n_layer', type=int, default=12)
+parser.add_argument('--adapter_size', type=int, default=128)
+parser.add_argument('--attn_mode', type=str, default="none", choices=['prefix', 'adapter', 'lora', 'none'])
+parser.add_argument('--add_mem', action="store_true")
+parser.add_argument('--atol', type=float, default=1e-4)
+parser.add_argument('--no_gpu', action="store_true")
+
+
+def step_time(model, input_ids, attention_mask, repeats, device):
+    """ mean wall time in seconds of a forward/backward training step """
+    elapsed = []
+    for _ in range(repeats):
+        model.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+        outputs[0].float().mean().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed.append(time.perf_counter() - start)
+    return sum(elapsed) / len(elapsed)
+
+
+def max_abs_diff(model, input_ids, attention_mask):
+    """ largest gap between the eager and sdpa logits in eval mode, with a fixed posterior sample """
+    model.eval()
+    outputs = {}
+    with torch.no_grad():
+        for backend in ("eager", "sdpa"):
+            set_attn_backend(model, backend)
+            torch.manual_seed(0)
+            outputs[backend] = model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    model.train()
+    return (outputs["eager"] - outputs["sdpa"]).abs().max().item()
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_gpu else 'cpu')
+    config, model = build_model(args, device)
+    ## dropout would make the two backends draw different masks
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0
+    model.train()
+    print(f"batch {args.batch_size}, {args.encoder_n_layer} encoder / {args.decoder_n_layer} decoder layers on {device.type}")
+    print(f"{'len':>5} | {'max |diff|':>10} | {'eager ms':>9} | {'sdpa ms':>9} | {'eager MiB':>10} | {'sdpa MiB':>10}")
+    for seq_len in [int(l) for l in args.seq_lens.split(',')]:
+        input_ids = torch.randint(config.vocab_size, (args.batch_size, seq_len), device=device)
+        attention_mask = torch.ones_like(input_ids)
+        ## pad the tail of half the batch so the padding mask is exercised as well
+        attention_mask[::2, seq_len // 2:] = 0
+
+        diff = max_abs_diff(model, input_ids, attention_mask)
+        results = {}
+        for backend in ("eager", "sdpa"):
+            set_attn_backend(model, backend)
+            step_time(model, input_ids, attention_mask, 1, device)  # warm-up
+            results[backend] = (step_time(model, input_ids, attention_mask, args.repeats, device),
+                                step_memory(model, input_ids, attention_mask, None, device))
+        flag = '' if diff <= args.atol else '  (above atol)'
+        print(f"{seq_len:>5} | {diff:>10.2e} | {results['eager'][0] * 1e3:>9.1f} | {results['sdpa'][0] * 1e3:>9.1f} | "
+              f"{results['eager'][1] / 2 ** 20:>10.1f} | {results['sdpa'][1] / 2 ** 20:>10.1f}{flag}")
+    print("memory is the peak above the resting allocations of one forward/backward step (see step_memory)")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
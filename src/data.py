@@ -1,9 +1,21 @@
 import pandas as pd
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 import random
 import os
+import re
 import torch
 import functools
+import hashlib
+import json
+import numpy as np
+
+## word tokens of the word-level perplexity, punctuation marks are words of their own
+WORD_SPLIT = re.compile('("|\'|!|\?|\.|,|:| |\n|’|“|”|;|\(|\)|`)')
+
+
+def count_words(text: str) -> int:
+    """ words of a sentence for ppl_word, plus one for the <|endoftext|> predicted after it """
+    return len([t for t in WORD_SPLIT.split(text.strip()) if t != ' ' and t != '']) + 1
 
 
 class DataFrameTextClassificationDataset(Dataset):
@@ -38,6 +50,7 @@ class ConditionalGenerationDataset(Dataset):
     def __init__(self, dl: list):
         self.x = []
         self.text_len = []
+        self.word_count = []
         self.y = []
         self.init_data(dl)
         self.length = len(self.x)
@@ -49,13 +62,14 @@ class ConditionalGenerationDataset(Dataset):
             self.y.append(inst[0])
             self.x.append(inst[1])
             self.text_len.append(len(inst[1].split()))
+            self.word_count.append(count_words(inst[1][:-1]))
 
     def __getitem__(self, index: int) -> dict:
         ## add BOS and EOS special token
         x = '<|endoftext|> ' + self.x[index][:-1] + ' <|endoftext|>'
         y = self.y[index]
 
-        return {'x': str(x), 'y': int(y)}
+        return {'x': str(x), 'y': int(y), 'n_words': self.word_count[index]}
 
     def __len__(self):
         return self.length
@@ -71,6 +85,7 @@ class GenerationDataset(Dataset):
     def __init__(self, dl: list):
         self.x = []
         self.text_len = []
+        self.word_count = []
         self.init_data(dl)
         self.length = len(self.x)
 
@@ -79,12 +94,13 @@ class GenerationDataset(Dataset):
             ## label
             self.x.append(inst)
             self.text_len.append(len(inst.split()))
+            self.word_count.append(count_words(inst))
 
     def __getitem__(self, index: int) -> dict:
         ## add BOS and EOS special token
         x = '<|endoftext|> ' + self.x[index] + ' <|endoftext|>'
 
-        return {'x': str(x)}
+        return {'x': str(x), 'n_words': self.word_count[index]}
 
     def __len__(self):
         return self.length
@@ -100,6 +116,7 @@ class GLUEPretrainingDataset(Dataset):
     def __init__(self, dl: list, dataset: str):
         self.x = []
         self.text_len = []
+        self.word_count = []
         self.init_data(dl, dataset)
         self.length = len(self.x)
 
@@ -109,15 +126,17 @@ class GLUEPretrainingDataset(Dataset):
             if dataset == "cola":
                 self.x.append(inst[3])
                 self.text_len.append(len(inst[3].split()))
+                self.word_count.append(count_words(inst[3]))
             elif dataset == "sst-2":
                 self.x.append(inst[0])
                 self.text_len.append(len(inst[0].split()))
+                self.word_count.append(count_words(inst[0]))
 
     def __getitem__(self, index: int) -> dict:
         ## add BOS and EOS special token
         x = '<|endoftext|> ' + self.x[index] + ' <|endoftext|>'
 
-        return {'x': str(x)}
+        return {'x': str(x), 'n_words': self.word_count[index]}
 
     def __len__(self):
         return self.length
@@ -183,13 +202,251 @@ class DictDataset(Dataset):
     def __len__(self):
         return self.length
 
-def collate_fn(samples: dict, eos_id: list, tokenizer):
-    """ Creates a batch out of samples for direct input"""
-    x_max_len = max(map(lambda s: len(s['x']), samples))
-    # Zero pad mask
-    x_mask = torch.ByteTensor([[1] * len(ss['x']) + [0] * (x_max_len - len(ss['x'])) for ss in samples])
-    # tokenizer.convert_tokens_to_ids('<|startoftext|>') = 50257, endoftext 50256, use 50257 here causes errors!!
-    x = torch.LongTensor([ss['x'] + eos_id * (x_max_len - len(ss['x'])) for ss in samples])
+def token_cache_key(dataset: Dataset, tokenizer, max_length: int) -> str:
+    """ identifies a tokenized corpus: its formatted texts, the tokenizer vocabulary with the special tokens
+    (e.g. the <BOS>/<EOS>/<PAD> of --from_optimus) and the truncation length """
+    texts = hashlib.md5()
+    for i in range(len(dataset)):
+        texts.update(dataset[i]['x'].encode('utf-8'))
+        texts.update(b'\n')
+    vocab = hashlib.md5(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8'))
+    key = json.dumps({'format': type(dataset).__name__,
+                      'texts': texts.hexdigest(),
+                      'vocab': vocab.hexdigest(),
+                      'special_tokens': tokenizer.special_tokens_map,
+                      'max_length': max_length}, sort_keys=True)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def build_token_cache(dataset: Dataset, tokenizer, max_length: int, ids_path: str, offsets_path: str,
+                      chunk_size: int = 10000):
+    """ tokenize every 'x' of the dataset once, as tokenize() in utils.py does, into a flat int32 token file
+    and an int64 offsets index (sentence i is ids[offsets[i]:offsets[i + 1]]) """
+    offsets = [0]
+    with open(ids_path + '.tmp', 'wb') as f:
+        for start in range(0, len(dataset), chunk_size):
+            texts = [dataset[i]['x'] for i in range(start, min(start + chunk_size, len(dataset)))]
+            for ids in tokenizer(texts, truncation=True, max_length=max_length)['input_ids']:
+                np.asarray(ids, dtype=np.int32).tofile(f)
+                offsets.append(offsets[-1] + len(ids))
+    np.asarray(offsets, dtype=np.int64).tofile(offsets_path + '.tmp')
+    ## only complete caches are visible to other runs
+    os.replace(ids_path + '.tmp', ids_path)
+    os.replace(offsets_path + '.tmp', offsets_path)
+
+class TokenizedDataset(Dataset):
+    """ pre-tokenized view of GenerationDataset, ConditionalGenerationDataset or GLUEPretrainingDataset:
+    the token ids are built once into cache_dir (see build_token_cache) and memory-mapped,
+    items are the ones of the wrapped dataset plus 'x_ids' (int32 array of the tokenized 'x'), see Collator """
+    def __init__(self, dataset: Dataset, tokenizer, max_length: int, cache_dir: str):
+        self.dataset = dataset
+        self.text_len = dataset.text_len
+        self.length = len(dataset)
+        os.makedirs(cache_dir, exist_ok=True)
+        key = token_cache_key(dataset, tokenizer, max_length)
+        self.ids_path = os.path.join(cache_dir, f'{key}.ids')
+        offsets_path = os.path.join(cache_dir, f'{key}.offsets')
+        if not (os.path.exists(self.ids_path) and os.path.exists(offsets_path)):
+            build_token_cache(dataset, tokenizer, max_length, self.ids_path, offsets_path)
+        self.offsets = np.fromfile(offsets_path, dtype=np.int64)
+        ## opened lazily so that every DataLoader worker maps the file itself
+        self._ids = None
+
+    @property
+    def ids(self) -> np.ndarray:
+        if self._ids is None:
+            self._ids = np.memmap(self.ids_path, dtype=np.int32, mode='r')
+        return self._ids
+
+    def __getitem__(self, index: int) -> dict:
+        data_dict = self.dataset[index]
+        data_dict['x_ids'] = np.array(self.ids[self.offsets[index]:self.offsets[index + 1]])
+        return data_dict
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ids'] = None
+        return state
+
+class EncoderFeatureDataset(Dataset):
+    """ wraps the training set with the cached last hidden states of the frozen encoder (see build_encoder_cache
+    in utils.py), memory-mapped: items get 'enc_hidden', a (n_input_positions, n_embd) float16 array """
+    def __init__(self, dataset: Dataset, features_path: str, offsets_path: str, n_embd: int):
+        self.dataset = dataset
+        self.text_len = dataset.text_len
+        self.length = len(dataset)
+        self.features_path = features_path
+        self.n_embd = n_embd
+        self.offsets = np.fromfile(offsets_path, dtype=np.int64)
+        assert len(self.offsets) == self.length + 1, "encoder feature cache does not match the dataset"
+        self._features = None
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            self._features = np.memmap(self.features_path, dtype=np.float16, mode='r').reshape(-1, self.n_embd)
+        return self._features
+
+    def __getitem__(self, index: int) -> dict:
+        data_dict = self.dataset[index]
+        data_dict['enc_hidden'] = np.array(self.features[self.offsets[index]:self.offsets[index + 1]])
+        return data_dict
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+class BucketBatchSampler(Sampler):
+    """ batches of sentences of similar length, to limit the padding of each batch.
+    every epoch the examples are shuffled and split into pools of ``bucket_batches`` batches, each pool is sorted
+    by length and cut into batches, and the order of the batches is shuffled.
+    with ``max_tokens`` the batch size varies so that batch size * longest length stays within max_tokens """
+    def __init__(self, lengths, batch_size: int, max_tokens: int = None, bucket_batches: int = 100,
+                 shuffle: bool = True, drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.batches = self.make_batches()
+
+    def make_batches(self) -> list:
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            if self.max_tokens is None:
+                batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+            else:
+                batch = []
+                for index in pool:
+                    ## the pool is sorted, the new example is the longest of the batch
+                    if batch and (len(batch) + 1) * self.lengths[index] > self.max_tokens:
+                        batches.append(np.asarray(batch))
+                        batch = []
+                    batch.append(index)
+                if batch:
+                    batches.append(np.asarray(batch))
+        if self.drop_last and self.max_tokens is None:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            random.shuffle(batches)
+        return [batch.tolist() for batch in batches]
+
+    def __iter__(self):
+        batches = self.batches
+        ## the next epoch is drawn now so that __len__ stays exact
+        self.batches = self.make_batches()
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def batching(dataset: Dataset, batch_size: int, length_buckets: bool = False, max_tokens: int = None,
+             shuffle: bool = True, drop_last: bool = False) -> dict:
+    """ DataLoader batching arguments: uniform batches, or a BucketBatchSampler over the dataset's text_len """
+    if not length_buckets:
+        return {'batch_size': batch_size, 'shuffle': shuffle, 'drop_last': drop_last}
+    return {'batch_sampler': BucketBatchSampler(dataset.text_len, batch_size, max_tokens=max_tokens,
+                                                shuffle=shuffle, drop_last=drop_last)}
+
+class EvalBatches(object):
+    """ validation/test set collated once and reused by every evaluation call: the examples are sorted by text_len
+    and cut into batches of ``batch_size`` (little padding), each batch is collated by ``collate`` a single time
+    and the batch order is shuffled with a fixed seed, so that evaluation loops capped at a number of batches see
+    sentences of all lengths. iterates like a DataLoader, over the same batches at every call """
+    def __init__(self, dataset: Dataset, collate, batch_size: int, seed: int = 0):
+        order = sorted(range(len(dataset)), key=lambda i: dataset.text_len[i])
+        self.batches = [collate([dataset[i] for i in order[start:start + batch_size]])
+                        for start in range(0, len(order), batch_size)]
+        random.Random(seed).shuffle(self.batches)
+        if torch.cuda.is_available():
+            ## page-locked once, the evaluation loops copy them with non_blocking=True
+            self.batches = [{k: v.pin_memory() if torch.is_tensor(v) else v for k, v in batch.items()}
+                            for batch in self.batches]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def pad_token_ids(token_ids: list, pad_id: int):
+    """ right-padded (batch, longest) ids and attention mask of id sequences """
+    max_len = max(len(ids) for ids in token_ids)
+    input_ids = torch.full((len(token_ids), max_len), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros(len(token_ids), max_len, dtype=torch.long)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+    return input_ids, attention_mask
+
+class Collator(object):
+    """ worker-side collation: tokenization (or padding of TokenizedDataset ids), shifting and masks are done
+    in the DataLoader workers, batches come out as tensors ready to be moved to the device.
+        language modeling datasets: 'x_ids' (target), 'input_ids', 'attention_mask' as tokenize() in utils.py,
+            plus 'y' labels for ConditionalGenerationDataset, 'encoder_hidden_states' for EncoderFeatureDataset,
+            the word counts 'n_words' (see count_words) and the texts 'x'
+        DialogGenerationDataset: 'inputs_src', 'inputs_tgt', 'labels_tgt', 'src_attention_mask',
+            'tgt_attention_mask' as tokenize() in dialogue/run_spacefusion_gen.py, plus the texts """
+    def __init__(self, tokenizer, max_length: int):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def __call__(self, samples: list) -> dict:
+        if 'response' in samples[0]:
+            return self.dialog_batch(samples)
+        if 'x_ids' in samples[0]:
+            input_ids, attention_mask = pad_token_ids([sample['x_ids'] for sample in samples],
+                                                      self.tokenizer.pad_token_id)
+        else:
+            x_tokenized = self.tokenizer([sample['x'] for sample in samples], padding=True, truncation=True,
+                                         return_tensors='pt', max_length=self.max_length)
+            input_ids, attention_mask = x_tokenized['input_ids'], x_tokenized['attention_mask']
+        batch = {'x': [sample['x'] for sample in samples],
+                 'x_ids': input_ids[:, 1:].contiguous(),
+                 'input_ids': input_ids[:, :-1],
+                 'attention_mask': attention_mask[:, 1:]}
+        if 'y' in samples[0]:
+            batch['y'] = torch.tensor([sample['y'] for sample in samples], dtype=torch.long)
+        if 'n_words' in samples[0]:
+            batch['n_words'] = torch.tensor([sample['n_words'] for sample in samples], dtype=torch.long)
+        if 'enc_hidden' in samples[0]:
+            ## padded positions are masked out by the latent attention
+            n_embd = samples[0]['enc_hidden'].shape[-1]
+            hidden_states = torch.zeros(len(samples), batch['input_ids'].size(1), n_embd, dtype=torch.half)
+            for i, sample in enumerate(samples):
+                hidden_states[i, :len(sample['enc_hidden'])] = torch.from_numpy(sample['enc_hidden'])
+            batch['encoder_hidden_states'] = hidden_states
+        return batch
+
+    def dialog_batch(self, samples: list) -> dict:
+        context = [sample['context'] for sample in samples]
+        response = [sample['response'] for sample in samples]
+        response_tokenized = self.tokenizer(response, padding=True, truncation=True, return_tensors='pt',
+                                            max_length=self.max_length)
+        context_tokenized = self.tokenizer(context, padding=True, truncation=True, return_tensors='pt')
+        return {'context': context,
+                'response': response,
+                'inputs_src': context_tokenized['input_ids'][:, :-1],
+                'src_attention_mask': context_tokenized['attention_mask'][:, :-1],
+                'labels_tgt': response_tokenized['input_ids'][:, 1:],
+                'inputs_tgt': response_tokenized['input_ids'][:, :-1],
+                'tgt_attention_mask': response_tokenized['attention_mask'][:, 1:]}
+
+def loader_workers(num_workers: int, prefetch_factor: int = 2) -> dict:
+    """ DataLoader worker arguments: workers persist across epochs and prepare batches ahead of the model """
+    if num_workers <= 0:
+        return {'num_workers': 0}
+    return {'num_workers': num_workers, 'persistent_workers': True, 'prefetch_factor': prefetch_factor}
 
 
 def prepare_dataset(data_dir, dataset_name, tokenizer, train_bsz, train_seq_len, val_bsz, val_seq_len, test_bsz=1,
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: memory_profile.py
+@feature: activation memory of one AdaVAE training step, with and without the decoder presents
+"""
+import argparse
+import torch
+from transformers import GPT2Config
+from adapters.vae import AdaVAEModel
+from adapters.common import AdapterConfig
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--seq_len', type=int, default=32)
+parser.add_argument('--latent_size', type=int, default=32)
+parser.add_argument('--encoder_n_layer', type=int, default=8)
+parser.add_argument('--decoder_n_layer', type=int, default=12)
+parser.add_argument('--adapter_size', type=int, default=128)
+parser.add_argument('--attn_mode', type=str, default="none", choices=['prefix', 'adapter', 'lora', 'none'])
+parser.add_argument('--add_mem', action="store_true")
+parser.add_argument('--no_gpu', action="store_true")
+
+
+def step_memory(model, input_ids, attention_mask, use_cache, device):
+    """
+    peak memory in bytes allocated during a forward/backward training step, above what was allocated before it.
+    on cpu the peak is the maximum of the running total of the self allocations/frees of the profiled ops
+    """
+    model.zero_grad()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=use_cache)
+        outputs[0].float().mean().backward()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        outputs = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=use_cache)
+        outputs[0].float().mean().backward()
+    ## self_cpu_memory_usage is exclusive of the child ops and negative on frees
+    current, peak = 0, 0
+    for event in sorted(prof.function_events, key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def build_model(args, device):
+    """ randomly initialised AdaVAE sized like the training script's defaults """
+    config = GPT2Config()
+    ada_config = AdapterConfig(hidden_size=768, adapter_size=args.adapter_size, adapter_act='relu',
+                               adapter_initializer_range=1e-2, latent_size=args.latent_size, class_num=2,
+                               encoder_n_layer=args.encoder_n_layer, decoder_n_layer=args.decoder_n_layer,
+                               dis_emb=128, init='bert', adapter_scalar='1.0', ffn_option='parallel_ffn',
+                               attn_mode=args.attn_mode, latent_gen='averaged_attn', attn_option='none',
+                               mid_dim=30, attn_bn=25, prefix_dropout=0.1, tune_enc=False, tune_dec=False,
+                               add_z2adapters=False)
+    model = AdaVAEModel(config, ada_config, add_input=False, add_attn=True, add_softmax=False,
+                        add_mem=args.add_mem).to(device)
+    return config, model
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_gpu else 'cpu')
+    config, model = build_model(args, device)
+    model.train()
+    input_ids = torch.randint(config.vocab_size, (args.batch_size, args.seq_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+
+    ## warm-up step so that both measures see the same allocator state
+    step_memory(model, input_ids, attention_mask, True, device)
+    with_presents = step_memory(model, input_ids, attention_mask, True, device)
+    without_presents = step_memory(model, input_ids, attention_mask, None, device)
+    print(f"batch {args.batch_size} x {args.seq_len}, {args.encoder_n_layer} encoder / "
+          f"{args.decoder_n_layer} decoder layers on {device.type}")
+    print(f"with presents    : {with_presents / 2 ** 20:.1f} MiB peak")
+    print(f"without presents : {without_presents / 2 ** 20:.1f} MiB peak")
+    print(f"saved            : {(with_presents - without_presents) / 2 ** 20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: metrics.py
+@feature: latent space statistics of the evaluation loops (active units, mutual information)
+"""
+import math
+import torch
+
+
+def log_gaussian_density(z, mu, logvar):
+    """
+    log N(z_i; mu_j, diag(exp(logvar_j))) of every (z_i, x_j) pair without the (n_z, n_x, nz) deviation tensor:
+    sum_d (z_d - mu_d)^2 / var_d = z^2 @ (1/var)^T - 2 z @ (mu/var)^T + sum_d mu_d^2 / var_d
+    :param z: (n_z, nz)
+    :param mu: (n_x, nz)
+    :param logvar: (n_x, nz)
+    :return: (n_z, n_x)
+    """
+    nz = z.size(-1)
+    inv_var = torch.exp(-logvar)
+    quad = torch.mm(z ** 2, inv_var.t()) - 2 * torch.mm(z, (mu * inv_var).t()) + (mu ** 2 * inv_var).sum(-1)
+    return -0.5 * quad - 0.5 * (nz * math.log(2 * math.pi) + logvar.sum(-1))
+
+
+def log_aggregate_posterior(z, mu, logvar, chunk_size=4096, device=None):
+    """
+    log q(z) = log 1/N sum_j q(z|x_j) of the aggregate posterior, streamed over chunks of posteriors with a
+    running log-sum-exp so that at most a (chunk_size, chunk_size) density block is alive.
+    :param z: (n_z, nz)
+    :param mu: (n_x, nz) posterior means, e.g. kept on cpu during the evaluation loop
+    :param logvar: (n_x, nz)
+    :param device: device of the density blocks, defaults to the one of ``z``
+    :return: (n_z,) on ``device``
+    """
+    device = z.device if device is None else device
+    n_x = mu.size(0)
+    log_qz = []
+    for z_start in range(0, z.size(0), chunk_size):
+        z_chunk = z[z_start:z_start + chunk_size].to(device, torch.float)
+        running_max = z_chunk.new_full((z_chunk.size(0),), -float('Inf'))
+        running_sum = z_chunk.new_zeros(z_chunk.size(0))
+        for x_start in range(0, n_x, chunk_size):
+            mu_chunk = mu[x_start:x_start + chunk_size].to(device, torch.float)
+            logvar_chunk = logvar[x_start:x_start + chunk_size].to(device, torch.float)
+            log_density = log_gaussian_density(z_chunk, mu_chunk, logvar_chunk)
+            new_max = torch.max(running_max, log_density.max(dim=1)[0])
+            running_sum = running_sum * torch.exp(running_max - new_max) + \
+                          torch.exp(log_density - new_max.unsqueeze(1)).sum(dim=1)
+            running_max = new_max
+        log_qz.append(running_max + torch.log(running_sum) - math.log(n_x))
+    return torch.cat(log_qz, dim=0)
+
+
+def mutual_information(mu, logvar, chunk_size=4096, num_samples=None, device=None, generator=None):
+    """
+    I(x; z) = E_x E_{q(z|x)}[log q(z|x)] - E_{q(z)}[log q(z)] with one z sample per posterior,
+    E_{q(z|x)}log(q(z|x)) = -0.5*nz*log(2*\pi) - 0.5*(1+logvar).sum(-1) in closed form.
+    :param mu: (n_x, nz) posterior means of the whole evaluation set
+    :param logvar: (n_x, nz)
+    :param num_samples: draw z from this many random posteriors only (q(z) still uses all of them)
+        and report the standard error of the estimate; None uses every posterior
+    :param generator: torch.Generator of the posterior subset and of the z samples
+    :return: (mi, stderr), stderr is None when every posterior is used
+    """
+    device = mu.device if device is None else device
+    n_x, nz = mu.size()
+    if num_samples is not None and num_samples < n_x:
+        indices = torch.randperm(n_x, generator=generator)[:num_samples]
+        sample_mu, sample_logvar = mu[indices], logvar[indices]
+    else:
+        num_samples = None
+        sample_mu, sample_logvar = mu, logvar
+    sample_mu = sample_mu.to(device, torch.float)
+    sample_logvar = sample_logvar.to(device, torch.float)
+    eps = torch.randn(sample_mu.size(), generator=generator).to(device)
+    z = sample_mu + eps * sample_logvar.mul(0.5).exp()
+
+    neg_entropy = -0.5 * nz * math.log(2 * math.pi) - 0.5 * (1 + sample_logvar).sum(-1)
+    log_qz = log_aggregate_posterior(z, mu, logvar, chunk_size=chunk_size, device=device)
+    mi_terms = neg_entropy - log_qz
+    mi = mi_terms.mean().item()
+    if num_samples is None:
+        return mi, None
+    return mi, (mi_terms.std() / math.sqrt(num_samples)).item()
+
+
+class LatentStatistics(object):
+    """
+    posterior statistics gathered in the single forward pass of an evaluation loop:
+    Welford mean/variance of the posterior means for the active units, and the (mu, logvar) of every
+    example (on cpu) for the mutual information.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.mu_list, self.logvar_list = [], []
+
+    def update(self, mu, logvar):
+        """
+        :param mu: (batch, nz) posterior means of a batch
+        :param logvar: (batch, nz)
+        """
+        mu = mu.detach().float()
+        n = mu.size(0)
+        batch_mean = mu.mean(dim=0)
+        batch_m2 = ((mu - batch_mean) ** 2).sum(dim=0)
+        if self.count == 0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            ## merge of two partial (count, mean, m2) statistics
+            total = self.count + n
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * n / total
+            self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * n / total
+        self.count += n
+        self.mu_list.append(mu.cpu())
+        self.logvar_list.append(logvar.detach().float().cpu())
+
+    def active_units(self, delta=0.01):
+        """ number of latent dimensions whose posterior mean varies by at least ``delta`` across examples """
+        au_var = self.m2 / (self.count - 1)
+        return (au_var >= delta).sum().item()
+
+    def mutual_information(self, **kwargs):
+        """ see mutual_information, over every example seen so far """
+        return mutual_information(torch.cat(self.mu_list, dim=0), torch.cat(self.logvar_list, dim=0), **kwargs)
@@ -14,9 +14,11 @@ import torch.nn.functional as F
 from adapters.vae import *
 from adaVAE import compute_loss
 from utils import *
-from collections import defaultdict
+from metrics import LatentStatistics
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from adapters.common import AdapterConfig
-from data import ConditionalGenerationDataset, GenerationDataset
+from data import ConditionalGenerationDataset, GenerationDataset, Collator, batching, loader_workers
 import datetime
 
 from torch.utils.data import Dataset, DataLoader
@@ -71,16 +73,31 @@ parser.add_argument('--experiment', type=str, help="ckpt dirctory", default='out
 parser.add_argument('--adapter_init', type=str, default='bert', choices=['lora', 'bert', 'lisa', 'other'],
                     help="parameter initialization method for adapter layers.")
 parser.add_argument('--workers', default=2, type=int, metavar='N',  help='number of data loading workers')
+parser.add_argument('--prefetch_factor', default=2, type=int, help='batches prepared ahead by every data loading worker')
+parser.add_argument('--attn_backend', type=str, default="eager", choices=['eager', 'sdpa'],
+                    help="attention kernel: eager matmul/softmax or torch scaled_dot_product_attention")
 parser.add_argument("--total_sents", default=10, type=int, help="Total sentences to test recontruction/generation.")
 parser.add_argument("--max_test_batch", default=10, type=int, help="Total sentence pairs to test interpolation/analogy.")
 parser.add_argument("--num_interpolation_step", default=10, type=int)
 parser.add_argument("--degree_to_target", type=float, default=1.0)
 parser.add_argument("--max_val_batches", type=int, help="Max batch size number to test recontruction.", default=30)
 parser.add_argument("--latest_date", type=str, help="Latest date for model testing.", default="")
+parser.add_argument('--vocab_shortlist', action="store_true",
+                    help="generate only with the token types of the training set")
+parser.add_argument('--shortlist_min_count', type=int, default=1,
+                    help="minimum training frequency of a token type to enter the shortlist")
+parser.add_argument('--decode_slots', type=int, default=0,
+                    help="number of sentences decoded at once by generation, 0 for 1000")
+parser.add_argument('--detok_workers', type=int, default=4,
+                    help="threads detokenizing generated sentences")
+parser.add_argument('--length_buckets', action="store_true",
+                    help="batch sentences of similar length together")
 
 ## metrics
 parser.add_argument('--au_delta', type=float, default=0.01,
                     help="threshold for activated unit calculation.")
+parser.add_argument('--mi_samples', type=int, default=None,
+                    help="posteriors sampled for the mutual information estimate (reported with its standard error), all if not set")
 
 # use GPU
 parser.add_argument('--gpu', default=0, type=int)
@@ -106,6 +123,8 @@ parser.add_argument('--attn_proj_vary', action="store_true")
 parser.add_argument('--finetune_enc', action="store_true")
 parser.add_argument('--finetune_dec', action="store_true")
 parser.add_argument('--weighted_sample', action="store_true")
+parser.add_argument('--iw_max_tokens', type=int, default=16384,
+                    help="tokens per decoder pass of the importance weighted NLL, sentences and samples are chunked to fit")
 parser.add_argument('--add_z2adapters', action="store_true")
 parser.add_argument('--learn_prior', action="store_true")
 parser.add_argument('--test_model', action="store_true")
@@ -113,37 +132,26 @@ parser.add_argument('--do_sample', action="store_true", help="sample for reconst
 
 cache_dir = '/home/tuhq/.cache/torch/transformers'
 
-def generate(args, model, save_dir, bsz, tokenizer, device, parallel=False, topk=100, top_p=0.95):
+def generate(args, model, save_dir, bsz, tokenizer, device, parallel=False, topk=100, top_p=0.95, shortlist=None):
     endoftext = tokenizer.convert_tokens_to_ids(tokenizer.eos_token)
-    if parallel or bsz <= 1000:
-        sents, _ = sample_sequence(model, args.max_length,
-                                   batch_size=bsz, top_k=topk, top_p=top_p,
-                                   device=device, sample=True, eos_token=endoftext)
-        sents = sents.tolist()
+    if parallel:
+        n_slots = bsz
     else:
-        sents = []
-        assert bsz % 1000 == 0, "total sentence should be divided by 1000"
-        partition = int(bsz/1000)
-        for i in range(partition):
-            sents_, _ = sample_sequence(model, args.max_length,
-                                       batch_size=1000, top_k=topk, top_p=top_p,
-                                       device=device, sample=True, eos_token=endoftext)
-            sents.extend(sents_.tolist())
-    # Sample sentences
-    sentences_list = []
-    for i in range(len(sents)):
-        sent = sents[i]
-        sent = sent[sent.index(endoftext) + 1:]
-
-        if endoftext in sent:
-            idx = sent.index(endoftext)
-            sent = sent[:idx]
-
-        sent = tokenizer.decode(sent).strip()
-        sentences_list.append(sent)
-    with open(f"{save_dir}/{bsz}.txt", 'w') as f:
-        for sentence in sentences_list:
-            f.write(sentence + '\n')
+        n_slots = args.decode_slots if args.decode_slots > 0 else 1000
+    stats = {}
+    stream = stream_sample(model, args.max_length, n_slots, batch_size=bsz, top_k=topk, top_p=top_p,
+                           device=device, sample=True, eos_token=endoftext, shortlist=shortlist, stats=stats)
+    ## sentences are detokenized by a thread pool and appended as they end, while decoding goes on
+    pending = deque()
+    with open(f"{save_dir}/{bsz}.txt", 'w') as f, ThreadPoolExecutor(max_workers=args.detok_workers) as pool:
+        for _, sent in stream:
+            pending.append(pool.submit(tokenizer.decode, sent))
+            while pending and pending[0].done():
+                f.write(pending.popleft().result().strip() + '\n')
+        while pending:
+            f.write(pending.popleft().result().strip() + '\n')
+    if 'occupancy' in stats:
+        print(f"{stats['sentences_per_sec']:.2f} sentences/sec, slot occupancy {stats['occupancy']:.3f}")
     print(f"Finish generating {bsz} sentences...")
 
 def cal_interpolate(args, ada_config, model, tokenizer, device, eval_dataloader, num_interpolation_steps=10, top_k=100, top_p=0.5):
@@ -154,7 +162,7 @@ def cal_interpolate(args, ada_config, model, tokenizer, device, eval_dataloader,
     for batch in tqdm(eval_dataloader, desc="Evaluating interpolation"):
         with torch.no_grad():
             if sample_interval == 0 or sample_interval == args.total_sents:
-                x_ids, input_ids, attention_mask = tokenize(batch['x'], tokenizer, device, args)
+                x_ids, input_ids, attention_mask = batch_tokens(batch, tokenizer, device, args)
                 outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
                 latent_z = outputs[-2]
                 latent_codes.append(latent_z)
@@ -192,76 +200,110 @@ def cal_interpolate(args, ada_config, model, tokenizer, device, eval_dataloader,
 
 
 
-def interpolate(args, ada_config, model, tokenizer, device, batch_pair, f, num_interpolation_steps=10, top_k=100, top_p=0.5):
-    endoftext = tokenizer.convert_tokens_to_ids("<|endoftext|>")
+def _cut_sentence(sent, endoftext):
+    """drop the leading <|endoftext|> and everything after the closing one"""
+    sent = sent[sent.index(endoftext) + 1:]
+    if endoftext in sent:
+        idx = sent.index(endoftext)
+        sent = sent[:idx]
+    return sent
+
+def encode_latents(args, model, tokenizer, device, texts):
+    """
+    posterior means of ``texts``, encoded in batches of args.batch_size.
+    only the averaged_attn and latent_attn latent heads mask the padding: with linear and mean_max_linear the
+    padding would change the latents, so sentences are then only batched with sentences of the same token length
+    (no padding), which gives the same latents as encoding every sentence alone.
+    """
+    if model.encoder.latent_type in ["averaged_attn", "latent_attn"]:
+        groups = [list(range(len(texts)))]
+    else:
+        lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=args.max_length)['input_ids']]
+        by_length = defaultdict(list)
+        for i, length in enumerate(lengths):
+            by_length[length].append(i)
+        groups = list(by_length.values())
+
+    latents = [None] * len(texts)
     with torch.no_grad():
-        x_ids, input_ids, attention_mask = tokenize(batch_pair['x'][0], tokenizer, device, args)
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
-        latent_z1 = outputs[-2]
+        for group in groups:
+            for start in range(0, len(group), args.batch_size):
+                indices = group[start:start + args.batch_size]
+                x_ids, input_ids, attention_mask = tokenize([texts[i] for i in indices], tokenizer, device, args)
+                mean = model.encoder(input_ids=input_ids, attention_mask=attention_mask)[0]
+                for i, latent in zip(indices, mean):
+                    latents[i] = latent
+    return torch.stack(latents, dim=0)
+
+def decode_latents(args, model, tokenizer, device, latent_z, top_k=100, top_p=0.5):
+    """decode a stack of latent codes with batched sample_sequence calls of args.batch_size"""
+    endoftext = tokenizer.convert_tokens_to_ids("<|endoftext|>")
+    sentences = []
+    for i in range(0, latent_z.size(0), args.batch_size):
+        z = latent_z[i:i + args.batch_size]
+        sents, _ = sample_sequence(model, args.max_length, z.to(device),
+                                   batch_size=z.size(0), top_k=top_k, top_p=top_p,
+                                   device=device, sample=True, eos_token=endoftext)
+        for sent in sents.tolist():
+            sentences.append(tokenizer.decode(_cut_sentence(sent, endoftext)).strip())
+    return sentences
 
-        x_ids, input_ids, attention_mask = tokenize(batch_pair['x'][1], tokenizer, device, args)
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
-        latent_z2 = outputs[-2]
-    result = defaultdict(str)
+def interpolate_batch(args, model, tokenizer, device, pairs, num_interpolation_steps=10, top_k=100, top_p=0.5):
+    """
+    interpolate between many sentence pairs: all anchors are encoded together and the whole
+    (pairs x steps) grid of latent codes is decoded in batches
+    :param pairs: list of (sentence_1, sentence_2)
+    :return: list of {step: sentence}, one per pair
+    """
+    latent_z = encode_latents(args, model, tokenizer, device, [s for pair in pairs for s in pair])
+    latent_z1, latent_z2 = latent_z[0::2], latent_z[1::2]
     num_steps = num_interpolation_steps + 1
-    for step in range(num_steps + 1):
-        latent_z = latent_z1 + (latent_z2 - latent_z1) * step * 1.0 / num_steps
-        sents, _ = sample_sequence(model, args.max_length, latent_z.to(device),
-                                       batch_size=1, top_k=top_k, top_p=top_p,
-                                       device=device, sample=True, eos_token=endoftext)
-        # Sample sentences
-        sents = sents.tolist()
-        sentences_list = []
-        ## bsz == 1 only sample 1 sentence for each interpolation step
-        sent = sents[0]
-        sent = sent[sent.index(endoftext) + 1:]
+    weights = torch.arange(num_steps + 1, dtype=latent_z.dtype, device=latent_z.device) / num_steps
+    ## (pairs, steps, nz)
+    grid = latent_z1.unsqueeze(1) + (latent_z2 - latent_z1).unsqueeze(1) * weights.view(1, -1, 1)
+    sentences = decode_latents(args, model, tokenizer, device, grid.view(-1, grid.size(-1)), top_k, top_p)
+    results = []
+    for i in range(len(pairs)):
+        result = defaultdict(str)
+        for step in range(num_steps + 1):
+            result[step] = sentences[i * (num_steps + 1) + step]
+        results.append(result)
+    return results
 
-        if endoftext in sent:
-            idx = sent.index(endoftext)
-            sent = sent[:idx]
-
-        sent = tokenizer.decode(sent).strip()
-        result[step] = sent
-        f.write(sent + '\n')
+def interpolate(args, ada_config, model, tokenizer, device, batch_pair, f, num_interpolation_steps=10, top_k=100, top_p=0.5):
+    result = interpolate_batch(args, model, tokenizer, device, [batch_pair['x'][:2]],
+                               num_interpolation_steps, top_k, top_p)[0]
+    for step in sorted(result):
+        f.write(result[step] + '\n')
 
     return result
 
-def analogy(args, ada_config, model, tokenizer, device, batch_triple, f, top_k=100, top_p=0.5):
-    endoftext = tokenizer.convert_tokens_to_ids("<|endoftext|>")
-    with torch.no_grad():
-        x_ids, input_ids, attention_mask = tokenize(batch_triple['x'][0], tokenizer, device, args)
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
-        latent_z1 = outputs[-2]
-
-        x_ids, input_ids, attention_mask = tokenize(batch_triple['x'][1], tokenizer, device, args)
-        outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
-        latent_z2 = outputs[-2]
-
-        for i in range(2, len(batch_triple['x'])):
-            x_ids, input_ids, attention_mask = tokenize(batch_triple['x'][i], tokenizer, device, args)
-            outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
-            latent_z3 = outputs[-2]
-
-            result = defaultdict(str)
-            latent_z = latent_z3 + args.degree_to_target * (latent_z2 - latent_z1)
-            sents, _ = sample_sequence(model, args.max_length, latent_z.to(device),
-                                       batch_size=1, top_k=top_k, top_p=top_p,
-                                       device=device, sample=True, eos_token=endoftext)
-            # Sample sentences
-            sents = sents.tolist()
-            ## bsz == 1 only sample 1 sentence for each interpolation step
-            sent = sents[0]
-            sent = sent[sent.index(endoftext) + 1:]
-
-            if endoftext in sent:
-                idx = sent.index(endoftext)
-                sent = sent[:idx]
+def analogy_batch(args, model, tokenizer, device, groups, top_k=100, top_p=0.5):
+    """
+    sentence analogy z_i + degree_to_target * (z_b - z_a) for many groups [a, b, c_1, c_2, ...]:
+    one batched encoder pass over all sentences and one batched decode of all targets
+    :return: list of generated sentences per group
+    """
+    texts = [s for group in groups for s in group]
+    latent_z = encode_latents(args, model, tokenizer, device, texts)
+    targets, offset = [], 0
+    for group in groups:
+        latent_z1, latent_z2 = latent_z[offset], latent_z[offset + 1]
+        targets.append(latent_z[offset + 2:offset + len(group)] + args.degree_to_target * (latent_z2 - latent_z1))
+        offset += len(group)
+    sentences = decode_latents(args, model, tokenizer, device, torch.cat(targets, dim=0), top_k, top_p)
+    results, offset = [], 0
+    for group in groups:
+        results.append(sentences[offset:offset + len(group) - 2])
+        offset += len(group) - 2
+    return results
 
-            sent = tokenizer.decode(sent).strip()
-            result[0] = sent
-            f.write(sent + '\n')
+def analogy(args, ada_config, model, tokenizer, device, batch_triple, f, top_k=100, top_p=0.5):
+    result = analogy_batch(args, model, tokenizer, device, [batch_triple['x']], top_k, top_p)[0]
+    for sent in result:
+        f.write(sent + '\n')
 
-    # return result
+    return result
 
 def cal_rec(args, ada_config, model, tokenizer, device, eval_dataloader, save_dir=None, sample=False, top_k=100, top_p=0.95):
     endoftext = tokenizer.convert_tokens_to_ids("<|endoftext|>")
@@ -269,7 +311,7 @@ def cal_rec(args, ada_config, model, tokenizer, device, eval_dataloader, save_di
     with tqdm(total=min(len(eval_dataloader), args.max_val_batches), desc="Evaluating Model") as pbar:
         for i, batch in enumerate(eval_dataloader):
             with torch.no_grad():
-                x_ids, input_ids, attention_mask = tokenize(batch['x'], tokenizer, device, args)
+                x_ids, input_ids, attention_mask = batch_tokens(batch, tokenizer, device, args)
                 outputs = model(input_ids=input_ids, attention_mask=attention_mask, from_mean=True)
                 latent_z = outputs[-2]
                 sents, _ = sample_sequence(model, args.max_length, z=latent_z,
@@ -299,12 +341,9 @@ def cal_rec(args, ada_config, model, tokenizer, device, eval_dataloader, save_di
 
 def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder):
     model.eval()
-    endoftext = tokenizer.convert_tokens_to_ids("<|endoftext|>")
     loss_fn = nn.CrossEntropyLoss(reduction='none')
     n_words_bpe = 0
     n_words = 0
-    n_examples = 0
-    cnt_au = 0
     logp_sum = 0.0
     reg_loss_sum = 0.0
 
@@ -316,8 +355,7 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
         d_loss_sum = 0.
         g_loss_sum = 0.
 
-    mu_batch_list, logvar_batch_list = [], []
-    neg_entropy = 0.
+    latent_stats = LatentStatistics()
     max_val_batches = args.max_val_batches
 
     print("Validation loop.         Batches: %d" % len(val_loader))
@@ -326,13 +364,14 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
     with tqdm(total=min(len(val_loader), max_val_batches), desc="Evaluating Model") as pbar:
         for i, val_data_dict in enumerate(val_loader):
             with torch.no_grad():
-                val_x_ids, val_input_ids, val_attention_mask = tokenize(val_data_dict['x'], tokenizer, device, args)
+                val_x_ids, val_input_ids, val_attention_mask = batch_tokens(val_data_dict, tokenizer, device, args)
 
                 if args.weighted_sample:
                     val_loss, val_ce_loss, val_reg_loss, val_mu, val_lv, \
                     val_loss_ppl, val_loss_rec = compute_loss(device, model, val_x_ids,
                                                               val_input_ids, val_attention_mask,
-                                                              loss_fn, 1.0, 0.0, args.reg_loss, True)
+                                                              loss_fn, 1.0, 0.0, args.reg_loss, True,
+                                                              iw_max_tokens=args.iw_max_tokens)
                     val_loss_ppl, val_loss_rec = val_loss_ppl.sum(), val_loss_rec.sum()
                     reported_loss_ppl += val_loss_ppl.item()
                     reported_loss_rec += val_loss_rec.item()
@@ -343,14 +382,10 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
             """
             calculate text perplexity
             """
-            target_tokens = val_x_ids
-            if len(target_tokens.size()) == 1:
-                target_tokens = target_tokens.unsqueeze(0)
-            n, l = target_tokens.size()
-
-            text = target_tokens.tolist()
-            tokens = [t[:t.index(endoftext) + 1] if endoftext in t else t for t in text]
-            words_bpe = sum([len(t) for t in tokens])
+            n = val_attention_mask.size(0)
+
+            ## target tokens up to <|endoftext|> are the ones of the attention mask
+            words_bpe = val_attention_mask.sum().item()
             n_words_bpe += words_bpe
             logprob = val_ce_loss.mean()
 
@@ -365,43 +400,21 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
 
             logp_sum += logprob * words_bpe
 
-            n_words_bpe += len(text)
+            n_words_bpe += n
 
-            ctext = [tokenizer.decode(target_tokens[i, :]) for i in range(n)]
-            ctext = [s[s.find("<|endoftext|>") + len("<|endoftext|>"):] for s in ctext]
-            ctext = [s[:s.find("<|endoftext|>") + len("<|endoftext|>")] if "<|endoftext|>" in s else s for s in
-                     ctext]
-            words = sum([len(
-                [t for t in re.split('("|\'|!|\?|\.|,|:| |\n|’|“|”|;|\(|\)|`)', s) if t != ' ' and t != '']) for
-                s in ctext])
-            n_words += words
+            ## word counts precomputed with the dataset (see count_words in data.py)
+            n_words += val_data_dict['n_words'].sum().item()
 
             """
-            calculate mutual information (mi) Stage 1
+            posterior statistics of mutual information (mi) and active units (au)
             """
-            n_examples += n
-            nz = val_mu.size(1)
-            # E_{q(z|x)}log(q(z|x)) = -0.5*nz*log(2*\pi) - 0.5*(1+logvar).sum(-1)
-            neg_entropy += (-0.5 * nz * math.log(2 * math.pi) - 0.5 * (1 + val_lv).sum(-1)).sum().item()
-            mu_batch_list += [val_mu.cpu()]
-            logvar_batch_list += [val_lv.cpu()]
-
-            """
-            compute the number of active units (au) Stage 1
-            """
-            if cnt_au == 0:
-                means_sum = val_mu.sum(dim=0, keepdim=True)
-            else:
-                means_sum = means_sum + val_mu.sum(dim=0, keepdim=True)
-            cnt_au += val_mu.size(0)
+            latent_stats.update(val_mu, val_lv)
 
 
             if i > max_val_batches:
                 break
             pbar.update(1)
 
-    neg_entropy = neg_entropy / n_examples
-    mean_mean = means_sum / cnt_au
     loss_bpe = logp_sum / n_words_bpe
     reg = reg_loss_sum / len(val_loader)
     latent_bound = g_loss if args.reg_loss == "adversarial" else reg_loss_sum
@@ -420,77 +433,10 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
         g_loss = g_loss_sum / len(val_loader)
 
     """
-    calculate mi and au Stage 2
-    """
-    n_examples = 0
-    log_qz = 0.
-    for i in tqdm(range(len(mu_batch_list)), desc="Evaluating MI, Stage 2"):
-        ###############
-        # get z_samples
-        ###############
-        mu, logvar = mu_batch_list[i].cuda(), logvar_batch_list[i].cuda()
-
-        # [z_batch, 1, nz]
-        with torch.no_grad():
-            z_samples = model.reparameterize(mu, logvar).unsqueeze(1)
-
-        z_samples = z_samples.view(-1, 1, nz)
-        n_examples += z_samples.size(0)
-
-        ###############
-        # compute density
-        ###############
-        # [1, x_batch, nz]
-        # mu, logvar = mu_batch_list[i].cuda(), logvar_batch_list[i].cuda()
-        # indices = list(np.random.choice(np.arange(len(mu_batch_list)), 10)) + [i]
-        indices = np.arange(len(mu_batch_list))
-        mu = torch.cat([mu_batch_list[_] for _ in indices], dim=0).cuda()
-        logvar = torch.cat([logvar_batch_list[_] for _ in indices], dim=0).cuda()
-        x_batch, nz = mu.size()
-
-        mu, logvar = mu.unsqueeze(0), logvar.unsqueeze(0)
-        var = logvar.exp()
-
-        # (z_batch, x_batch, nz)
-        dev = z_samples - mu
-
-        # (z_batch, x_batch)
-        log_density = -0.5 * ((dev ** 2) / var).sum(dim=-1) - \
-                      0.5 * (nz * math.log(2 * math.pi) + logvar.sum(-1))
-
-        # log q(z): aggregate posterior
-        # [z_batch]
-        log_qz += (log_sum_exp(log_density, dim=1) - math.log(x_batch)).sum(-1)
-
-
-    log_qz /= n_examples
-    mi = (neg_entropy - log_qz).item()
-
-    """
-    calculate au Stage 2
+    calculate mi and au from the statistics of the single pass
     """
-    cnt_au = 0
-    with tqdm(total=min(len(val_loader), max_val_batches), desc="Evaluating AU, Stage 2") as pbar:
-        for i, val_data_dict in enumerate(val_loader):
-            with torch.no_grad():
-                val_x_ids, val_input_ids, val_attention_mask = tokenize(val_data_dict['x'], tokenizer, device, args)
-
-                val_loss, val_ce_loss, val_reg_loss, val_mu, val_lv = compute_loss(device, model, val_x_ids,
-                                                                                   val_input_ids, val_attention_mask,
-                                                                                   loss_fn, 1.0, 0.0, args.reg_loss)
-            if cnt_au == 0:
-                var_sum = ((val_mu - mean_mean) ** 2).sum(dim=0)
-            else:
-                var_sum = var_sum + ((val_mu - mean_mean) ** 2).sum(dim=0)
-            cnt_au += val_mu.size(0)
-
-            if i > max_val_batches:
-                break
-            pbar.update(1)
-
-    # (nz)
-    au_var = var_sum / (cnt_au - 1)
-    n_au = (au_var >= args.au_delta).sum().item()
+    mi, mi_stderr = latent_stats.mutual_information(num_samples=args.mi_samples, device=device)
+    n_au = latent_stats.active_units(args.au_delta)
 
     with open(os.path.join(save_folder, f"test_ws{args.weighted_sample}.txt"), 'w') as f:
         f.write('val loss    : %.4f\n' % loss_bpe)
@@ -498,6 +444,8 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
         f.write('val ppl_word: %.4f\n' % ppl_word)
         f.write('val reg_loss: %.4f\n' % reg)
         f.write('val MI      : %.4f\n' % mi)
+        if mi_stderr is not None:
+            f.write('val MI err  : %.4f\n' % mi_stderr)
         f.write('val AU      : %.4f\n' % n_au)
         if args.reg_loss == "adversarial":
             f.write('val d_loss: %.4f\n' % d_loss)
@@ -509,6 +457,8 @@ def val_step(args, model, val_loader, ada_config, tokenizer, device, save_folder
     print('val ppl_word: %.4f' % ppl_word)
     print('val reg_loss: %.4f' % reg)
     print('val MI      : %.4f' % mi)
+    if mi_stderr is not None:
+        print('val MI err  : %.4f' % mi_stderr)
     print('val AU      : %.4f' % n_au)
     if args.reg_loss == "adversarial":
         print('val d_loss: %.4f' % d_loss)
@@ -563,6 +513,7 @@ def test(args):
     init_para_frompretrained(AdaVAE.transformer, gpt2_model.transformer, share_para=False)
     init_para_frompretrained(AdaVAE.encoder, gpt2_model.transformer, share_para=False)
     AdaVAE.lm_head.weight = gpt2_model.lm_head.weight
+    set_attn_backend(AdaVAE, args.attn_backend)
 
     AdaVAE.eval()
     ## load ckpt
@@ -592,22 +543,22 @@ def test(args):
             mode = args.mode
             assert mode in ['generate', 'interpolate', 'reconstruct', 'analogy', 'cal_interpolate', 'overall'], "get invalid test mode.."
 
-            if args.weighted_sample and mode == "overall": args.batch_size = 10
             args.dataset = '_'.join(experiment.split("_")[:2])
+            test_set = GenerationDataset.from_file(f"../data/optimus_dataset/{args.dataset}/test.txt")
+            valid_set = GenerationDataset.from_file(f"../data/optimus_dataset/{args.dataset}/valid.txt")
+            collate = Collator(tokenizer, args.max_length)
             test_loader = DataLoader(
-                GenerationDataset.from_file(f"../data/optimus_dataset/{args.dataset}/test.txt"),
-                batch_size=args.batch_size,
+                test_set,
+                **batching(test_set, args.batch_size, args.length_buckets, shuffle=True, drop_last=False),
                 pin_memory=True,
-                drop_last=False,
-                shuffle=True,
-                num_workers=args.workers)
+                **loader_workers(args.workers, args.prefetch_factor),
+                collate_fn=collate)
             val_loader = DataLoader(
-                GenerationDataset.from_file(f"../data/optimus_dataset/{args.dataset}/valid.txt"),
-                batch_size=args.batch_size,
+                valid_set,
+                **batching(valid_set, args.batch_size, args.length_buckets, shuffle=True, drop_last=False),
                 pin_memory=True,
-                drop_last=False,
-                shuffle=True,
-                num_workers=args.workers)
+                **loader_workers(args.workers, args.prefetch_factor),
+                collate_fn=collate)
 
             if args.test_model:
                 print("test set")
@@ -624,7 +575,17 @@ def test(args):
                 print("valid set")
                 val_step(args, AdaVAE, val_loader, ada_config, tokenizer, device, save_folder)
             elif mode == "generate":
-                generate(args, AdaVAE, save_dir, args.total_sents, tokenizer, device, topk=100, top_p=0.95)
+                shortlist = None
+                if args.vocab_shortlist:
+                    train_set = GenerationDataset.from_file(f"../data/optimus_dataset/{args.dataset}/train.txt")
+                    shortlist, coverage = build_vocab_shortlist([train_set[i]['x'] for i in range(len(train_set))],
+                                                                tokenizer, min_count=args.shortlist_min_count,
+                                                                special_ids=[tokenizer.eos_token_id],
+                                                                eval_texts=[valid_set[i]['x'] for i in range(len(valid_set))])
+                    print(f"Vocabulary shortlist: {coverage['shortlist_size']}/{coverage['vocab_size']} types, "
+                          f"lost token coverage {coverage['train_lost']:.4%} (train) {coverage['eval_lost']:.4%} (valid)")
+                generate(args, AdaVAE, save_dir, args.total_sents, tokenizer, device, topk=100, top_p=0.95,
+                         shortlist=shortlist)
                 print(f"Done generating {args.total_sents} for {args.class_num} class(es).")
 
             elif mode == "interpolate":
@@ -634,17 +595,14 @@ def test(args):
                     pin_memory=True,
                     drop_last=True,
                     num_workers=args.workers)
-                result = []
-                with tqdm(total=min(len(test_loader), args.max_test_batch),
-                          desc=f"Interpolation for {args.max_test_batch} pairs") as pbar:
-                    for i, batch in enumerate(test_loader):
-                        result_ = interpolate(args, ada_config, AdaVAE, tokenizer, device, batch,
-                                             num_interpolation_steps=args.num_interpolation_step)
-                        result.append(result_)
-                        if i >args.max_test_batch:
-                            break
-                        pbar.update(1)
-                return result
+                pairs = []
+                for i, batch in enumerate(test_loader):
+                    pairs.append(batch['x'])
+                    if i > args.max_test_batch:
+                        break
+                print(f"Interpolation for {len(pairs)} pairs")
+                return interpolate_batch(args, AdaVAE, tokenizer, device, pairs,
+                                         num_interpolation_steps=args.num_interpolation_step)
 
             elif mode == "reconstruct":
                 if args.do_sample: do_sample = True
@@ -659,16 +617,13 @@ def test(args):
                     pin_memory=True,
                     drop_last=True,
                     num_workers=args.workers)
-                result = []
-                with tqdm(total=min(len(test_loader), args.max_test_batch),
-                          desc=f"Analogy for {args.max_test_batch} pairs") as pbar:
-                    for i, batch in enumerate(test_loader):
-                        result_ = analogy(args, ada_config, AdaVAE, tokenizer, device, batch)
-                        result.append(result_)
-                        if i > args.max_test_batch:
-                            break
-                        pbar.update(1)
-                return result
+                groups = []
+                for i, batch in enumerate(test_loader):
+                    groups.append(batch['x'])
+                    if i > args.max_test_batch:
+                        break
+                print(f"Analogy for {len(groups)} triples")
+                return analogy_batch(args, AdaVAE, tokenizer, device, groups)
 
             elif mode == "cal_interpolate":
                 pass
@@ -718,6 +673,7 @@ def test_short(args):
     init_para_frompretrained(AdaVAE.transformer, gpt2_model.transformer, share_para=False)
     init_para_frompretrained(AdaVAE.encoder, gpt2_model.transformer, share_para=False)
     AdaVAE.lm_head.weight = gpt2_model.lm_head.weight
+    set_attn_backend(AdaVAE, args.attn_backend)
 
     AdaVAE.eval()
     ## load ckpt
@@ -814,35 +770,25 @@ def test_short(args):
     with open(f"./output_txts/{args.mode}_k{topk}_p{topp}_yelp.txt", 'a') as f:
         if args.mode == "interpolate":
             f.write("-"*10 + "Interpolating" + "-"*10 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair1, f, num_interpolation_steps=10, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair2, f, num_interpolation_steps=10, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair3, f, num_interpolation_steps=10, top_k=topk, top_p=topp)
-
-            f.write("-" * 20 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair4, f, num_interpolation_steps=10,
-                        top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair5, f, num_interpolation_steps=10,
-                        top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            interpolate(args, ada_config, AdaVAE, tokenizer, device, batch_pair6, f, num_interpolation_steps=10,
-                        top_k=topk, top_p=topp)
+            batch_pairs = [batch_pair1, batch_pair2, batch_pair3, batch_pair4, batch_pair5, batch_pair6]
+            results = interpolate_batch(args, AdaVAE, tokenizer, device, [pair['x'] for pair in batch_pairs],
+                                        num_interpolation_steps=10, top_k=topk, top_p=topp)
+            for i, result in enumerate(results):
+                if i > 0:
+                    f.write("-" * 20 + '\n')
+                for step in sorted(result):
+                    f.write(result[step] + '\n')
         elif args.mode == "analogy":
             f.write("-" * 10 + "Analogying" + "-" * 10 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet1, f, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet2, f, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet3, f, top_k=topk, top_p=topp)
-
-            f.write("-" * 20 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet4, f, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet5, f, top_k=topk, top_p=topp)
-            f.write("-" * 20 + '\n')
-            analogy(args, ada_config, AdaVAE, tokenizer, device, analogy_triplet6, f, top_k=topk, top_p=topp)
+            analogy_triplets = [analogy_triplet1, analogy_triplet2, analogy_triplet3,
+                                analogy_triplet4, analogy_triplet5, analogy_triplet6]
+            results = analogy_batch(args, AdaVAE, tokenizer, device, [triplet['x'] for triplet in analogy_triplets],
+                                    top_k=topk, top_p=topp)
+            for i, result in enumerate(results):
+                if i > 0:
+                    f.write("-" * 20 + '\n')
+                for sent in result:
+                    f.write(sent + '\n')
 
 if __name__=="__main__":
     args = parser.parse_args()
@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: conftest.py
+@feature: the tests import the src modules the way the scripts do (utils, data, metrics, adapters.*)
+"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
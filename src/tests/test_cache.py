@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: test_cache.py
+@feature: incremental decoding with the static/slot key-value caches and the latent context vs a full forward
+"""
+import pytest
+import torch
+from transformers import GPT2Config
+from adapters.vae import AdaVAEModel
+from adapters.common import AdapterConfig
+
+## add_softmax projects z with an (n_embd, vocab_size) layer, the latent size is n_embd
+LATENT_SIZE = 32
+LATENT_MODES = [dict(add_attn=True), dict(add_mem=True), dict(add_input=True, add_softmax=True),
+                dict(add_attn=True, add_mem=True, add_softmax=True)]
+
+
+def tiny_model(add_input=False, add_attn=False, add_softmax=False, add_mem=False):
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=50, n_positions=16, n_ctx=16, n_embd=32, n_layer=2, n_head=4)
+    ada_config = AdapterConfig(hidden_size=32, adapter_size=8, adapter_act='relu', adapter_initializer_range=1e-2,
+                               latent_size=LATENT_SIZE, class_num=2, encoder_n_layer=2, decoder_n_layer=2, dis_emb=16,
+                               init='bert', adapter_scalar='1.0', ffn_option='parallel_ffn', attn_mode='none',
+                               latent_gen='averaged_attn', attn_option='none', mid_dim=8, attn_bn=4,
+                               prefix_dropout=0.0, tune_enc=False, tune_dec=False, add_z2adapters=False)
+    model = AdaVAEModel(config, ada_config, add_input=add_input, add_attn=add_attn, add_softmax=add_softmax,
+                        add_mem=add_mem)
+    return model.eval()
+
+
+def full_logits(model, input_ids, z):
+    """ logits of the uncached forward, z projected inside the decoder """
+    hidden = model.transformer(input_ids=input_ids, representations=z, use_cache=False)[0]
+    logits = model.lm_head(hidden)
+    if model.add_softmax:
+        logits = logits + model.lm_head_rep(z).unsqueeze(1)
+    return logits
+
+
+def step_logits(model, hidden, latent_context):
+    logits = model.lm_head(hidden)
+    if model.add_softmax:
+        logits = logits + latent_context.logits_rep.unsqueeze(1)
+    return logits
+
+
+@pytest.mark.parametrize('modes', LATENT_MODES)
+@pytest.mark.parametrize('chunks', [(1,) * 10, (4, 1, 1, 4)])
+def test_static_cache_matches_full_forward(modes, chunks):
+    model = tiny_model(**modes)
+    input_ids = torch.randint(50, (3, 10))
+    z = torch.randn(3, LATENT_SIZE)
+    with torch.no_grad():
+        expected = full_logits(model, input_ids, z)
+        mem = model.transformer.init_kv_cache(input_ids.size(1))
+        latent_context = model.init_latent_context(z)
+        logits, start = [], 0
+        for chunk in chunks:
+            hidden, mem = model.transformer(input_ids=input_ids[:, start:start + chunk], past=mem,
+                                            representations=latent_context)
+            logits.append(step_logits(model, hidden, latent_context))
+            start += chunk
+    assert torch.allclose(torch.cat(logits, dim=1), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('modes', LATENT_MODES)
+def test_static_cache_rows_selected(modes):
+    model = tiny_model(**modes)
+    input_ids = torch.randint(50, (3, 6))
+    z = torch.randn(3, LATENT_SIZE)
+    keep = torch.tensor([0, 2])
+    with torch.no_grad():
+        expected = full_logits(model, input_ids[keep], z[keep])
+        mem = model.transformer.init_kv_cache(input_ids.size(1))
+        latent_context = model.init_latent_context(z)
+        hidden, mem = model.transformer(input_ids=input_ids[:, :3], past=mem, representations=latent_context)
+        mem = model.transformer.select_past(mem, keep)
+        latent_context = latent_context.index_select(keep)
+        hidden, mem = model.transformer(input_ids=input_ids[keep, 3:], past=mem, representations=latent_context)
+        logits = step_logits(model, hidden, latent_context)
+    assert torch.allclose(logits, expected[:, 3:], atol=1e-5)
+
+
+def test_static_cache_overflow():
+    model = tiny_model(add_attn=True)
+    mem = model.transformer.init_kv_cache(2)
+    with torch.no_grad():
+        with pytest.raises(ValueError):
+            model.transformer(input_ids=torch.randint(50, (1, 3)), past=mem,
+                              representations=model.init_latent_context(torch.randn(1, LATENT_SIZE)))
+
+
+@pytest.mark.parametrize('modes', [m for m in LATENT_MODES if m.get('add_attn') or m.get('add_mem')])
+def test_slot_cache_matches_full_forward(modes):
+    """ two slots at different positions, the second one refilled with a new sequence and latent code """
+    model = tiny_model(**modes)
+    first = torch.randint(50, (2, 8))
+    second = torch.randint(50, (1, 5))
+    z = torch.randn(3, LATENT_SIZE)
+    with torch.no_grad():
+        expected_first = full_logits(model, first, z[:2])
+        expected_second = full_logits(model, second, z[2:])
+        mem = model.transformer.init_slot_cache(2, first.size(1))
+        latent_context = model.init_latent_context(z[:2])
+        ## slot 1 starts one step after slot 0
+        hidden, mem = model.transformer(input_ids=first[:, :1], past=mem, representations=latent_context)
+        mem.positions[1] = 0
+        got_first = [step_logits(model, hidden, latent_context)[0]]
+        for i in range(1, 8):
+            prev = torch.stack([first[0, i], first[1, i - 1]]).unsqueeze(1)
+            hidden, mem = model.transformer(input_ids=prev, past=mem, representations=latent_context)
+            logits = step_logits(model, hidden, latent_context)
+            got_first.append(logits[0])
+            assert torch.allclose(logits[1], expected_first[1, i - 1:i], atol=1e-5)
+        assert torch.allclose(torch.cat(got_first, dim=0), expected_first[0], atol=1e-5)
+
+        ## slot 0 is done: refill it, slot 1 feeds its last token then leaves
+        refill = torch.tensor([0])
+        latent_context.index_copy_(refill, model.init_latent_context(z[2:]))
+        mem.reset(refill)
+        prev = torch.stack([second[0, 0], first[1, 7]]).unsqueeze(1)
+        hidden, mem = model.transformer(input_ids=prev, past=mem, representations=latent_context)
+        logits = step_logits(model, hidden, latent_context)
+        assert torch.allclose(logits[1], expected_first[1, 7:], atol=1e-5)
+        got_second = [logits[0]]
+        keep = torch.tensor([0])
+        mem = model.transformer.select_past(mem, keep)
+        latent_context = latent_context.index_select(keep)
+        for i in range(1, 5):
+            hidden, mem = model.transformer(input_ids=second[:, i:i + 1], past=mem, representations=latent_context)
+            got_second.append(step_logits(model, hidden, latent_context)[0])
+        assert torch.allclose(torch.cat(got_second, dim=0), expected_second[0], atol=1e-5)
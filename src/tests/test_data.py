@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: test_data.py
+@feature: word counts of the datasets, batch samplers and collation
+"""
+import re
+import numpy as np
+import torch
+from data import GenerationDataset, ConditionalGenerationDataset, Collator, BucketBatchSampler, EvalBatches
+
+SENTENCES = ["the movie was great !\n", "i ca n't believe it , \"really\" .\n", "(a)  `quoted’ word;  end\n",
+             "one\n", "what ? no : yes ...\n"]
+
+
+class WhitespaceTokenizer(object):
+    """ stand-in of the GPT2Tokenizer call of Collator, ids are the word positions """
+    pad_token_id = 0
+
+    def __call__(self, texts, padding=True, truncation=True, return_tensors='pt', max_length=None):
+        ids = [list(range(1, len(text.split()) + 1))[:max_length] for text in texts]
+        longest = max(len(i) for i in ids)
+        return {'input_ids': torch.tensor([i + [0] * (longest - len(i)) for i in ids]),
+                'attention_mask': torch.tensor([[1] * len(i) + [0] * (longest - len(i)) for i in ids])}
+
+
+def regex_word_count(text):
+    """ the per-batch count val_step made on the decoded targets: the sentence after <|endoftext|> and its EOS """
+    text = text[text.find("<|endoftext|>") + len("<|endoftext|>"):]
+    text = text[:text.find("<|endoftext|>") + len("<|endoftext|>")]
+    return len([t for t in re.split(r'("|\'|!|\?|\.|,|:| |\n|’|“|”|;|\(|\)|`)', text) if t != ' ' and t != ''])
+
+
+def test_collator_word_counts():
+    collate = Collator(WhitespaceTokenizer(), max_length=32)
+    datasets = [GenerationDataset([s.rstrip('\n') for s in SENTENCES]),
+                ConditionalGenerationDataset(['1\t' + s for s in SENTENCES])]
+    for dataset in datasets:
+        samples = [dataset[i] for i in range(len(dataset))]
+        batch = collate(samples)
+        assert batch['n_words'].dtype == torch.long
+        assert batch['n_words'].tolist() == [regex_word_count(sample['x']) for sample in samples]
+
+
+def test_collator_shifts_targets():
+    collate = Collator(WhitespaceTokenizer(), max_length=32)
+    dataset = ConditionalGenerationDataset(['1\t' + s for s in SENTENCES])
+    samples = [dataset[i] for i in range(len(dataset))]
+    tokenized = WhitespaceTokenizer()([sample['x'] for sample in samples])
+    batch = collate(samples)
+    assert torch.equal(batch['input_ids'], tokenized['input_ids'][:, :-1])
+    assert torch.equal(batch['x_ids'], tokenized['input_ids'][:, 1:])
+    assert torch.equal(batch['attention_mask'], tokenized['attention_mask'][:, 1:])
+    assert batch['y'].tolist() == [1] * len(samples)
+    assert batch['x'] == [sample['x'] for sample in samples]
+
+    ## pre-tokenized ids (TokenizedDataset) are padded by the collator itself
+    ids_batch = collate([{'x': sample['x'], 'x_ids': ids[mask.bool()].tolist()}
+                         for sample, ids, mask in zip(samples, tokenized['input_ids'], tokenized['attention_mask'])])
+    for key in ('input_ids', 'x_ids', 'attention_mask'):
+        assert torch.equal(ids_batch[key], batch[key])
+
+
+def test_bucket_batch_sampler():
+    np.random.seed(0)
+    lengths = np.random.randint(1, 40, size=503)
+    sampler = BucketBatchSampler(lengths, batch_size=16, bucket_batches=4)
+    for _ in range(2):
+        assert len(sampler) == len(sampler.batches)
+        batches = list(sampler)
+        ## every example once per epoch, batches cut from length-sorted pools
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+        assert all(len(batch) <= 16 for batch in batches)
+        assert all(list(lengths[batch]) == sorted(lengths[batch]) for batch in batches)
+
+    sampler = BucketBatchSampler(lengths, batch_size=16, max_tokens=120)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) == 1 or len(batch) * lengths[batch].max() <= 120 for batch in batches)
+
+    batches = list(BucketBatchSampler(lengths, batch_size=16, drop_last=True))
+    assert all(len(batch) == 16 for batch in batches)
+
+
+def test_eval_batches():
+    dataset = GenerationDataset(["word " * n for n in np.random.RandomState(0).randint(1, 30, size=45)])
+    collate = Collator(WhitespaceTokenizer(), max_length=64)
+    batches = EvalBatches(dataset, collate, batch_size=8, seed=3)
+    assert len(batches) == 6
+    ## every example in one batch of similar lengths, the same batches at every call
+    lengths = [sorted(batch['n_words'].tolist()) for batch in batches]
+    assert sorted(n for batch in lengths for n in batch) == sorted(dataset.word_count)
+    assert all(batch['n_words'].tolist() == sorted(batch['n_words'].tolist()) for batch in batches)
+    ## cut from the length-sorted set: the length ranges of the batches do not overlap
+    ranges = sorted((batch[0], batch[-1]) for batch in lengths)
+    assert all(high <= next_low for (_, high), (next_low, _) in zip(ranges, ranges[1:]))
+    ## batch order shuffled, so that capped evaluation loops see all lengths
+    assert [batch[0] for batch in lengths] != [low for low, _ in ranges]
+    assert all(a is b for a, b in zip(batches, batches))
+    assert [batch['n_words'].tolist() for batch in EvalBatches(dataset, collate, batch_size=8, seed=3)] == \
+           [batch['n_words'].tolist() for batch in batches]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: test_iw_nll.py
+@feature: importance weighted log p(x) of iw_log_likelihood vs a per-sample computation, for every chunking
+"""
+import math
+import pytest
+import torch
+import torch.nn.functional as F
+from test_cache import tiny_model, LATENT_SIZE
+
+BSZ, SEQ_LEN, NSAMPLES = 3, 6, 5
+
+
+def batch():
+    torch.manual_seed(1)
+    ids = torch.randint(50, (BSZ, SEQ_LEN + 1))
+    mask = torch.ones(BSZ, SEQ_LEN, dtype=torch.long)
+    mask[0, 4:] = 0
+    mask[2, 2:] = 0
+    mean, logvar = torch.randn(BSZ, LATENT_SIZE), torch.randn(BSZ, LATENT_SIZE) * 0.1
+    eps = torch.randn(BSZ, NSAMPLES, LATENT_SIZE)
+    return ids[:, :-1], mask, ids[:, 1:], mean, logvar, eps
+
+
+def fix_noise(model, eps):
+    """ reparameterize reads the (sentence, sample) noise of ``eps`` whatever the chunks it is called on """
+    reparameterize = model.reparameterize
+    cursor = {'row': 0, 'sample': 0}
+
+    def fixed(mean, logvar, z=None, ns=0):
+        row, sample = cursor['row'], cursor['sample']
+        cursor['sample'] += ns
+        if cursor['sample'] == eps.size(1):
+            cursor['row'], cursor['sample'] = row + mean.size(0), 0
+        return reparameterize(mean, logvar, z=eps[row:row + mean.size(0), sample:sample + ns], ns=ns)
+    model.reparameterize = fixed
+
+
+def reference(model, x, mask, labels, mean, logvar, eps):
+    """ one decoder pass and the materialized logits per sample """
+    log_weights, log_gens = [], []
+    for k in range(eps.size(1)):
+        z = mean + eps[:, k] * logvar.mul(0.5).exp()
+        logits = model.lm_logits(model.transformer(x, attention_mask=mask, representations=z, use_cache=False)[0],
+                                 model.lm_head_rep(z) if model.add_softmax else None)
+        nll = F.cross_entropy(logits.transpose(1, 2), labels, reduction='none')
+        log_gen = -(nll * mask).sum(-1)
+        log_prior = (-0.5 * math.log(2 * math.pi) - z ** 2 / 2).sum(-1)
+        log_infer = (-0.5 * math.log(2 * math.pi) - 0.5 * logvar - 0.5 * eps[:, k] ** 2).sum(-1)
+        log_weights.append(log_gen + log_prior - log_infer)
+        log_gens.append(log_gen)
+    log_prob = torch.logsumexp(torch.stack(log_weights, dim=1), dim=1) - math.log(eps.size(1))
+    return log_prob, torch.stack(log_gens, dim=1).mean(dim=1)
+
+
+@pytest.mark.parametrize('modes', [dict(add_attn=True), dict(add_input=True, add_softmax=True)])
+@pytest.mark.parametrize('max_tokens', [16384, 36, 12, 1])
+def test_chunking_does_not_change_estimate(modes, max_tokens):
+    """ 16384: a single pass, 36: every sentence with uneven sample chunks, 12 and 1: sentence chunks """
+    model = tiny_model(**modes)
+    x, mask, labels, mean, logvar, eps = batch()
+    with torch.no_grad():
+        expected = reference(model, x, mask, labels, mean, logvar, eps)
+        fix_noise(model, eps)
+        log_prob, log_gen = model.iw_log_likelihood(x, mask, labels, mean, logvar, nsamples=NSAMPLES,
+                                                    max_tokens=max_tokens)
+    assert torch.allclose(log_prob, expected[0], atol=1e-4)
+    assert torch.allclose(log_gen, expected[1], atol=1e-4)
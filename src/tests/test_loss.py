@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: test_loss.py
+@feature: linear_cross_entropy vs F.cross_entropy of the materialized logits, forward and gradient
+"""
+import pytest
+import torch
+import torch.nn.functional as F
+from adapters.loss import linear_cross_entropy
+
+
+def inputs(bias):
+    torch.manual_seed(0)
+    hidden = torch.randn(3, 5, 16, requires_grad=True)
+    weight = torch.randn(37, 16, requires_grad=True)
+    target = torch.randint(37, (3, 5))
+    target[0, 3:] = -100
+    logits_bias = torch.randn(3, 37, requires_grad=True) if bias else None
+    return hidden, weight, target, logits_bias
+
+
+def reference(hidden, weight, target, bias, reduction):
+    logits = F.linear(hidden, weight)
+    if bias is not None:
+        logits = logits + bias.unsqueeze(1)
+    return F.cross_entropy(logits.view(-1, logits.size(-1)), target.view(-1), ignore_index=-100, reduction=reduction)
+
+
+def grads(loss, tensors):
+    tensors = [t for t in tensors if t is not None]
+    return torch.autograd.grad(loss, tensors, grad_outputs=torch.rand_like(loss) if loss.dim() else None)
+
+
+@pytest.mark.parametrize('reduction', ['mean', 'sum', 'none'])
+@pytest.mark.parametrize('bias', [False, True])
+@pytest.mark.parametrize('chunk_size', [8, 37, 8192])
+def test_matches_cross_entropy(reduction, bias, chunk_size):
+    hidden, weight, target, logits_bias = inputs(bias)
+    expected = reference(hidden, weight, target, logits_bias, reduction)
+    loss = linear_cross_entropy(hidden, weight, target, bias=logits_bias, reduction=reduction, chunk_size=chunk_size)
+    assert torch.allclose(loss, expected, atol=1e-5)
+
+    torch.manual_seed(1)
+    expected_grads = grads(expected, (hidden, weight, logits_bias))
+    torch.manual_seed(1)
+    loss_grads = grads(loss, (hidden, weight, logits_bias))
+    for got, want in zip(loss_grads, expected_grads):
+        assert torch.allclose(got, want, atol=1e-5)
+
+
+def test_gathered_positions_with_bias_index():
+    """ the iw_log_likelihood layout: masked positions gathered, every one pointing at its row of ``bias`` """
+    hidden, weight, target, logits_bias = inputs(True)
+    valid = target.ne(-100)
+    bias_index = torch.arange(3).unsqueeze(1).expand_as(target)[valid]
+    loss = linear_cross_entropy(hidden[valid], weight, target[valid], bias=logits_bias, bias_index=bias_index,
+                                reduction='none', chunk_size=8)
+    expected = reference(hidden, weight, target, logits_bias, 'none')[valid.view(-1)]
+    assert torch.allclose(loss, expected, atol=1e-5)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+@file: test_metrics.py
+@feature: chunked mutual information and streamed active units vs their direct computation
+"""
+import math
+import pytest
+import torch
+from torch.distributions import Normal
+from metrics import log_gaussian_density, mutual_information, LatentStatistics
+
+
+def posteriors(n_x=50, nz=6):
+    torch.manual_seed(0)
+    mu = torch.randn(n_x, nz, dtype=torch.double)
+    ## a few dimensions are collapsed to the prior
+    mu[:, :2] *= 1e-3
+    logvar = torch.randn(n_x, nz, dtype=torch.double) * 0.5
+    return mu, logvar
+
+
+def direct_log_aggregate_posterior(mu, logvar, z):
+    """ log q(z) from the dense (n_z, n_x, nz) densities """
+    log_density = Normal(mu.unsqueeze(0), logvar.mul(0.5).exp().unsqueeze(0)).log_prob(z.unsqueeze(1)).sum(-1)
+    return torch.logsumexp(log_density, dim=1) - math.log(mu.size(0))
+
+
+def closed_form_neg_entropy(logvar):
+    """ E_{q(z|x)}log q(z|x) """
+    return -0.5 * logvar.size(1) * math.log(2 * math.pi) - 0.5 * (1 + logvar).sum(-1)
+
+
+def test_log_gaussian_density():
+    mu, logvar = posteriors()
+    z = torch.randn(7, mu.size(1), dtype=torch.double)
+    expected = Normal(mu.unsqueeze(0), logvar.mul(0.5).exp().unsqueeze(0)).log_prob(z.unsqueeze(1)).sum(-1)
+    assert torch.allclose(log_gaussian_density(z, mu, logvar), expected, atol=1e-8)
+
+
+@pytest.mark.parametrize('chunk_size', [7, 50, 4096])
+def test_mutual_information_all_posteriors(chunk_size):
+    mu, logvar = posteriors()
+    mi, stderr = mutual_information(mu, logvar, chunk_size=chunk_size, generator=torch.Generator().manual_seed(3))
+    assert stderr is None
+
+    ## same z sample as mutual_information draws
+    eps = torch.randn(mu.size(), generator=torch.Generator().manual_seed(3)).double()
+    z = mu + eps * logvar.mul(0.5).exp()
+    terms = closed_form_neg_entropy(logvar) - direct_log_aggregate_posterior(mu, logvar, z)
+    assert mi == pytest.approx(terms.mean().item(), abs=1e-4)
+
+
+@pytest.mark.parametrize('chunk_size', [4, 4096])
+def test_mutual_information_subset(chunk_size):
+    mu, logvar = posteriors()
+    generator = torch.Generator().manual_seed(5)
+    mi, stderr = mutual_information(mu, logvar, chunk_size=chunk_size, num_samples=20, generator=generator)
+
+    generator = torch.Generator().manual_seed(5)
+    rows = torch.randperm(mu.size(0), generator=generator)[:20]
+    eps = torch.randn(20, mu.size(1), generator=generator).double()
+    z = mu[rows] + eps * logvar[rows].mul(0.5).exp()
+    terms = closed_form_neg_entropy(logvar[rows]) - direct_log_aggregate_posterior(mu, logvar, z)
+    assert mi == pytest.approx(terms.mean().item(), abs=1e-4)
+    assert stderr == pytest.approx((terms.std() / math.sqrt(20)).item(), abs=1e-4)
+
+
+def test_latent_statistics_streamed():
+    mu, logvar = posteriors()
+    stats = LatentStatistics()
+    ## uneven batches, the last one a single example
+    for start, end in [(0, 16), (16, 19), (19, 49), (49, 50)]:
+        stats.update(mu[start:end], logvar[start:end])
+    assert stats.count == mu.size(0)
+    assert torch.allclose(stats.mean.double(), mu.mean(dim=0), atol=1e-6)
+    variance = mu.var(dim=0)
+    assert torch.allclose((stats.m2 / (stats.count - 1)).double(), variance, rtol=1e-5, atol=1e-6)
+    for delta in (0.01, 0.5, 1.0):
+        assert stats.active_units(delta) == (variance.float() >= delta).sum().item()
+    assert stats.active_units() == mu.size(1) - 2
+
+    expected = mutual_information(mu.float(), logvar.float(), generator=torch.Generator().manual_seed(3))
+    got = stats.mutual_information(chunk_size=7, generator=torch.Generator().manual_seed(3))
+    assert got[0] == pytest.approx(expected[0], abs=1e-5)
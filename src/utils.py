@@ -6,7 +6,7 @@
 @email: tuisaac163@gmail.com
 @feature: #Enter features here
 """
-import random, re, os
+import random, re, os, time
 # from data.prompt_dataset import *
 # from data.plot_dataset import *
 # from data.arxiv_dataset import *
@@ -20,7 +20,7 @@ import functools
 from rake_nltk import Rake
 import urllib, sys
 import urllib.request
-import json, re
+import json, re, hashlib
 import numpy as np
 import copy
 import math
@@ -54,40 +54,60 @@ def log_sum_exp(value: torch.Tensor, dim: int=None, keepdim: bool=False):
 ################################
 ######## training utils ########
 ################################
-def top_k_top_p_filtering(logits, top_k=100, top_p=0.95, filter_value=-float('Inf')):
-    """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
+def _per_row(value, logits):
+    """scalar or (batch,) sampling parameter as a (batch, 1) tensor"""
+    return torch.as_tensor(value, dtype=logits.dtype, device=logits.device).view(-1, 1)
+
+def top_k_top_p_sample(logits, top_k=0, top_p=0.0, temperature=1.0, sample=True):
+    """ Fused top-k / nucleus (top-p) sampling
+        top-k runs first, nucleus filtering and Gumbel-max sampling only look at the k candidates,
+        so no full-vocabulary sort or softmax is needed.
         Args:
-            logits: logits distribution shape (vocabulary size)
-            top_k > 0: keep only top k tokens with highest probability (top-k filtering).
-            top_p > 0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
-                Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
-        From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+            logits: (batch, vocab_size)
+            top_k: int or (batch,) tensor, <= 0 keeps the full vocabulary
+            top_p: float or (batch,) tensor, <= 0 disables nucleus filtering
+            temperature: float or (batch,) tensor
+            sample: Gumbel-max sampling if True, greedy decoding otherwise
+        Returns:
+            next tokens (batch, 1), their log-probabilities under the filtered distribution (batch, 1)
     """
-    top_k = min(top_k, logits.size(-1))  # Safety check
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # scatter sorted tensors to original indexing
-        indices_to_remove = sorted_indices_to_remove.scatter(dim=1, index=sorted_indices, src=sorted_indices_to_remove)
-        logits[indices_to_remove] = filter_value
-
-    return logits
+    vocab_size = logits.size(-1)
+    logits = logits / _per_row(temperature, logits) if torch.is_tensor(temperature) else logits / temperature
+    if torch.is_tensor(top_k) and top_k.dim() > 0:
+        top_k = torch.where(top_k > 0, top_k.clamp(max=vocab_size), torch.full_like(top_k, vocab_size))
+        max_k = int(top_k.max())
+    else:
+        top_k = int(top_k)
+        max_k = top_k if 0 < top_k < vocab_size else vocab_size
+
+    topk_logits, topk_indices = torch.topk(logits, max_k, dim=-1)  # (B, max_k) sorted
+    if torch.is_tensor(top_k):
+        ranks = torch.arange(max_k, device=logits.device).unsqueeze(0)
+        topk_logits = topk_logits.masked_fill(ranks >= top_k.view(-1, 1).to(logits.device), -float('Inf'))
+
+    if torch.is_tensor(top_p) or top_p > 0.0:
+        top_p = _per_row(top_p, logits)
+        probs = F.softmax(topk_logits, dim=-1)
+        # keep the tokens until the cumulative probability reaches top_p, the first one is always kept
+        to_remove = (torch.cumsum(probs, dim=-1) - probs) > top_p
+        to_remove = to_remove & (top_p > 0)
+        topk_logits = topk_logits.masked_fill(to_remove, -float('Inf'))
+
+    log_probs = F.log_softmax(topk_logits, dim=-1)
+    if sample:
+        # Gumbel-max: argmax(log p - log E), E ~ Exp(1)
+        choice = (log_probs - torch.empty_like(log_probs).exponential_().log()).argmax(dim=-1, keepdim=True)
+    else:
+        choice = torch.zeros_like(topk_indices[:, :1])
+    return topk_indices.gather(-1, choice), log_probs.gather(-1, choice)
 
 def sample_sequence(model, length, z=None, batch_size=None,
                     temperature=1, top_k=100, top_p=0.95, device='cuda',
-                    sample=True, eos_token=None, model_type='cvae'):
+                    sample=True, eos_token=None, model_type='cvae', shortlist=None):
+    """
+    :param shortlist: sorted LongTensor of the token ids allowed in the outputs (see build_vocab_shortlist),
+        lm_head/lm_head_rep are sliced to these rows and sampled ids are mapped back to the full vocabulary
+    """
     with torch.no_grad():
         # if model_type == 'cvae':
         if z is None:
@@ -106,36 +126,220 @@ def sample_sequence(model, length, z=None, batch_size=None,
         #     z = latent_mean
         #     assert not torch.isnan(z).any(), 'training get nan z'
 
-        mem = None
+        ## static KV cache written in place every step, falls back to concatenated ``past`` if unsupported
+        mem = model.transformer.init_kv_cache(length)
+        ## z is fixed along the decode: project it once for every step
+        latent_context = model.init_latent_context(z)
+        if shortlist is not None:
+            ## decode in the reduced vocabulary
+            shortlist = shortlist.to(device)
+            lm_weight = model.lm_head.weight.index_select(0, shortlist)
+            if model.add_softmax:
+                latent_context.logits_rep = latent_context.logits_rep.index_select(-1, shortlist)
         prev = torch.tensor([[eos_token]] * batch_size, dtype=torch.long, device=device)
-
-        output = prev
-        probability = torch.tensor([], dtype=torch.float, device=device)
-        if_end = torch.tensor([False] * batch_size, dtype=torch.bool, device=device)
+        ## per-row sampling parameters, selected along with the active rows
+        row_params = [v.to(device) if torch.is_tensor(v) else v for v in (top_k, top_p, temperature)]
+
+        ## rows are written in place, positions after <eos> keep the <eos> filling
+        output = torch.full((batch_size, length + 1), eos_token, dtype=torch.long, device=device)
+        probability = torch.zeros(batch_size, length, dtype=torch.float, device=device)
+        ## rows of the batch still decoding: finished ones are pruned from the cache and the latent context
+        active = torch.arange(batch_size, device=device)
+        n_steps = 0
         for i in range(length): #trange
-            last_hidden, mem = model.transformer(input_ids=prev, past=mem, representations=z)
+            last_hidden, mem = model.transformer(input_ids=prev, past=mem, representations=latent_context)
 
-            logits = model.lm_head(last_hidden)
-            if model.add_softmax:
-                logits_rep = model.lm_head_rep(z)
-                logits = logits + logits_rep.unsqueeze(dim=1)
-
-            logits = logits[:, -1, :] / temperature
-            logits = top_k_top_p_filtering(logits, top_k, top_p)
-            probs = F.softmax(logits, dim=-1)
-            if sample:
-                next_token = torch.multinomial(probs, num_samples=1)
+            if shortlist is not None:
+                logits = F.linear(last_hidden, lm_weight)
             else:
-                _, next_token = torch.topk(probs, k=1, dim=-1)
+                logits = model.lm_head(last_hidden)
+            if model.add_softmax:
+                logits = logits + latent_context.logits_rep.unsqueeze(dim=1)
 
-            probability = torch.cat((probability, probs.gather(1, next_token)), dim=1)
-            output = torch.cat((output, next_token), dim=1)
+            k, p, t = [v[active] if torch.is_tensor(v) and v.dim() > 0 else v for v in row_params]
+            next_token, log_prob = top_k_top_p_sample(logits[:, -1, :], k, p, t, sample)
+
+            probability[active, i] = log_prob.exp().view(-1)
+            if shortlist is not None:
+                next_token = shortlist[next_token]
+            output[active, i + 1] = next_token.view(-1)
             prev = next_token
+            n_steps = i + 1
 
             # early stopping if all sents have ended once
-            if_end[next_token.view(-1).eq(eos_token)] = True
-            if if_end.all(): break
-    return output, probability
+            not_end = next_token.view(-1).ne(eos_token)
+            if not not_end.any(): break
+            if not not_end.all():
+                keep = not_end.nonzero().view(-1)
+                active, prev = active[keep], prev[keep]
+                mem = model.transformer.select_past(mem, keep)
+                latent_context = latent_context.index_select(keep)
+    return output[:, :n_steps + 1], probability[:, :n_steps]
+
+def stream_sample(model, length, n_slots, z=None, batch_size=None, top_k=100, top_p=0.95, temperature=1,
+                  device='cuda', sample=True, eos_token=None, shortlist=None, stats=None):
+    """
+    streaming sampler: yields every sentence as soon as it has ended, while the others keep decoding.
+    with a static-cache decoder (add_attn/add_mem) sentences are decoded by continuous batching: a fixed number
+    of slots, a slot whose sentence has ended is refilled with the next latent code at once so the batch stays full.
+    other AdaVAEModel decoders fall back to batches of ``n_slots`` through sample_sequence.
+    :param model: AdaVAEModel or Ctrl_AdaVAE (``transformer`` decoder and ``lm_head``)
+    :param length: maximum number of tokens generated per sentence
+    :param n_slots: number of sentences decoded at once
+    :param z: (batch_size, latent_size) latent codes, decoded representations of Ctrl_AdaVAE included;
+        if None, ``batch_size`` codes are drawn from the prior as the slots need them
+    :param stats: dict filled once the stream is exhausted with the throughput (sentences_per_sec, over the
+        decoding time only, the consumer's time between two sentences excluded), the mean share of busy slots
+        (occupancy) and the number of decoding steps
+    :return: generator of (row of z, token ids without <eos>)
+    """
+    n_samples = z.size(0) if z is not None else batch_size
+    n_slots = min(n_slots, n_samples)
+    latent_size = z.size(1) if z is not None else model.AdapterConfig.latent_size
+
+    def latents(index):
+        if z is None:
+            return torch.randn([index.size(0), latent_size], device=device)
+        return z[index].to(device)
+
+    ## only the decoding runs under no_grad and is timed: the consumer's code between two yields is not
+    decode_time = 0.
+    start = time.time()
+    with torch.no_grad():
+        mem = model.transformer.init_slot_cache(n_slots, length, device=device)
+    decode_time += time.time() - start
+    if mem is None:
+        for begin in range(0, n_samples, n_slots):
+            start = time.time()
+            index = torch.arange(begin, min(begin + n_slots, n_samples), device=device)
+            with torch.no_grad():
+                sents, _ = sample_sequence(model, length, latents(index), batch_size=index.size(0), top_k=top_k,
+                                           top_p=top_p, temperature=temperature, device=device, sample=sample,
+                                           eos_token=eos_token, shortlist=shortlist)
+            sents = sents[:, 1:].tolist()
+            decode_time += time.time() - start
+            for row, sent in zip(index.tolist(), sents):
+                yield row, sent[:sent.index(eos_token)] if eos_token in sent else sent
+        if stats is not None:
+            stats.update({'sentences_per_sec': n_samples / max(decode_time, 1e-8)})
+        return
+
+    init_latent_context = getattr(model, 'init_latent_context', model.transformer.init_latent_context)
+    add_softmax = getattr(model, 'add_softmax', False)
+
+    def latent_context_of(index):
+        context = init_latent_context(latents(index))
+        if shortlist is not None and add_softmax:
+            context.logits_rep = context.logits_rep.index_select(-1, shortlist)
+        return context
+
+    start = time.time()
+    with torch.no_grad():
+        if shortlist is not None:
+            shortlist = shortlist.to(device)
+            lm_weight = model.lm_head.weight.index_select(0, shortlist)
+        ## sentence decoded in every slot and its tokens so far, the next one waits for a free slot
+        slot_sample = torch.arange(n_slots, device=device)
+        slot_tokens = torch.full((n_slots, length + 1), eos_token, dtype=torch.long, device=device)
+        next_sample = n_slots
+        latent_context = latent_context_of(slot_sample)
+        prev = torch.full((n_slots, 1), eos_token, dtype=torch.long, device=device)
+    decode_time += time.time() - start
+    n_steps, busy = 0, 0
+    while slot_sample.numel() > 0:
+        start = time.time()
+        with torch.no_grad():
+            last_hidden, mem = model.transformer(input_ids=prev, past=mem, representations=latent_context)
+            if shortlist is not None:
+                logits = F.linear(last_hidden[:, -1, :], lm_weight)
+            else:
+                logits = model.lm_head(last_hidden[:, -1, :])
+            if add_softmax:
+                logits = logits + latent_context.logits_rep
+
+            next_token, _ = top_k_top_p_sample(logits, top_k, top_p, temperature, sample)
+            if shortlist is not None:
+                next_token = shortlist[next_token]
+            ## the cursor already counts the fed <eos>, it is the column of the new token
+            slot_tokens[torch.arange(slot_sample.size(0), device=device), mem.positions] = next_token.view(-1)
+            prev = next_token
+            n_steps += 1
+            busy += slot_sample.numel()
+
+            ended = next_token.view(-1).eq(eos_token)
+            finished = ended | mem.positions.ge(length)
+            done = finished.nonzero().view(-1)
+            rows = list(zip(slot_sample[done].tolist(), slot_tokens[done].tolist(), mem.positions[done].tolist(),
+                            ended[done].tolist()))
+        decode_time += time.time() - start
+        if done.numel() == 0:
+            continue
+        for row, tokens, position, eos in rows:
+            yield row, tokens[1:position] if eos else tokens[1:position + 1]
+
+        start = time.time()
+        with torch.no_grad():
+            ## refill the finished slots while latent codes are waiting, drop the others
+            refill = done[:n_samples - next_sample]
+            if refill.numel() > 0:
+                new_sample = torch.arange(next_sample, next_sample + refill.numel(), device=device)
+                next_sample += refill.numel()
+                latent_context.index_copy_(refill, latent_context_of(new_sample))
+                mem.reset(refill)
+                prev[refill] = eos_token
+                slot_sample[refill] = new_sample
+            if refill.numel() < done.numel():
+                finished[refill] = False
+                keep = (~finished).nonzero().view(-1)
+                slot_sample, slot_tokens, prev = slot_sample[keep], slot_tokens[keep], prev[keep]
+                mem = model.transformer.select_past(mem, keep)
+                latent_context = latent_context.index_select(keep)
+        decode_time += time.time() - start
+    if stats is not None:
+        stats.update({'sentences_per_sec': n_samples / max(decode_time, 1e-8),
+                      'occupancy': busy / max(n_steps * n_slots, 1),
+                      'steps': n_steps})
+
+def continuous_sample(model, length, z, n_slots, top_k=100, top_p=0.95, temperature=1, device='cuda',
+                      sample=True, eos_token=None, shortlist=None):
+    """
+    collect stream_sample over the latent codes ``z``
+    :return: (n_samples, length + 1) ids in the order of ``z``, <eos>-filled as in sample_sequence, dict of stats
+    """
+    stats = {}
+    output = torch.full((z.size(0), length + 1), eos_token, dtype=torch.long)
+    for row, tokens in stream_sample(model, length, n_slots, z=z, top_k=top_k, top_p=top_p, temperature=temperature,
+                                     device=device, sample=sample, eos_token=eos_token, shortlist=shortlist,
+                                     stats=stats):
+        output[row, 1:len(tokens) + 1] = torch.tensor(tokens, dtype=torch.long)
+    return output, stats
+
+def build_vocab_shortlist(texts, tokenizer, min_count=1, special_ids=(), eval_texts=None):
+    """
+    token types a corpus uses, to restrict lm_head during generation
+    :param texts: training texts, formatted as the datasets return them
+    :param min_count: types seen fewer times in ``texts`` are dropped
+    :param special_ids: ids always kept, e.g. <|endoftext|> which ends the sampling
+    :param eval_texts: held-out texts to measure the lost coverage on
+    :return: sorted LongTensor of ids, dict of coverage statistics
+    """
+    def count(corpus):
+        ids = [i for sent in tokenizer(corpus)['input_ids'] for i in sent]
+        return np.bincount(np.array(ids, dtype=np.int64), minlength=len(tokenizer))
+
+    train_counts = count(texts)
+    keep = train_counts >= min_count
+    keep[list(special_ids)] = True
+    shortlist = torch.from_numpy(np.nonzero(keep)[0]).long()
+
+    coverage = {'vocab_size': len(tokenizer),
+                'shortlist_size': shortlist.size(0),
+                ## share of the token occurrences the shortlist cannot produce
+                'train_lost': 1. - train_counts[keep].sum() / train_counts.sum()}
+    if eval_texts is not None:
+        eval_counts = count(eval_texts)
+        coverage['eval_lost'] = 1. - eval_counts[keep].sum() / eval_counts.sum()
+    return shortlist, coverage
 
 def add_special_tokens_(tokenizer, model):
     orig_num_tokens = len(tokenizer.encoder)
@@ -156,6 +360,65 @@ def tokenize(texts, tokenizer, device, args):
     ## target, input tokens, mask
     return x_ids, input_ids, attention_mask
 
+def batch_tokens(batch, tokenizer, device, args):
+    """
+    target, input tokens, mask of a batch as returned by tokenize():
+    moved to the device when the batch is already collated (data.Collator), tokenized from the texts otherwise
+    """
+    if 'input_ids' in batch:
+        return tuple(batch[k].to(device, non_blocking=True) for k in ('x_ids', 'input_ids', 'attention_mask'))
+    return tokenize(batch['x'], tokenizer, device, args)
+
+def parse_layers(spec, n_layer):
+    """ block indices of a layer spec: None/'none', 'all', a range 'start-end' (end included) or a list '0,2,4' """
+    if spec is None or spec == 'none':
+        return []
+    if spec == 'all':
+        return list(range(n_layer))
+    layers = []
+    for part in spec.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            layers.extend(range(int(start), int(end) + 1))
+        else:
+            layers.append(int(part))
+    if any(i < 0 or i >= n_layer for i in layers):
+        raise ValueError(f"layer spec {spec} out of the {n_layer} blocks")
+    return layers
+
+def encoder_cache_key(encoder, token_key):
+    """ identifies the encoder features of a tokenized corpus (see token_cache_key in data.py):
+    the corpus and the frozen encoder parameters the features depend on """
+    key = hashlib.md5(token_key.encode('utf-8'))
+    for name, parameter in encoder.named_parameters():
+        if not parameter.requires_grad:
+            key.update(name.encode('utf-8'))
+            key.update(parameter.detach().float().cpu().numpy().tobytes())
+    return key.hexdigest()
+
+def build_encoder_cache(encoder, loader, features_path, offsets_path, device):
+    """
+    last hidden states of the encoder, dropout off, for every sentence of a sequential loader of data.Collator batches,
+    into a flat fp16 (n_positions, n_embd) file and an int64 offsets index over its positions:
+    sentence i is features[offsets[i]:offsets[i + 1]], one row per unmasked input position
+    """
+    was_training = encoder.training
+    encoder.eval()
+    offsets = [0]
+    with open(features_path + '.tmp', 'wb') as f, torch.no_grad():
+        for batch in tqdm(loader, desc="Caching encoder features"):
+            input_ids, attention_mask = batch['input_ids'].to(device), batch['attention_mask'].to(device)
+            hidden_states = encoder(input_ids=input_ids, attention_mask=attention_mask)[2]
+            lengths = attention_mask.sum(-1).tolist()
+            for i, length in enumerate(lengths):
+                hidden_states[i, :length].half().cpu().numpy().tofile(f)
+                offsets.append(offsets[-1] + length)
+    np.asarray(offsets, dtype=np.int64).tofile(offsets_path + '.tmp')
+    ## only complete caches are visible to other runs
+    os.replace(features_path + '.tmp', features_path)
+    os.replace(offsets_path + '.tmp', offsets_path)
+    encoder.train(was_training)
+
 def num_params(model):
     return sum([np.prod(p.size()) for p in model.parameters() if p.requires_grad])
 